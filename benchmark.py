@@ -0,0 +1,366 @@
+# Copyright 2023  Jacob Wachlin
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all copies or
+#  substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT
+# LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Headless speed and accuracy regression suite. Each case is run with a chosen engine and its summary is
+# compared against golden values recorded with the reference power_profile stepping loop.
+#
+#   python benchmark.py                      run all cases with the stepping loop and check them
+#   python benchmark.py --engine hyperperiod --rtol 1e-3
+#   python benchmark.py --update-golden      record new golden values from the stepping loop
+#   python benchmark.py --baseline           check against the power_profile of the baseline commit
+#   python benchmark.py --record-baseline    record the baseline values, needs git
+#
+# Peak memory comes from a separate run under tracemalloc, which is several times slower than the timed
+# runs. --no-memory skips it.
+#
+# With Numba installed the step engine runs the compiled kernel and step_python the Python loop. The first
+# run in a process also loads the compiled kernel, so use --repeat 2 to time the kernel alone.
+
+import argparse
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+
+import embedded_power_model as epm
+import coin_cell_nonrecharge_example
+import embedded_power_example
+import multiple_sources_partial_charge_example
+import nanosleeper_example
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_FILE = os.path.join(REPO_DIR, "benchmark_golden.json")
+BASELINE_FILE = os.path.join(REPO_DIR, "benchmark_baseline.json")
+
+# Panels are seeded so runs with clouds repeat exactly
+PANEL_SEED = 2023
+
+######### Synthetic Scaling Cases #########
+
+def many_threads_system(num_threads=64):
+    # Many threads with unrelated periods, so nearly every event changes a single thread
+    threads = []
+    for i in range(num_threads):
+        threads.append(epm.Thread(name="Task {0}".format(i), stages=[
+            epm.Stage(delta_t_sec=0.01*(1 + i % 7), components=[
+                epm.Component(name="Peripheral {0}".format(i), mode_name="Active", current_ma=0.5 + 0.25*(i % 5))
+            ]),
+            epm.Stage(delta_t_sec=1.0 + 0.137*i, components=[
+                epm.Component(name="Peripheral {0}".format(i), mode_name="Sleep", current_ma=0.002)
+            ])
+        ]))
+    reg_3v3 = epm.VoltageRegulator(name="3.3V Rail", output_voltage=3.3, is_switching=True, efficiency=0.9, threads=threads[0::2], quiescent_current_ma=0.05)
+    reg_1v8 = epm.VoltageRegulator(name="1.8V Rail", output_voltage=1.8, is_switching=False, threads=threads[1::2], quiescent_current_ma=0.01)
+    source = epm.LithiumIonBattery(name="2Ah, 2S Li-ion", number_cells=2, regulators=[reg_3v3, reg_1v8], capacity_mAh=2000.0, initial_charge_mAh=1800.0,
+                                   internal_resistance_ohm=0.065)
+    return epm.EmbeddedSystem(name="Many threads", sources=[source])
+
+def sub_millisecond_system():
+    # Radio and ADC bursts shorter than a millisecond
+    radio_thread = epm.Thread(name="Radio", stages=[
+        epm.Stage(delta_t_sec=0.0002, components=[epm.Component(name="Radio", mode_name="TX", current_ma=12.0)]),
+        epm.Stage(delta_t_sec=0.0008, components=[epm.Component(name="Radio", mode_name="Idle", current_ma=0.3)])
+    ])
+    adc_thread = epm.Thread(name="ADC", stages=[
+        epm.Stage(delta_t_sec=0.00035, components=[epm.Component(name="ADC", mode_name="Convert", current_ma=1.2)]),
+        epm.Stage(delta_t_sec=0.00115, components=[epm.Component(name="ADC", mode_name="Off", current_ma=0.0)])
+    ])
+    reg_3v0 = epm.VoltageRegulator(name="3.0V Rail", output_voltage=3.0, is_switching=True, efficiency=0.85, threads=[radio_thread, adc_thread], quiescent_current_ma=0.02)
+    source = epm.LithiumIonBattery(name="500mAh, 1S Li-ion", number_cells=1, regulators=[reg_3v0], capacity_mAh=500.0, initial_charge_mAh=500.0,
+                                   internal_resistance_ohm=0.1)
+    return epm.EmbeddedSystem(name="Sub-millisecond stages", sources=[source])
+
+def multi_year_system():
+    # A slow sensor node on a coin cell, run over several years
+    report_thread = epm.Thread(name="Report", stages=[
+        epm.Stage(delta_t_sec=0.05, components=[epm.Component(name="MCU", mode_name="Active", current_ma=3.0)]),
+        epm.Stage(delta_t_sec=1799.95, components=[epm.Component(name="MCU", mode_name="Sleep", current_ma=0.0008)])
+    ])
+    sensor_thread = epm.Thread(name="Sensor", stages=[
+        epm.Stage(delta_t_sec=0.2, components=[epm.Component(name="Sensor", mode_name="On", current_ma=0.4)]),
+        epm.Stage(delta_t_sec=3599.8, components=[epm.Component(name="Sensor", mode_name="Off", current_ma=0.0001)])
+    ])
+    reg_1v8 = epm.VoltageRegulator(name="1.8V Rail", output_voltage=1.8, is_switching=False, threads=[report_thread, sensor_thread], quiescent_current_ma=0.000025)
+    source = epm.LithiumCoinCellBattery(name="210mAh, CR2032", number_cells=1, regulators=[reg_1v8], capacity_mAh=210.0, initial_charge_mAh=210.0,
+                                        internal_resistance_ohm=60.0)
+    return epm.EmbeddedSystem(name="Multi-year", sources=[source])
+
+def many_sources_system(num_sources=16):
+    # Independent solar charged nodes sharing one system
+    sources = []
+    for i in range(num_sources):
+        thread = epm.Thread(name="Node {0}".format(i), stages=[
+            epm.Stage(delta_t_sec=0.5 + 0.01*i, components=[epm.Component(name="Node {0}".format(i), mode_name="Active", current_ma=20.0)]),
+            epm.Stage(delta_t_sec=9.5 + 0.13*i, components=[epm.Component(name="Node {0}".format(i), mode_name="Sleep", current_ma=0.05)])
+        ])
+        reg = epm.VoltageRegulator(name="Node {0} 3.3V Rail".format(i), output_voltage=3.3, is_switching=True, efficiency=0.9, threads=[thread], quiescent_current_ma=0.02)
+        sources.append(epm.LithiumIonBattery(name="Node {0} 1S Li-ion".format(i), number_cells=1, regulators=[reg], capacity_mAh=1000.0, initial_charge_mAh=600.0,
+                                             internal_resistance_ohm=0.05, energy_harvesting=epm.SolarPanel(rated_power_W=0.5, t_offset_sec=3600.0*i)))
+    return epm.EmbeddedSystem(name="Many sources", sources=sources)
+
+# Name, system builder and simulated time of every case
+CASES = [
+    ("nanosleeper", nanosleeper_example.build_system, 86400.0),
+    ("coin_cell", coin_cell_nonrecharge_example.build_system, 2*86400.0),
+    ("esp32", embedded_power_example.build_system, 86400.0),
+    ("multiple_sources", multiple_sources_partial_charge_example.build_system, 86400.0),
+    ("many_threads", many_threads_system, 3600.0),
+    ("sub_millisecond", sub_millisecond_system, 30.0),
+    ("multi_year", multi_year_system, 5*365*86400.0),
+    ("many_sources", many_sources_system, 2*3600.0),
+]
+
+# Every engine runs a freshly built system for sim_time_sec. Faster engines are added here and checked
+# against the golden values of the stepping loop.
+ENGINES = {
+    "step": lambda system, sim_time_sec: system.power_profile(sim_time_sec),
+    "step_python": lambda system, sim_time_sec: system.power_profile(sim_time_sec, backend='python'),
+    "hyperperiod": lambda system, sim_time_sec: system.power_profile(sim_time_sec, use_hyperperiod=True),
+    "split": lambda system, sim_time_sec: system.power_profile(sim_time_sec, split_sources=True),
+    "split_processes": lambda system, sim_time_sec: system.power_profile(sim_time_sec, split_sources=True, processes=None),
+}
+
+######### Measurement #########
+
+def build_case(build):
+    system = build()
+    for i, source in enumerate(system.sources):
+        if source.energy_harvesting is not None:
+            source.energy_harvesting.seed = PANEL_SEED + i
+            source.energy_harvesting.reset()
+    return system
+
+def count_events(build, sim_time_sec):
+    # Stage change events of the stepping loop over the run. Coincident changes count once, as they do in the loop.
+    compiled = build_case(build).compile()
+    return sum(len(times) for times, steps, currents in epm._load_event_blocks(compiled, sim_time_sec))
+
+def measure(build, sim_time_sec, engine, repeat=1, memory=True, prepare=build_case):
+    # Best wall time over repeat runs, then the peak traced memory of one more run
+    run = ENGINES[engine]
+    wall_sec = float('inf')
+    for _ in range(repeat):
+        system = prepare(build)
+        t = time.perf_counter()
+        run(system, sim_time_sec)
+        wall_sec = min(wall_sec, time.perf_counter() - t)
+    peak_bytes = None
+    if memory:
+        traced = prepare(build)
+        tracemalloc.start()
+        run(traced, sim_time_sec)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return system, wall_sec, peak_bytes
+
+######### Golden Values #########
+
+def flatten_summary(summary, prefix=""):
+    # Numeric leaves of a summary, keyed by their path
+    values = {}
+    items = summary.items() if isinstance(summary, dict) else enumerate(summary)
+    for key, value in items:
+        path = "{0}.{1}".format(prefix, key) if prefix else str(key)
+        if isinstance(value, (dict, list)):
+            values.update(flatten_summary(value, path))
+        elif value is None or isinstance(value, (int, float)):
+            values[path] = value
+    return values
+
+def compare(golden, values, rtol, atol):
+    # Returns the largest relative error and the paths that differ beyond tolerance
+    worst = 0.0
+    mismatches = []
+    for path in sorted(set(golden) | set(values)):
+        expected = golden.get(path, "missing")
+        actual = values.get(path, "missing")
+        if expected is None or actual is None or isinstance(expected, str) or isinstance(actual, str):
+            if expected != actual:
+                mismatches.append((path, expected, actual))
+            continue
+        if math.isinf(expected) or math.isinf(actual):
+            if expected != actual:
+                mismatches.append((path, expected, actual))
+            continue
+        error = abs(actual - expected)
+        if expected != 0.0:
+            worst = max(worst, error/abs(expected))
+        if not math.isclose(actual, expected, rel_tol=rtol, abs_tol=atol):
+            mismatches.append((path, expected, actual))
+    return worst, mismatches
+
+def load_golden(filename=GOLDEN_FILE):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, "r") as f:
+        return json.load(f)
+
+def save_golden(golden, filename=GOLDEN_FILE):
+    with open(filename, "w") as f:
+        json.dump(golden, f, indent=1, sort_keys=True)
+        f.write("\n")
+
+######### Baseline Values #########
+
+# Reference values from power_profile as it was at BASELINE_COMMIT, before the stepping loop was rewritten.
+# That version had no summary, so the charge drawn from each source and its net energy are compared. It
+# credited the harvesting of every source at the voltage of the last source, so only single source cases
+# are recorded.
+BASELINE_COMMIT = "f1872b9"
+BASELINE_CASES = ["nanosleeper", "coin_cell", "esp32", "many_threads", "sub_millisecond", "multi_year"]
+BASELINE_RTOL = 1.0e-4
+
+def build_baseline_case(build):
+    # The settings of the baseline: panels evaluated at every load event with clouds drawn from np.random,
+    # and source voltages taken at the current without solving. The baseline's panels have no reset.
+    system = build()
+    for source in system.sources:
+        source.solve_voltage = False
+        panel = source.energy_harvesting
+        if panel is not None:
+            panel.step_sec = None
+            panel.seed = None
+            if hasattr(panel, 'reset'):
+                panel.reset()
+    np.random.seed(PANEL_SEED)
+    return system
+
+def baseline_values(system):
+    return flatten_summary({'drawn_mAh': [source.initial_charge_mAh - source.current_charge_mAh for source in system.sources],
+                            'net_energy_J': [source.net_energy_J for source in system.sources]})
+
+def run_baseline(names):
+    # Values of the cases with the embedded_power_model this module imported
+    values = {}
+    for name, build, sim_time_sec in CASES:
+        if name in names:
+            system = build_baseline_case(build)
+            system.power_profile(sim_time_sec)
+            values[name] = {'sim_time_sec': sim_time_sec, 'values': baseline_values(system)}
+    return values
+
+def record_baseline(names):
+    # Runs the cases in a subprocess that imports the model of the baseline commit instead of this one
+    directory = tempfile.mkdtemp()
+    try:
+        model = subprocess.check_output(["git", "show", BASELINE_COMMIT + ":embedded_power_model.py"], cwd=REPO_DIR)
+        with open(os.path.join(directory, "embedded_power_model.py"), "wb") as f:
+            f.write(model)
+        code = "import sys; sys.path[:0] = [{0!r}, {1!r}]; import json, benchmark; print(json.dumps(benchmark.run_baseline({2!r})))".format(
+            directory, REPO_DIR, list(names))
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=directory)
+    finally:
+        shutil.rmtree(directory)
+    # The baseline prints its errors, the values are on the last line
+    return json.loads(output.decode().splitlines()[-1])
+
+######### Main #########
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the simulator and check it against golden summary values")
+    parser.add_argument("--cases", nargs="+", default=None, help="case names to run, default all")
+    parser.add_argument("--engine", default="step", choices=sorted(ENGINES))
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, the best wall time is reported")
+    parser.add_argument("--rtol", type=float, default=None, help="default 1e-9, or {0} with --baseline".format(BASELINE_RTOL))
+    parser.add_argument("--atol", type=float, default=1.0e-12)
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced run for peak memory")
+    parser.add_argument("--update-golden", action="store_true", help="record golden values with the stepping loop")
+    parser.add_argument("--baseline", action="store_true", help="check against the baseline values instead of the golden values")
+    parser.add_argument("--record-baseline", action="store_true", help="record the baseline values with the model of the baseline commit")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    names = [name for name, build, sim_time_sec in CASES]
+    if args.baseline or args.record_baseline:
+        names = BASELINE_CASES
+    if args.cases is not None:
+        unknown = set(args.cases) - set(names)
+        if unknown:
+            parser.error("unknown cases: {0}".format(", ".join(sorted(unknown))))
+        names = args.cases
+    cases = [case for case in CASES if case[0] in names]
+    if args.update_golden and args.engine != "step":
+        parser.error("golden values are only recorded with the step engine")
+    if args.update_golden and (args.baseline or args.record_baseline):
+        parser.error("golden values are not recorded with the baseline")
+    if args.rtol is None:
+        args.rtol = BASELINE_RTOL if args.baseline else 1.0e-9
+
+    if args.record_baseline:
+        baseline = load_golden(BASELINE_FILE)
+        baseline.update(record_baseline(name for name, build, sim_time_sec in cases))
+        save_golden(baseline, BASELINE_FILE)
+        print("Recorded baseline values of {0} from {1}".format(", ".join(name for name, build, sim_time_sec in cases), BASELINE_COMMIT))
+        return 0
+
+    golden = load_golden(BASELINE_FILE if args.baseline else GOLDEN_FILE)
+    results = []
+    failed = False
+    print("{0:<18} {1:<12} {2:>10} {3:>9} {4:>12} {5:>10} {6:>10}  {7}".format(
+        "case", "engine", "events", "wall s", "events/s", "peak MiB", "max rel", "status"))
+    for name, build, sim_time_sec in cases:
+        events = count_events(build, sim_time_sec)
+        if args.baseline:
+            system, wall_sec, peak_bytes = measure(build, sim_time_sec, args.engine, repeat=args.repeat, memory=not args.no_memory, prepare=build_baseline_case)
+            values = baseline_values(system)
+        else:
+            system, wall_sec, peak_bytes = measure(build, sim_time_sec, args.engine, repeat=args.repeat, memory=not args.no_memory)
+            values = flatten_summary(system.summary())
+
+        worst = None
+        if args.update_golden:
+            golden[name] = {'sim_time_sec': sim_time_sec, 'summary': values}
+            status = "recorded"
+        elif name not in golden:
+            status = "no golden"
+        else:
+            worst, mismatches = compare(golden[name]['values' if args.baseline else 'summary'], values, args.rtol, args.atol)
+            status = "ok"
+            if mismatches:
+                failed = True
+                status = "FAIL"
+                for path, expected, actual in mismatches[:5]:
+                    status = status + "\n    {0}: expected {1}, got {2}".format(path, expected, actual)
+                if len(mismatches) > 5:
+                    status = status + "\n    ... {0} more".format(len(mismatches) - 5)
+
+        peak_mib = peak_bytes/2**20 if peak_bytes is not None else None
+        print("{0:<18} {1:<12} {2:>10} {3:>9.3f} {4:>12.0f} {5:>10} {6:>10}  {7}".format(
+            name, args.engine, events, wall_sec, events/wall_sec if wall_sec > 0.0 else float('inf'),
+            "{0:.2f}".format(peak_mib) if peak_mib is not None else "-",
+            "{0:.2e}".format(worst) if worst is not None else "-", status))
+        results.append({'case': name, 'engine': args.engine, 'sim_time_sec': sim_time_sec, 'events': events,
+                        'wall_sec': wall_sec, 'peak_bytes': peak_bytes, 'max_rel_error': worst, 'status': status.split("\n")[0]})
+
+    if args.update_golden:
+        save_golden(golden)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
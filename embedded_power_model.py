@@ -15,9 +15,40 @@
 # WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE 
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import bisect
+import collections
+import concurrent.futures
+import copy
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import time
+import zlib
+from fractions import Fraction
+
 import numpy as np
 import matplotlib.pyplot as plt
 
+try:
+  import numba
+except ImportError:
+  numba = None
+
+try:
+  import tomllib
+except ImportError:
+  try:
+    import tomli as tomllib
+  except ImportError:
+    tomllib = None
+
 class Component:
   def __init__(self, name, mode_name, current_ma):
     self.name = name
@@ -37,52 +68,906 @@ class Thread:
     self.last_stage_change_t = 0.0
     self.next_stage_change_t = self.last_stage_change_t + stages[0].delta_t_sec
     self.stage_index = 0
+    self.stage_time_sec = [0.0]*self.num_stages
+
+  def cycle_time_sec(self):
+    return sum(stage.delta_t_sec for stage in self.stages)
+
+  def stage_time_over(self, sim_time_sec):
+    # Time spent in each stage over a run from the start of the first stage, whole cycles plus the
+    # part of the last one
+    cycle_time_sec = self.cycle_time_sec()
+    cycles = math.floor(sim_time_sec / cycle_time_sec)
+    stage_time_sec = []
+    stage_start_sec = 0.0
+    for stage in self.stages:
+      partial_sec = min(max(sim_time_sec - cycles*cycle_time_sec - stage_start_sec, 0.0), stage.delta_t_sec)
+      stage_time_sec.append(cycles*stage.delta_t_sec + partial_sec)
+      stage_start_sec = stage_start_sec + stage.delta_t_sec
+    return stage_time_sec
+
+  def stage_arrays(self):
+    # Duration and total current of every stage, as used by CompiledSystem
+    return (np.array([stage.delta_t_sec for stage in self.stages], dtype=float),
+            np.array([sum(component.current_ma for component in stage.components) for stage in self.stages], dtype=float))
+
+  def duty_cycles(self):
+    # Fraction of the last run spent in each stage
+    total_sec = sum(self.stage_time_sec)
+    return [stage_sec/total_sec if total_sec > 0.0 else 0.0 for stage_sec in self.stage_time_sec]
+
+  def reset(self):
+    self.num_stages = len(self.stages)
+    self.last_stage_change_t = 0.0
+    self.next_stage_change_t = self.last_stage_change_t + self.stages[0].delta_t_sec
+    self.stage_index = 0
+    self.stage_time_sec = [0.0]*self.num_stages
+
+######### Measured Current Traces #########
+# A TraceThread replays a measured current waveform as a thread that loops it, from a file of raw samples
+# taken at a fixed rate. The file is memory-mapped and read in chunks of chunk_samples, merging runs of equal
+# samples into stages. With tolerance_ma, a run also takes every following sample within tolerance_ma of its
+# first one, and becomes a stage at the run's mean current. That keeps the charge of the trace exact while
+# shrinking noisy traces to a small stage table. The stage table is written to scratch files as it is made
+# and memory-mapped from there, as are the compiled tables and per-stage times of long traces, so a trace
+# is never held in memory whole.
+
+TRACE_CHUNK_SAMPLES = 1048576
+# Stage tables longer than this are kept in scratch files instead of in memory
+STAGE_TABLE_MEMORY_ROWS = 1048576
+
+def _scratch_array(num_rows, dtype=np.float64):
+  # Zeroed array backed by a temporary file, which is removed once the array is released
+  if num_rows == 0:
+    return np.zeros(0, dtype=dtype)
+  with tempfile.TemporaryFile() as f:
+    f.truncate(num_rows*np.dtype(dtype).itemsize)
+    return np.memmap(f, dtype=dtype, mode='r+', shape=(num_rows,))
+
+def _concatenate_rows(arrays, dtype=np.float64):
+  # np.concatenate of arrays or lists, into a scratch file when the result is too long for memory
+  num_rows = sum(len(array) for array in arrays)
+  if num_rows <= STAGE_TABLE_MEMORY_ROWS:
+    return np.concatenate([np.zeros(0, dtype=dtype)] + [np.asarray(array, dtype=dtype) for array in arrays])
+  result = _scratch_array(num_rows, dtype)
+  row = 0
+  for array in arrays:
+    for start in range(0, len(array), STAGE_TABLE_MEMORY_ROWS):
+      chunk = np.asarray(array[start:start + STAGE_TABLE_MEMORY_ROWS], dtype=dtype)
+      result[row:row + len(chunk)] = chunk
+      row = row + len(chunk)
+  return result
+
+class _StageRows:
+  # Reads a long stage table by index as Python values, converting the block of rows around the index at
+  # a time, since the stepping loop mostly moves through a table in order
+  def __init__(self, array, block_rows=65536):
+    self.array = array
+    self.block_rows = block_rows
+    self.block_start = 0
+    self.block = []
+
+  def __len__(self):
+    return len(self.array)
+
+  def __getitem__(self, i):
+    k = i - self.block_start
+    if 0 <= k < len(self.block):
+      return self.block[k]
+    self.block_start = i - i % self.block_rows
+    self.block = self.array[self.block_start:self.block_start + self.block_rows].tolist()
+    return self.block[i - self.block_start]
+
+def _stage_rows(array):
+  # Per-stage values as the stepping loop updates them, a list unless it would be too long for memory
+  return array.tolist() if len(array) <= STAGE_TABLE_MEMORY_ROWS else np.asarray(array)
+
+def _stage_reader(array):
+  # Per-stage values as the stepping loop reads them
+  return array.tolist() if len(array) <= STAGE_TABLE_MEMORY_ROWS else _StageRows(array)
+
+def _rows_list(rows):
+  return rows.tolist() if isinstance(rows, np.ndarray) else list(rows)
+
+def _stage_time_rows(values):
+  # A copy of per-stage times as threads keep them, a list unless it would be too long for memory
+  return _rows_list(values) if len(values) <= STAGE_TABLE_MEMORY_ROWS else _concatenate_rows([values])
+
+def _compress_trace(samples, sample_period_sec, scale_ma, tolerance_ma, chunk_samples):
+  # Durations and currents of the stages, appended chunk by chunk to scratch files and mapped from there
+  files = (tempfile.TemporaryFile(), tempfile.TemporaryFile())
+  num_stages = [0]
+
+  def write(counts, sums):
+    counts = np.asarray(counts)
+    files[0].write(np.ascontiguousarray(counts*sample_period_sec, dtype=np.float64).tobytes())
+    files[1].write(np.ascontiguousarray(np.asarray(sums)/counts, dtype=np.float64).tobytes())
+    num_stages[0] = num_stages[0] + len(counts)
+
+  if tolerance_ma is None:
+    _trace_runs_equal(samples, scale_ma, chunk_samples, write)
+  else:
+    _trace_runs_within(samples, scale_ma, tolerance_ma, chunk_samples, write)
+  tables = []
+  for f in files:
+    with f:
+      f.flush()
+      tables.append(np.memmap(f, dtype=np.float64, mode='r', shape=(num_stages[0],)))
+  return tuple(tables)
+
+def _trace_runs_equal(samples, scale_ma, chunk_samples, write):
+  run = None # value, count and sum of the run still open at the end of the previous chunk
+  for start in range(0, len(samples), chunk_samples):
+    chunk = np.asarray(samples[start:start + chunk_samples], dtype=np.float64)*scale_ma
+    run_starts = np.concatenate([[0], np.flatnonzero(chunk[1:] != chunk[:-1]) + 1])
+    run_counts = np.diff(np.concatenate([run_starts, [len(chunk)]]))
+    run_sums = np.add.reduceat(chunk, run_starts)
+    if run is not None:
+      if run[0] == chunk[0]:
+        run_counts[0] = run_counts[0] + run[1]
+        run_sums[0] = run_sums[0] + run[2]
+      else:
+        write([run[1]], [run[2]])
+    write(run_counts[:-1], run_sums[:-1])
+    run = (chunk[-1], run_counts[-1], run_sums[-1])
+  write([run[1]], [run[2]])
+
+# Runs within tolerance_ma up to this many samples long are found for every sample of a chunk at once
+TRACE_SHORT_RUN_SAMPLES = 16
+
+def _first_outside(values, start, end, first_ma, tolerance_ma):
+  # Index of the first of values[start:end] more than tolerance_ma from first_ma, or None. Searched in
+  # windows that double, so short runs stay cheap and long ones are read in large slices.
+  window = 64
+  while start < end:
+    outside = np.flatnonzero(np.abs(values[start:min(start + window, end)] - first_ma) > tolerance_ma)
+    if len(outside) > 0:
+      return start + int(outside[0])
+    start = start + window
+    window = 2*window
+  return None
+
+def _trace_runs_within(samples, scale_ma, tolerance_ma, chunk_samples, write):
+  # Each run takes every following sample within tolerance_ma of its first one. For every sample of a chunk,
+  # the length of the run it would start is found at once when it is at most TRACE_SHORT_RUN_SAMPLES, which
+  # leaves a walk from run to run in Python and a search only for the longer runs.
+  short = TRACE_SHORT_RUN_SAMPLES
+  run = None # first value, count and sum of the run still open at the end of the previous chunk
+  for chunk_start in range(0, len(samples), chunk_samples):
+    values = np.asarray(samples[chunk_start:chunk_start + chunk_samples + short], dtype=np.float64)*scale_ma
+    n = min(chunk_samples, len(samples) - chunk_start)
+    i = 0
+    if run is not None:
+      i = _first_outside(values, 0, n, run[0], tolerance_ma)
+      if i is None:
+        run = (run[0], run[1] + n, run[2] + float(np.sum(values[:n])))
+        continue
+      write([run[1] + i], [run[2] + float(np.sum(values[:i]))])
+      run = None
+
+    # Run lengths up to short, zero for longer runs and for runs that may go past the end of the trace
+    padded = np.concatenate([values, np.full(n + short - len(values), np.nan)])
+    run_length = np.zeros(n, dtype=np.int64)
+    for k in range(short, 0, -1):
+      run_length[np.abs(padded[k:k + n] - padded[:n]) > tolerance_ma] = k
+    run_length = run_length.tolist()
+
+    bounds = [i]
+    while i < n:
+      length = run_length[i]
+      if length == 0 or i + length > n:
+        end = _first_outside(values, i + 1, n, values[i], tolerance_ma)
+        if end is None:
+          # Still open at the end of the chunk
+          run = (values[i], n - i, float(np.sum(values[i:n])))
+          break
+        length = end - i
+      i = i + length
+      bounds.append(i)
+    if len(bounds) > 1:
+      write(np.diff(bounds), np.add.reduceat(values[:bounds[-1]], bounds[:-1]))
+  if run is not None:
+    write([run[1]], [run[2]])
+
+def convert_trace_csv(csv_filename, filename, column=0, delimiter=",", skip_rows=0, dtype=np.float32, chunk_rows=TRACE_CHUNK_SAMPLES):
+  # Writes one column of a CSV capture to a raw sample file for TraceThread, chunk_rows lines at a time.
+  # Returns the number of samples written.
+  num_samples = 0
+  with open(csv_filename, 'r') as csv_file, open(filename, 'wb') as f:
+    for _ in range(skip_rows):
+      next(csv_file)
+    while True:
+      lines = list(itertools.islice(csv_file, chunk_rows))
+      if len(lines) == 0:
+        break
+      values = np.loadtxt(lines, delimiter=delimiter, usecols=column, dtype=np.float64, ndmin=1)
+      values.astype(dtype).tofile(f)
+      num_samples = num_samples + len(values)
+  return num_samples
+
+class _TraceStages:
+  # Stages of a TraceThread, made as they are asked for
+  def __init__(self, thread):
+    self.thread = thread
+
+  def __len__(self):
+    return len(self.thread.stage_delta_t_sec)
+
+  def __getitem__(self, i):
+    if i < -len(self) or i >= len(self):
+      raise IndexError("stage index out of range")
+    return Stage(delta_t_sec=float(self.thread.stage_delta_t_sec[i]), components=[
+      Component(name=self.thread.name, mode_name="Trace", current_ma=float(self.thread.stage_current_ma[i]))])
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+class TraceThread(Thread):
+  def __init__(self, name, filename, sample_period_sec, dtype=np.float32, scale_ma=1.0, tolerance_ma=None, start_sample=0, num_samples=None,
+               chunk_samples=TRACE_CHUNK_SAMPLES):
+    # Samples are read as dtype and multiplied by scale_ma to give mA, 1000.0 for a capture in A. A window of
+    # the file is replayed with start_sample and num_samples.
+    if sample_period_sec <= 0.0:
+      raise ValueError("sample_period_sec must be positive")
+    if tolerance_ma is not None and tolerance_ma <= 0.0:
+      raise ValueError("tolerance_ma must be positive, or None to merge only equal samples")
+    self.name = name
+    self.filename = filename
+    self.sample_period_sec = sample_period_sec
+    self.dtype = np.dtype(dtype)
+    self.scale_ma = scale_ma
+    self.tolerance_ma = tolerance_ma
+    self.start_sample = start_sample
+    self.chunk_samples = chunk_samples
+    samples = np.memmap(filename, dtype=dtype, mode='r')
+    end_sample = len(samples) if num_samples is None else min(start_sample + num_samples, len(samples))
+    del samples
+    if end_sample <= start_sample:
+      raise ValueError("Trace {0} has no samples to replay".format(filename))
+    self.num_samples = end_sample - start_sample
+    self._compress()
+    self.reset()
+
+  def _compress(self):
+    samples = np.memmap(self.filename, dtype=self.dtype, mode='r')
+    self.stage_delta_t_sec, self.stage_current_ma = _compress_trace(samples[self.start_sample:self.start_sample + self.num_samples],
+                                                                    self.sample_period_sec, self.scale_ma, self.tolerance_ma, self.chunk_samples)
+
+  def __getstate__(self):
+    # Pickled without the stage table, which is made again from the trace file when unpickled
+    state = self.__dict__.copy()
+    state['stage_delta_t_sec'] = None
+    state['stage_current_ma'] = None
+    state['stage_time_sec'] = np.asarray(self.stage_time_sec, dtype=float)
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._compress()
+    self.stage_time_sec = _stage_time_rows(state['stage_time_sec'])
+
+  @property
+  def stages(self):
+    return _TraceStages(self)
+
+  def stage_arrays(self):
+    return self.stage_delta_t_sec, self.stage_current_ma
+
+  def cycle_time_sec(self):
+    return float(np.sum(self.stage_delta_t_sec))
+
+  def stage_time_over(self, sim_time_sec):
+    cycle_time_sec = self.cycle_time_sec()
+    cycles = math.floor(sim_time_sec / cycle_time_sec)
+    stage_start_sec = np.cumsum(self.stage_delta_t_sec) - self.stage_delta_t_sec
+    partial_sec = np.clip(sim_time_sec - cycles*cycle_time_sec - stage_start_sec, 0.0, self.stage_delta_t_sec)
+    return _stage_rows(cycles*self.stage_delta_t_sec + partial_sec)
+
+  def reset(self):
+    self.num_stages = len(self.stage_delta_t_sec)
+    self.last_stage_change_t = 0.0
+    self.next_stage_change_t = self.last_stage_change_t + float(self.stage_delta_t_sec[0])
+    self.stage_index = 0
+    self.stage_time_sec = [0.0]*self.num_stages if self.num_stages <= STAGE_TABLE_MEMORY_ROWS else _scratch_array(self.num_stages)
+
+######### Time History #########
+# Recorded series are stored column-wise in preallocated NumPy chunks, one row per event, with the values of
+# a row holding until the next row. Time is always kept as float64 while the other columns use the policy
+# dtype. A policy may decimate what is kept, either every Nth event or the min/max of each column per time
+# bucket, but the time integral of every column is always accumulated over all events.
+
+class HistoryPolicy:
+  def __init__(self, dtype=np.float64, keep_every=1, bucket_sec=None, chunk_rows=16384):
+    self.dtype = np.dtype(dtype)
+    self.keep_every = keep_every
+    self.bucket_sec = bucket_sec
+    self.chunk_rows = chunk_rows
+
+  def create(self, columns, name="history"):
+    return HistoryRecorder(columns, self, name)
+
+class HistoryRecorder:
+  # name is the series name a system files the history under, see EmbeddedSystem._histories
+  def __init__(self, columns, policy=None, name="history"):
+    self.name = name
+    self.columns = list(columns)
+    self.policy = HistoryPolicy() if policy is None else policy
+    self.num_events = 0
+    self.end_t = None
+    self._integrals = [0.0]*len(self.columns)
+    self._last_t = None
+    self._last_values = None
+    self._bucket = None
+    self._time_chunks = []
+    self._value_chunks = []
+    self._new_chunk()
+
+  def _new_chunk(self):
+    self._time = np.empty(self.policy.chunk_rows, dtype=np.float64)
+    self._values = np.empty((self.policy.chunk_rows, len(self.columns)), dtype=self.policy.dtype)
+    self._row = 0
+    self._cache = None
+
+  def append(self, t, values):
+    if self._last_values is not None:
+      dt = t - self._last_t
+      for c, value in enumerate(self._last_values):
+        self._integrals[c] = self._integrals[c] + value*dt
+    self._last_t = t
+    self._last_values = values
+    self.num_events = self.num_events + 1
+
+    if self.policy.bucket_sec is not None:
+      bucket = int(t // self.policy.bucket_sec)
+      if self._bucket is not None and bucket != self._bucket[0]:
+        self._flush_bucket()
+      if self._bucket is None:
+        self._bucket = [bucket, t, list(values), t, list(values)]
+      else:
+        self._bucket[2] = [min(a, b) for a, b in zip(self._bucket[2], values)]
+        self._bucket[3] = t
+        self._bucket[4] = [max(a, b) for a, b in zip(self._bucket[4], values)]
+    elif (self.num_events - 1) % self.policy.keep_every == 0:
+      self._store(t, values)
+
+  def append_rows(self, t, values):
+    # Same as appending every row of t and values in turn
+    if len(t) == 0:
+      return
+    if self.policy.bucket_sec is not None:
+      for row_t, row_values in zip(t.tolist(), values.tolist()):
+        self.append(row_t, row_values)
+      return
+    # Integrated row after row in the same order as append, since cumsum adds up sequentially
+    if self._last_values is not None:
+      dt = np.diff(np.concatenate([[self._last_t], t]))
+      previous = np.concatenate([[self._last_values], values[:-1]])
+    else:
+      dt = np.diff(t)
+      previous = values[:-1]
+    for c in range(len(self.columns)):
+      self._integrals[c] = float(np.cumsum(np.concatenate([[self._integrals[c]], previous[:, c]*dt]))[-1])
+    self._last_t = float(t[-1])
+    self._last_values = values[-1].tolist()
+    kept = (self.num_events + np.arange(len(t))) % self.policy.keep_every == 0
+    self.num_events = self.num_events + len(t)
+    self._store_rows(t[kept], values[kept])
+
+  def _store_rows(self, t, values):
+    start = 0
+    while start < len(t):
+      if self._row == self.policy.chunk_rows:
+        self._store_chunk(self._time, self._values)
+        self._new_chunk()
+      num_rows = min(len(t) - start, self.policy.chunk_rows - self._row)
+      self._time[self._row:self._row + num_rows] = t[start:start + num_rows]
+      self._values[self._row:self._row + num_rows] = values[start:start + num_rows]
+      self._row = self._row + num_rows
+      start = start + num_rows
+    self._cache = None
+
+  def _flush_bucket(self):
+    bucket, first_t, minimums, last_t, maximums = self._bucket
+    self._store(first_t, minimums)
+    if last_t > first_t:
+      self._store(last_t, maximums)
+    self._bucket = None
+
+  def _store(self, t, values):
+    if self._row == self.policy.chunk_rows:
+      self._store_chunk(self._time, self._values)
+      self._new_chunk()
+    self._time[self._row] = t
+    self._values[self._row] = values
+    self._row = self._row + 1
+    self._cache = None
+
+  def _store_chunk(self, time, values):
+    self._time_chunks.append(time)
+    self._value_chunks.append(values)
+
+  def close(self, end_t):
+    # Integrates the last row up to the end of the run and stores any pending bucket
+    if self._last_values is not None:
+      for c, value in enumerate(self._last_values):
+        self._integrals[c] = self._integrals[c] + value*(end_t - self._last_t)
+      self._last_t = end_t
+    if self._bucket is not None:
+      self._flush_bucket()
+    self.end_t = end_t
+
+  def _arrays(self):
+    if self._cache is None:
+      self._cache = (np.concatenate(self._time_chunks + [self._time[:self._row]]),
+                     np.concatenate(self._value_chunks + [self._values[:self._row]]))
+    return self._cache
+
+  def __len__(self):
+    return len(self._arrays()[0])
+
+  @property
+  def time(self):
+    return self._arrays()[0]
+
+  def column(self, name):
+    return self._arrays()[1][:, self.columns.index(name)]
+
+  def integral(self, name):
+    return self._integrals[self.columns.index(name)]
+
+  @property
+  def nbytes(self):
+    return sum(chunk.nbytes for chunk in self._time_chunks + self._value_chunks) + self._time.nbytes + self._values.nbytes
+
+######### Streaming History to Disk #########
+# A HistorySink is a policy whose recorders append each full chunk to raw binary files in a directory as the
+# run progresses, so memory stays bounded by one chunk per series regardless of the horizon. A JSON manifest
+# describes every series and load_history() memory-maps them back for analysis and plotting.
+
+HISTORY_MANIFEST = "manifest.json"
+
+class HistorySink(HistoryPolicy):
+  def __init__(self, directory, dtype=np.float64, keep_every=1, bucket_sec=None, chunk_rows=16384):
+    HistoryPolicy.__init__(self, dtype=dtype, keep_every=keep_every, bucket_sec=bucket_sec, chunk_rows=chunk_rows)
+    self.directory = directory
+    self.recorders = {}
+    os.makedirs(directory, exist_ok=True)
+
+  def create(self, columns, name="history"):
+    recorder = DiskHistoryRecorder(columns, self, name)
+    self.recorders[name] = recorder
+    return recorder
+
+  def write_manifest(self):
+    manifest = {}
+    for name, recorder in self.recorders.items():
+      manifest[name] = {
+        'columns': recorder.columns,
+        'dtype': recorder.policy.dtype.str,
+        'num_rows': recorder.num_rows,
+        'num_events': recorder.num_events,
+        'end_t': recorder.end_t,
+        'integrals': recorder._integrals,
+        'time_file': recorder.time_file,
+        'values_file': recorder.values_file,
+      }
+    _write_manifest(self.directory, manifest)
+
+def _write_manifest(directory, manifest):
+  temp_filename = os.path.join(directory, HISTORY_MANIFEST + ".tmp")
+  with open(temp_filename, 'w') as f:
+    json.dump(manifest, f, indent=2)
+  os.replace(temp_filename, os.path.join(directory, HISTORY_MANIFEST))
+
+class DiskHistoryRecorder(HistoryRecorder):
+  def __init__(self, columns, sink, name):
+    self.sink = sink
+    self.time_file = name + "_time.bin"
+    self.values_file = name + "_values.bin"
+    self.num_rows = 0
+    self._time_out = open(os.path.join(sink.directory, self.time_file), 'wb')
+    self._values_out = open(os.path.join(sink.directory, self.values_file), 'wb')
+    HistoryRecorder.__init__(self, columns, sink, name)
+
+  def _new_chunk(self):
+    # The chunk is written out before it is reused, so a single buffer is enough
+    if not hasattr(self, '_time'):
+      HistoryRecorder._new_chunk(self)
+    self._row = 0
+    self._cache = None
+
+  def _store_chunk(self, time, values):
+    if self._time_out.closed:
+      # An extended run keeps appending after the recorder was closed
+      self._time_out = open(os.path.join(self.sink.directory, self.time_file), 'ab')
+      self._values_out = open(os.path.join(self.sink.directory, self.values_file), 'ab')
+    time.tofile(self._time_out)
+    values.tofile(self._values_out)
+    self.num_rows = self.num_rows + len(time)
+
+  def close(self, end_t):
+    HistoryRecorder.close(self, end_t)
+    self._store_chunk(self._time[:self._row], self._values[:self._row])
+    self._row = 0
+    self._time_out.close()
+    self._values_out.close()
+    self.sink.write_manifest()
+
+  def _arrays(self):
+    if self._cache is None:
+      if not self._time_out.closed:
+        self._time_out.flush()
+        self._values_out.flush()
+      time, values = _map_history_files(self.sink.directory, self.time_file, self.values_file, self.num_rows, len(self.columns), self.policy.dtype)
+      if self._row > 0:
+        time = np.concatenate([time, self._time[:self._row]])
+        values = np.concatenate([values, self._values[:self._row]])
+      self._cache = (time, values)
+    return self._cache
+
+  @property
+  def nbytes(self):
+    return self._time.nbytes + self._values.nbytes
+
+def _map_history_files(directory, time_file, values_file, num_rows, num_columns, dtype):
+  if num_rows == 0:
+    return np.zeros(0), np.zeros((0, num_columns), dtype=dtype)
+  time = np.memmap(os.path.join(directory, time_file), dtype=np.float64, mode='r', shape=(num_rows,))
+  values = np.memmap(os.path.join(directory, values_file), dtype=dtype, mode='r', shape=(num_rows, num_columns))
+  return time, values
+
+class MappedHistory:
+  # Read-only history backed by memory-mapped files, with the same reading interface as HistoryRecorder
+  def __init__(self, directory, entry, name="history"):
+    self.name = name
+    self.columns = entry['columns']
+    self.num_events = entry['num_events']
+    self.end_t = entry['end_t']
+    self._integrals = entry['integrals']
+    self._time, self._values = _map_history_files(directory, entry['time_file'], entry['values_file'], entry['num_rows'],
+                                                  len(self.columns), np.dtype(entry['dtype']))
+
+  def __len__(self):
+    return len(self._time)
+
+  @property
+  def time(self):
+    return self._time
+
+  def column(self, name):
+    return self._values[:, self.columns.index(name)]
+
+  def integral(self, name):
+    return self._integrals[self.columns.index(name)]
+
+  def _arrays(self):
+    return self._time, self._values
+
+  @property
+  def nbytes(self):
+    return 0
+
+def load_history(directory):
+  with open(os.path.join(directory, HISTORY_MANIFEST)) as f:
+    manifest = json.load(f)
+  return {name: MappedHistory(directory, entry, name) for name, entry in manifest.items()}
+
+def _write_series(directory, name, columns, time, values, num_events, end_t, integrals):
+  np.asarray(time, dtype=np.float64).tofile(os.path.join(directory, name + "_time.bin"))
+  np.ascontiguousarray(values).tofile(os.path.join(directory, name + "_values.bin"))
+  return {
+    'columns': list(columns),
+    'dtype': values.dtype.str,
+    'num_rows': len(time),
+    'num_events': num_events,
+    'end_t': end_t,
+    'integrals': [float(integral) for integral in integrals],
+    'time_file': name + "_time.bin",
+    'values_file': name + "_values.bin",
+  }
+
+def save_history(directory, histories):
+  # Writes finished histories, given as {name: history}, in the layout of a HistorySink for load_history
+  os.makedirs(directory, exist_ok=True)
+  manifest = {}
+  for name, history in histories.items():
+    time, values = history._arrays()
+    manifest[name] = _write_series(directory, name, history.columns, time, values, history.num_events, history.end_t, history._integrals)
+  _write_manifest(directory, manifest)
+
+def _step_profile(t, values, end_t):
+  # Each value holds until the next time, so every row becomes two points of a square profile
+  edges_t = np.empty(2*len(t))
+  edges_t[0::2] = t
+  edges_t[1::2] = np.append(t[1:], end_t)
+  return edges_t, np.repeat(values, 2)
+
+def _step_values_at(series_t, series_values, t):
+  # Values of a step series at times t, zero before its first time
+  index = np.searchsorted(series_t, t, side='right') - 1
+  return np.where(index >= 0, series_values[np.maximum(index, 0)], 0.0)
+
+def _step_integral(t, values, end_t):
+  return float(np.sum(values[:-1]*np.diff(t)) + values[-1]*(end_t - t[-1])) if len(t) > 0 else 0.0
+
+def _plot_resolution():
+  # Horizontal pixels of a default figure
+  return int(plt.rcParams['figure.figsize'][0]*plt.rcParams['figure.dpi'])
+
+def _window_rows(t, window):
+  # Rows of t from the one holding at the start of the window up to the end of the window
+  if window is None or len(t) == 0:
+    return 0, len(t)
+  start = max(int(np.searchsorted(t, window[0], side='right')) - 1, 0)
+  end = int(np.searchsorted(t, window[1], side='left'))
+  return start, max(end, min(start + 1, len(t)))
+
+def _plot_series(t, values, end_t, window=None, resolution=None, step=True):
+  # Points to plot a series over the time window, by default the whole run. values(start, end) gives the
+  # values of rows start to end, so only the window is read, one chunk at a time. Beyond two rows per pixel
+  # every pixel becomes a vertical stroke over the lowest and highest value held within it, which keeps
+  # short spikes visible at any zoom level.
+  resolution = _plot_resolution() if resolution is None else resolution
+  start, end = _window_rows(t, window)
+  if end <= start:
+    return np.array([]), np.array([])
+  next_t = t[end] if end < len(t) else end_t
+  if end - start <= 2*resolution:
+    if step:
+      return _step_profile(t[start:end], values(start, end), next_t)
+    return t[start:end], values(start, end)
+
+  t_min = t[start] if window is None else max(window[0], t[start])
+  t_max = next_t if window is None else min(window[1], next_t)
+  width = (t_max - t_min) / resolution
+  first_values = values(start, start + 1)
+  points_t, points_values = [np.array([t_min])], [first_values]
+  carried = first_values[0]
+  for chunk_start in range(start, end, PLOT_CHUNK_ROWS):
+    chunk_end = min(chunk_start + PLOT_CHUNK_ROWS, end)
+    chunk_values = np.asarray(values(chunk_start, chunk_end))
+    pixel = np.clip(((t[chunk_start:chunk_end] - t_min) // width).astype(np.int64), 0, resolution - 1)
+    firsts = np.flatnonzero(np.diff(pixel, prepend=-1))
+    lasts = np.append(firsts[1:], len(pixel)) - 1
+    # The value held when a pixel starts belongs to it too, and keeps levels flat across empty pixels
+    held = np.concatenate([[carried], chunk_values[lasts[:-1]]])
+    minimums = np.minimum(np.minimum.reduceat(chunk_values, firsts), held)
+    maximums = np.maximum(np.maximum.reduceat(chunk_values, firsts), held)
+    points_t.append(np.repeat(t_min + pixel[firsts]*width, 4))
+    points_values.append(np.column_stack([held, minimums, maximums, chunk_values[lasts]]).ravel())
+    carried = chunk_values[-1]
+  points_t.append(np.array([t_max]))
+  points_values.append(np.array([carried]))
+  return np.concatenate(points_t), np.concatenate(points_values)
+
+def _column_rows(column):
+  return lambda start, end: column[start:end]
+
+def _sum_step_series(series):
+  # Sums step series that may be recorded at different times, on the union of their times
+  if len(series) == 1:
+    return series[0]
+  t = np.unique(np.concatenate([series_t for series_t, series_values in series]))
+  total = np.zeros(len(t))
+  for series_t, series_values in series:
+    total = total + _step_values_at(series_t, series_values, t)
+  return t, total
+
+def _merged_step_times(times, chunk_rows):
+  # Union of the times of several step series, a chunk at a time so the whole union is never held. Each
+  # chunk takes at most chunk_rows times of every series, up to the earliest time where one would run past
+  # that. Yields the chunk's times, the time after the chunk (None after the last) and the range of rows
+  # taken from each series. A single series is passed through as it is, like _sum_step_series does.
+  starts = [0]*len(times)
+  while any(start < len(t) for start, t in zip(starts, times)):
+    bound = min([t[start + chunk_rows - 1] for start, t in zip(starts, times) if len(t) - start >= chunk_rows], default=np.inf)
+    ends = [int(np.searchsorted(t, bound, side='right')) if bound < np.inf else len(t) for t in times]
+    if len(times) == 1:
+      chunk_t = times[0][starts[0]:ends[0]]
+    else:
+      chunk_t = np.unique(np.concatenate([t[start:end] for start, end, t in zip(starts, ends, times)]))
+    following = [t[end] for end, t in zip(ends, times) if end < len(t)]
+    yield chunk_t, min(following) if len(following) > 0 else None, list(zip(starts, ends))
+    starts = ends
 
 ######### Generators Charge Sources #########
 
 class SolarPanel:
+  # Harvesting is integrated on its own grid of step_sec, exactly over the diurnal sine with the clouds held
+  # for each step, and credited to the source as load events pass the end of each step. step_sec=None
+  # evaluates the power at every load event instead, holding it over the time since the previous event.
   def __init__(self, rated_power_W, charge_efficiency=0.7, t_offset_sec = 0.0, 
-      clouds_tau=3600.0, clouds_cover = 1.0):
+      clouds_tau=3600.0, clouds_cover = 1.0, seed=None, step_sec=60.0):
+    if step_sec is not None and step_sec <= 0.0:
+      raise ValueError("step_sec must be positive, or None to evaluate at every load event")
     self.rated_power_W = rated_power_W
     self.charge_efficiency = charge_efficiency
     self.t_offset_sec = t_offset_sec
     self.clouds_tau = clouds_tau
     self.clouds_cover = clouds_cover
-    self.random_walk_val = 0.0
-    self.last_time_s = 0.0
-    self.time = []
-    self.power_history_W = []
-    self.random_walk_vals = []
+    self.step_sec = step_sec
+    # With a seed the clouds come from the panel's own generator and repeat run to run, otherwise from np.random
+    self.seed = seed
+    self.reset()
 
-  def calculate_power(self, t):
+  def reset(self):
+    self.rng = np.random.default_rng(self.seed) if self.seed is not None else None
+    self.random_walk_val = 0.0
+    self.history = HistoryRecorder(['power_W', 'random_walk'])
+    self.restart()
 
-    dt = t - self.last_time_s
-    if(dt > 0.0):
-      f = np.exp(-dt/self.clouds_tau)
-      self.random_walk_val = f*self.random_walk_val + np.sqrt(1.0-f**2.0) * np.random.randn()
+  def restart(self):
+    # Starts the panel's clock over at zero, keeping the cloud random walk and generator where they are
+    self.last_time_s = 0.0
+    self.step_start_t = None
+    self.next_step_t = 0.0
+    self.integrated_until_t = 0.0
 
+  def clear_sky_power(self, t):
+    # t may be a scalar or an array of times
     power = self.rated_power_W*(1.0/0.65)*(np.sin(((2.0*np.pi)/86400)*(t+self.t_offset_sec)) - 0.35)
+    if isinstance(power, np.ndarray):
+      return np.maximum(power, 0.0)
     if power < 0.0:
       power = 0.0
+    return power
+
+  def _clear_sky_phase_integral(self, t):
+    # Integral of max(sin(theta) - 0.35, 0) from theta = 0 to the phase at time t, a whole number of days
+    # plus the part of the current day's daylight that has passed
+    theta = ((2.0*np.pi)/86400)*(t+self.t_offset_sec)
+    sunrise = np.arcsin(0.35)
+    daily = 2.0*np.cos(sunrise) - 0.35*(np.pi - 2.0*sunrise)
+    days = np.floor(theta/(2.0*np.pi))
+    if isinstance(theta, float):
+      # np.clip costs more than the rest of the integral for a single time
+      phase = min(max(theta - days*2.0*np.pi, sunrise), np.pi - sunrise)
+    else:
+      phase = np.clip(theta - days*2.0*np.pi, sunrise, np.pi - sunrise)
+    return days*daily + (np.cos(sunrise) - np.cos(phase)) - 0.35*(phase - sunrise)
+
+  def clear_sky_energy(self, t_start, t_end):
+    # Exact integral of clear_sky_power in J, for scalars or arrays of times
+    return self.rated_power_W*(1.0/0.65)*(86400/(2.0*np.pi))*(self._clear_sky_phase_integral(t_end) - self._clear_sky_phase_integral(t_start))
 
+  def _cloud_factor(self):
     # Calculate threshold based on normal distribution
     if np.abs(self.random_walk_val) > self.clouds_cover:
-      power = 0.1*power
+      return 0.1
+    return 1.0
 
-    self.time.append(t)
-    self.power_history_W.append(power) 
-    self.random_walk_vals.append(self.random_walk_val)
+  def _advance_random_walk(self, t):
+    dt = t - self.last_time_s
+    if(dt > 0.0):
+      f = np.exp(-dt/self.clouds_tau)
+      normal = self.rng.standard_normal() if self.rng is not None else np.random.randn()
+      self.random_walk_val = f*self.random_walk_val + np.sqrt(1.0-f**2.0) * normal
     self.last_time_s = t
+
+  def _open_step(self, t):
+    # Clouds are drawn at the start of each step and held over it, the history keeps the step's mean power
+    self._advance_random_walk(t)
+    self.step_start_t = t
+    self.next_step_t = t + self.step_sec
+    if self.history is not None:
+      self.history.append(t, [self._cloud_factor()*self.clear_sky_energy(t, self.next_step_t)/self.step_sec, self.random_walk_val])
+
+  def harvest_until(self, t, partial=False):
+    # Energy in J from the end of the last harvest up to t, for every step completed by t and, with partial,
+    # the part of the current step up to t as well
+    if self.step_sec is None:
+      if t <= self.integrated_until_t:
+        return 0.0
+      energy_J = self.calculate_power(t) * (t - self.integrated_until_t)
+      self.integrated_until_t = t
+      return energy_J
+
+    if self.step_start_t is None:
+      self._open_step(self.integrated_until_t)
+    energy_J = 0.0
+    while t >= self.next_step_t:
+      energy_J = energy_J + self._cloud_factor()*self.clear_sky_energy(self.integrated_until_t, self.next_step_t)
+      self.integrated_until_t = self.next_step_t
+      self._open_step(self.next_step_t)
+    if partial and t > self.integrated_until_t:
+      energy_J = energy_J + self._cloud_factor()*self.clear_sky_energy(self.integrated_until_t, t)
+      self.integrated_until_t = t
+    return energy_J
+
+  def calculate_power(self, t):
+
+    self._advance_random_walk(t)
+
+    power = self._cloud_factor()*self.clear_sky_power(t)
+
+    if self.history is not None:
+      self.history.append(t, [power, self.random_walk_val])
     return power
 
   def capacity_factor(self):
     return np.mean(self.power_history_W)/self.rated_power_W
 
+  @property
+  def time(self):
+    return self.history.time if self.history is not None else np.array([])
+
+  @property
+  def power_history_W(self):
+    return self.history.column('power_W') if self.history is not None else np.array([])
+
+  @property
+  def random_walk_vals(self):
+    return self.history.column('random_walk') if self.history is not None else np.array([])
+
+
+######### Open Circuit Voltage Curves #########
+# Cell voltage vs. state of charge, linearly interpolated between table points with the segment slopes
+# precomputed. A scalar state of charge takes a bisect fast path for the stepping loop, while arrays of any
+# shape are evaluated in one np.interp call. Outside of the table the end voltages are held.
+
+class OCVCurve:
+  def __init__(self, soc_table, cell_voltage_table):
+    if len(soc_table) != len(cell_voltage_table) or len(soc_table) < 2:
+      raise ValueError("soc_table and cell_voltage_table must have the same length, with at least two points")
+    if any(soc_table[i+1] <= soc_table[i] for i in range(len(soc_table)-1)):
+      raise ValueError("soc_table must be strictly increasing")
+    self.soc_table = np.array(soc_table, dtype=float)
+    self.cell_voltage_table = np.array(cell_voltage_table, dtype=float)
+    self.slopes = np.diff(self.cell_voltage_table) / np.diff(self.soc_table)
+    self._soc_list = self.soc_table.tolist()
+    self._voltage_list = self.cell_voltage_table.tolist()
+    self._slope_list = self.slopes.tolist()
+
+  def segment(self, soc):
+    if isinstance(soc, (float, int)):
+      return min(max(bisect.bisect_right(self._soc_list, soc) - 1, 0), len(self._slope_list) - 1)
+    return np.clip(np.searchsorted(self.soc_table, soc, side='right') - 1, 0, len(self.slopes) - 1)
+
+  def cell_voltage(self, soc):
+    if isinstance(soc, (float, int)):
+      if soc <= self._soc_list[0]:
+        return self._voltage_list[0]
+      if soc >= self._soc_list[-1]:
+        return self._voltage_list[-1]
+      i = bisect.bisect_right(self._soc_list, soc) - 1
+      return self._voltage_list[i] + self._slope_list[i]*(soc - self._soc_list[i])
+    return np.interp(soc, self.soc_table, self.cell_voltage_table)
+
 
 ######### Sources #########
 
+# Source.solve_current iterates until the current changes by at most this fraction
+SAG_RTOL = 1.0e-9
+SAG_MAX_ITERATIONS = 100
+# Relative step of the finite differences taken for cached solutions
+SAG_STEP = 1.0e-6
+
+def _sagged_current_ma(base_ma, switching_mW, open_circuit_voltage, drop_ohm):
+  # Source current I = base_ma + switching_mW / V at the voltage V = open_circuit_voltage - drop_ohm*I*0.001
+  # it sags to, for a load of base_ma drawn at any voltage and switching regulators drawing switching_mW.
+  # This is the smaller root of a quadratic, the one fixed-point iteration from the open circuit voltage
+  # settles on, written to stay exact as drop_ohm goes to zero. Also returns whether the source can supply
+  # the load at all, and when it cannot, the current at which it delivers the most power instead.
+  if switching_mW == 0.0:
+    return base_ma, True
+  drop = drop_ohm*0.001
+  b = open_circuit_voltage + drop*base_ma
+  c = open_circuit_voltage*base_ma + switching_mW
+  discriminant = b*b - 4.0*drop*c
+  if discriminant < 0.0:
+    return b/(2.0*drop), False
+  return 2.0*c/(b + math.sqrt(discriminant)), True
+
 class Source:
-  def __init__(self, name, number_cells, regulators, capacity_mAh, initial_charge_mAh, internal_resistance_ohm, energy_harvesting=None):
+  ocv_curve = None
+
+  def __init__(self, name, number_cells, regulators, capacity_mAh, initial_charge_mAh, internal_resistance_ohm, energy_harvesting=None,
+               ocv_curve=None, solve_voltage=True):
+    # With solve_voltage the source voltage and the current its regulators draw are solved together, see
+    # solve_current. Without it each switching regulator sees the voltage sagged by its own output current
+    # rather than by the current the source supplies, which understates the sag. That is how the model
+    # worked before, and is kept to compare with earlier results.
     self.name = name
     self.number_cells = number_cells
     self.regulators = regulators
@@ -91,45 +976,211 @@ class Source:
     self.current_charge_mAh = initial_charge_mAh
     self.internal_resistance_ohm = internal_resistance_ohm
     self.energy_harvesting = energy_harvesting
-    self.net_energy_J = 0.0
-    self.time = []
-    self.charge_history_time = []
-    self.charge_history_mAh = []
-    self.voltage_history = []
-    self.current_history_ma = []
+    self.solve_voltage = solve_voltage
+    if ocv_curve is not None:
+      self.ocv_curve = ocv_curve
+    elif self.ocv_curve is None and hasattr(self, 'soc_table'):
+      # Subclasses may still describe their chemistry with soc_table and cell_voltage_table
+      self.ocv_curve = OCVCurve(self.soc_table, self.cell_voltage_table)
+    self.history = None
+    self.reset_statistics()
 
-class LithiumIonBattery(Source):
+  def reset(self):
+    self.current_charge_mAh = self.initial_charge_mAh
+    self.history = None
+    self.reset_statistics()
+    if self.energy_harvesting is not None:
+      self.energy_harvesting.reset()
+    for regulator in self.regulators:
+      regulator.reset()
 
-  soc_table = [0.0, 10.0, 20.0, 30.0, 40.0, 50.0, 60.0, 70.0, 80.0, 90.0, 95.0, 100.0]
-  cell_voltage_table = [2.25, 3.5, 3.65, 3.72, 3.73, 3.75, 3.76, 3.77, 3.78, 3.85, 4.1, 4.25]
+  def reset_statistics(self):
+    # Accumulated while a run progresses, so summaries do not need the time history
+    self.net_energy_J = 0.0
+    self.energy_in_J = 0.0
+    self.energy_out_J = 0.0
+    self.charge_out_mAh = 0.0
+    self.peak_current_ma = 0.0
+    self.min_voltage = None
+
+  def min_input_voltage(self):
+    # Lowest source voltage every regulator with a dropout voltage can still regulate from
+    voltages = [reg.output_voltage + reg.dropout_voltage for reg in self.regulators if reg.dropout_voltage is not None]
+    return max(voltages) if len(voltages) > 0 else float('-inf')
 
   def get_current_voltage(self, total_current_ma=0.0):
+    return self.voltage_at(self.current_charge_mAh, total_current_ma)
+
+  def _sags_linearly(self):
+    # Whether solve_current has a closed form: the voltage drops linearly with the current and no efficiency
+    # depends on the input voltage
+    if type(self).voltage_at is not Source.voltage_at or type(self).get_current_voltage is not Source.get_current_voltage:
+      return False
+    return all(not isinstance(regulator.efficiency, EfficiencyCurve) or regulator.efficiency.input_voltage_table is None
+               for regulator in self.regulators)
+
+  def solve_current(self, output_currents_ma, cache=None):
+    # Current drawn from the source by its regulators at the given output currents, with every switching
+    # regulator fed at the voltage the source sags to under that whole current. When the source sags linearly
+    # this has a closed form, see _sagged_current_ma. Otherwise it is solved by fixed-point iteration and,
+    # given a cache, kept per output currents and state of charge segment, and taken from the cache as it is
+    # for the rest of that segment. A load the source cannot supply is reported once per cached load.
+    if self._sags_linearly():
+      base_ma = 0.0
+      switching_mW = 0.0
+      for regulator, output_ma in zip(self.regulators, output_currents_ma):
+        base_ma = base_ma + regulator.quiescent_current_ma
+        if regulator.is_switching:
+          switching_mW = switching_mW + (regulator.output_voltage / regulator.efficiency_at(output_ma, None))*output_ma
+        else:
+          base_ma = base_ma + output_ma
+      current_ma, settled = _sagged_current_ma(base_ma, switching_mW, self.get_current_voltage(0.0), self.number_cells*self.internal_resistance_ohm)
+      if not settled:
+        key = tuple(output_currents_ma)
+        if cache is None or key not in cache:
+          print("Error: Source {0} cannot supply its regulators, its voltage does not settle under the load".format(self.name))
+        if cache is not None:
+          cache[key] = current_ma
+      return current_ma
+
     soc = (self.current_charge_mAh / self.capacity_mAh)*100.0
-    cell_voltage = self.cell_voltage_table[-1]
-    for i in range(len(self.soc_table)-1):
-      if (soc >= self.soc_table[i]) and (soc < self.soc_table[i+1]):
-        cell_voltage = self.cell_voltage_table[i] + ((self.cell_voltage_table[i+1]-self.cell_voltage_table[i])/(self.soc_table[i+1]-self.soc_table[i])) * (soc-self.soc_table[i])
-    
-    cell_voltage = cell_voltage - self.internal_resistance_ohm*(total_current_ma*0.001)
+    key = (tuple(output_currents_ma), self.ocv_curve.segment(soc))
+    if cache is not None:
+      solution = cache.get(key)
+      if solution is not None:
+        current_ma, charge_mAh, slope = solution
+        return current_ma + slope*(self.current_charge_mAh - charge_mAh)
+
+    def drawn_ma(charge_mAh, current_ma):
+      voltage = self.voltage_at(charge_mAh, current_ma)
+      return sum(regulator.input_current_ma(output_ma, voltage) for regulator, output_ma in zip(self.regulators, output_currents_ma))
+    charge_mAh = self.current_charge_mAh
+    current_ma = sum(regulator.input_current_ma(output_ma, self.voltage_at(charge_mAh, output_ma))
+                     for regulator, output_ma in zip(self.regulators, output_currents_ma))
+    for iteration in range(SAG_MAX_ITERATIONS):
+      next_current_ma = drawn_ma(charge_mAh, current_ma)
+      settled = abs(next_current_ma - current_ma) <= SAG_RTOL*abs(next_current_ma)
+      current_ma = next_current_ma
+      if settled:
+        break
+    else:
+      print("Error: Source {0} cannot supply its regulators, its voltage does not settle under the load".format(self.name))
+    if cache is not None:
+      # How the solution moves with the charge, from the derivatives of the fixed-point map, so it is carried
+      # along the segment rather than solved again
+      step_ma = SAG_STEP*max(abs(current_ma), 1.0)
+      step_mAh = SAG_STEP*self.capacity_mAh
+      sensitivity = (drawn_ma(charge_mAh, current_ma + step_ma) - drawn_ma(charge_mAh, current_ma))/step_ma
+      slope = (drawn_ma(charge_mAh + step_mAh, current_ma) - drawn_ma(charge_mAh, current_ma))/step_mAh/(1.0 - sensitivity) if settled and sensitivity < 1.0 else 0.0
+      cache[key] = (current_ma, charge_mAh, slope)
+    return current_ma
+
+  def _history_column(self, name):
+    if self.history is None:
+      return np.array([])
+    return self.history.column(name)
+
+  @property
+  def time(self):
+    return self.history.time if self.history is not None else np.array([])
+
+  @property
+  def charge_history_time(self):
+    return self.time
+
+  @property
+  def charge_history_mAh(self):
+    return self._history_column('charge_mAh')
+
+  @property
+  def voltage_history(self):
+    return self._history_column('voltage')
+
+  @property
+  def current_history_ma(self):
+    return self._history_column('current_ma')
+
+  def voltage_at(self, charge_mAh, total_current_ma=0.0):
+    # Both the charge and the current may be scalars or arrays
+    soc = (charge_mAh / self.capacity_mAh)*100.0
+    cell_voltage = self.ocv_curve.cell_voltage(soc) - self.internal_resistance_ohm*(total_current_ma*0.001)
     return self.number_cells * cell_voltage
+
+class LithiumIonBattery(Source):
+
+  soc_table = [0.0, 10.0, 20.0, 30.0, 40.0, 50.0, 60.0, 70.0, 80.0, 90.0, 95.0, 100.0]
+  cell_voltage_table = [2.25, 3.5, 3.65, 3.72, 3.73, 3.75, 3.76, 3.77, 3.78, 3.85, 4.1, 4.25]
+  ocv_curve = OCVCurve(soc_table, cell_voltage_table)
   
 class LithiumCoinCellBattery(Source):
 
   soc_table = [0.0, 5.0, 25.0, 50.0, 95.0, 100.0]
   cell_voltage_table = [2.0, 2.5, 2.7, 2.8, 3.0, 3.2]
-
-  def get_current_voltage(self, total_current_ma=0.0):
-    soc = (self.current_charge_mAh / self.capacity_mAh)*100.0
-    cell_voltage = self.cell_voltage_table[-1]
-    for i in range(len(self.soc_table)-1):
-      if (soc >= self.soc_table[i]) and (soc < self.soc_table[i+1]):
-        cell_voltage = self.cell_voltage_table[i] + ((self.cell_voltage_table[i+1]-self.cell_voltage_table[i])/(self.soc_table[i+1]-self.soc_table[i])) * (soc-self.soc_table[i])
-    
-    cell_voltage = cell_voltage - self.internal_resistance_ohm*(total_current_ma*0.001)
-    return self.number_cells * cell_voltage
+  ocv_curve = OCVCurve(soc_table, cell_voltage_table)
 
 
 ######### Regulators Provide Voltage Rails #########
+# A switching regulator's efficiency is a scalar or an EfficiencyCurve of the output load current, linearly
+# interpolated like OCVCurve and held outside of the table. Given input_voltage_table, efficiency_table has
+# a row per input voltage and is interpolated in the input voltage as well.
+
+class EfficiencyCurve:
+  def __init__(self, load_ma_table, efficiency_table, input_voltage_table=None):
+    self.load_ma_table = np.array(load_ma_table, dtype=float)
+    self.efficiency_table = np.array(efficiency_table, dtype=float)
+    self.input_voltage_table = None if input_voltage_table is None else np.array(input_voltage_table, dtype=float)
+    rows = 1 if self.input_voltage_table is None else len(self.input_voltage_table)
+    if len(self.load_ma_table) < 2 or np.any(np.diff(self.load_ma_table) <= 0.0):
+      raise ValueError("load_ma_table must be strictly increasing, with at least two points")
+    if self.input_voltage_table is not None and (rows < 2 or np.any(np.diff(self.input_voltage_table) <= 0.0)):
+      raise ValueError("input_voltage_table must be strictly increasing, with at least two points")
+    if self.efficiency_table.size != rows*len(self.load_ma_table):
+      raise ValueError("efficiency_table needs a value per load current, in a row per input voltage when input_voltage_table is given")
+    if np.any(self.efficiency_table <= 0.0):
+      raise ValueError("efficiencies must be positive")
+    self._rows = self.efficiency_table.reshape(rows, len(self.load_ma_table))
+    self._load_list = self.load_ma_table.tolist()
+    self._row_lists = self._rows.tolist()
+    self._voltage_list = None if self.input_voltage_table is None else self.input_voltage_table.tolist()
+
+  def _row_efficiency(self, row, load_ma):
+    values = self._row_lists[row]
+    if load_ma <= self._load_list[0]:
+      return values[0]
+    if load_ma >= self._load_list[-1]:
+      return values[-1]
+    i = bisect.bisect_right(self._load_list, load_ma) - 1
+    return values[i] + (values[i+1] - values[i])*(load_ma - self._load_list[i])/(self._load_list[i+1] - self._load_list[i])
+
+  def efficiency(self, load_ma, input_voltage=None):
+    # Both the load current and the input voltage may be scalars or arrays
+    if self._voltage_list is not None and input_voltage is None:
+      raise ValueError("this efficiency curve also depends on the input voltage")
+    if isinstance(load_ma, (float, int)) and (input_voltage is None or isinstance(input_voltage, (float, int))):
+      if self._voltage_list is None:
+        return self._row_efficiency(0, load_ma)
+      voltages = self._voltage_list
+      if input_voltage <= voltages[0]:
+        return self._row_efficiency(0, load_ma)
+      if input_voltage >= voltages[-1]:
+        return self._row_efficiency(len(voltages) - 1, load_ma)
+      j = bisect.bisect_right(voltages, input_voltage) - 1
+      w = (input_voltage - voltages[j])/(voltages[j+1] - voltages[j])
+      return (1.0 - w)*self._row_efficiency(j, load_ma) + w*self._row_efficiency(j + 1, load_ma)
+
+    if self.input_voltage_table is None:
+      return np.interp(load_ma, self.load_ma_table, self._rows[0])
+    load_ma, input_voltage = np.broadcast_arrays(np.asarray(load_ma, dtype=float), np.asarray(input_voltage, dtype=float))
+    rows = np.array([np.interp(load_ma, self.load_ma_table, row) for row in self._rows])
+    j = np.clip(np.searchsorted(self.input_voltage_table, input_voltage, side='right') - 1, 0, len(self.input_voltage_table) - 2)
+    w = np.clip((input_voltage - self.input_voltage_table[j])/(self.input_voltage_table[j+1] - self.input_voltage_table[j]), 0.0, 1.0)
+    lower = np.take_along_axis(rows, j[None, ...], axis=0)[0]
+    upper = np.take_along_axis(rows, (j + 1)[None, ...], axis=0)[0]
+    return (1.0 - w)*lower + w*upper
+
+  def as_dict(self):
+    return {'load_ma_table': self.load_ma_table.tolist(), 'efficiency_table': self._rows.tolist() if self.input_voltage_table is not None else self._rows[0].tolist(),
+            'input_voltage_table': None if self.input_voltage_table is None else self.input_voltage_table.tolist()}
 
 class VoltageRegulator:
   def __init__(self, name, output_voltage, threads, quiescent_current_ma, is_switching, efficiency=70.0, max_current_output_ma=None, dropout_voltage=None):
@@ -141,161 +1192,1698 @@ class VoltageRegulator:
     self.efficiency = efficiency
     self.max_current_output_ma = max_current_output_ma
     self.dropout_voltage = dropout_voltage
-    self.total_regulator_output_current_ma = []
+    self.output_charge_mAh = None
+    self.history = None
+    self.history_column = None
+
+  def reset(self):
+    self.output_charge_mAh = None
+    self.history = None
+    for thread in self.threads:
+      thread.reset()
+
+  def efficiency_at(self, output_current_ma, input_voltage):
+    # Scalars or arrays
+    if isinstance(self.efficiency, EfficiencyCurve):
+      return self.efficiency.efficiency(output_current_ma, input_voltage)
+    return self.efficiency
+
+  def input_current_ma(self, output_current_ma, input_voltage):
+    # Current drawn at input_voltage for an output current, including the quiescent current
+    if self.is_switching:
+      return self.quiescent_current_ma + (self.output_voltage / (input_voltage * self.efficiency_at(output_current_ma, input_voltage)))*output_current_ma
+    return self.quiescent_current_ma + output_current_ma
+
+  @property
+  def total_regulator_output_current_ma(self):
+    if self.history is None:
+      return np.array([])
+    return self.history.column(self.history_column)
+
+######### Event Scheduling #########
+
+# Stage changes are scheduled on an integer clock with this many ticks per second. Ticks are converted to
+# seconds by a float division, the same in Python and in the compiled kernel.
+TICKS_PER_SEC = 1.0e9
+
+######### Compiled Representation #########
+# Before simulating, the Source/Regulator/Thread/Stage tree is flattened into arrays. Sources own a
+# contiguous range of regulators, regulators a contiguous range of threads and threads a contiguous range of
+# stages, each given by a *_start array of length n+1, and every stage has its total current precomputed.
+
+class CompiledSystem:
+  def __init__(self, sources):
+    self.sources = sources
+    self.regulators = [regulator for source in sources for regulator in source.regulators]
+    self.threads = [thread for regulator in self.regulators for thread in regulator.threads]
+
+    self.source_regulator_start = np.cumsum([0] + [len(source.regulators) for source in sources])
+    self.regulator_source = np.repeat(np.arange(len(sources)), [len(source.regulators) for source in sources])
+    self.regulator_thread_start = np.cumsum([0] + [len(regulator.threads) for regulator in self.regulators])
+    self.regulator_quiescent_current_ma = np.array([regulator.quiescent_current_ma for regulator in self.regulators], dtype=float)
+    self.regulator_is_switching = np.array([regulator.is_switching for regulator in self.regulators], dtype=bool)
+    self.regulator_output_voltage = np.array([regulator.output_voltage for regulator in self.regulators], dtype=float)
+    # Regulators with an EfficiencyCurve have it in regulator_efficiency_curve and 1.0 in regulator_efficiency
+    self.regulator_efficiency_curve = [regulator.efficiency if isinstance(regulator.efficiency, EfficiencyCurve) else None
+                                       for regulator in self.regulators]
+    self.regulator_efficiency = np.array([1.0 if curve is not None else regulator.efficiency
+                                          for regulator, curve in zip(self.regulators, self.regulator_efficiency_curve)], dtype=float)
+    self.regulator_max_current_output_ma = np.array([np.inf if regulator.max_current_output_ma is None else regulator.max_current_output_ma
+                                                     for regulator in self.regulators], dtype=float)
+
+    self.thread_regulator = np.repeat(np.arange(len(self.regulators)), [len(regulator.threads) for regulator in self.regulators])
+    self.thread_num_stages = np.array([thread.num_stages for thread in self.threads], dtype=np.int64)
+    self.thread_stage_start = np.cumsum(np.concatenate([[0], self.thread_num_stages]))
+
+    stage_arrays = [thread.stage_arrays() for thread in self.threads]
+    self.stage_delta_t_sec = _concatenate_rows([delta_t_sec for delta_t_sec, current_ma in stage_arrays])
+    self.stage_current_ma = _concatenate_rows([current_ma for delta_t_sec, current_ma in stage_arrays])
+    if len(self.stage_delta_t_sec) <= STAGE_TABLE_MEMORY_ROWS:
+      self.stage_ticks = np.maximum(1, np.round(self.stage_delta_t_sec * TICKS_PER_SEC)).astype(np.int64)
+    else:
+      self.stage_ticks = _scratch_array(len(self.stage_delta_t_sec), np.int64)
+      for start in range(0, len(self.stage_ticks), STAGE_TABLE_MEMORY_ROWS):
+        chunk = self.stage_delta_t_sec[start:start + STAGE_TABLE_MEMORY_ROWS]
+        self.stage_ticks[start:start + len(chunk)] = np.maximum(1, np.round(chunk * TICKS_PER_SEC)).astype(np.int64)
+
+  def thread_stages(self, i):
+    return slice(self.thread_stage_start[i], self.thread_stage_start[i+1])
+
+  def thread_cycle_time_sec(self, i):
+    return float(np.sum(self.stage_delta_t_sec[self.thread_stages(i)]))
+
+######### Stepping Kernel #########
+# The stepping loop of EmbeddedSystem._step_through restated over flat arrays and scalars only, so that Numba
+# compiles it to machine code when it is installed. The kernel returns to Python at the start of an event
+# whenever it needs something only Python can do: the harvest of a solar panel step, room in its history
+# buffers or room in its message log. Python does that part and calls it again to carry on from the same
+# event. Every operation is done in the same order as in the Python loop, so both give identical results.
+# Without Numba the list based Python loop is faster than interpreting the kernel, and is used instead.
+
+STEP_BACKENDS = ('auto', 'python', 'kernel')
+KERNEL_DONE = 0
+KERNEL_HARVEST = 1
+KERNEL_FLUSH = 2
+# Message log kinds, replayed through the hooks by Python
+KERNEL_OVERCURRENT = 0
+KERNEL_EMPTY = 1
+KERNEL_UNSETTLED = 2
+KERNEL_HISTORY_ROWS = 65536
+KERNEL_LOG_ROWS = 4096
+
+def _jit(function):
+  if numba is None:
+    return function
+  return numba.njit(cache=True)(function)
+
+@_jit
+def _kernel_sift_down(heap_ticks, heap_thread, i):
+  # Orders entries by ticks then thread index, as heapq does with (ticks, thread) tuples
+  size = len(heap_ticks)
+  while True:
+    smallest = i
+    for child in (2*i + 1, 2*i + 2):
+      if child < size and (heap_ticks[child] < heap_ticks[smallest] or
+                           (heap_ticks[child] == heap_ticks[smallest] and heap_thread[child] < heap_thread[smallest])):
+        smallest = child
+    if smallest == i:
+      return
+    heap_ticks[i], heap_ticks[smallest] = heap_ticks[smallest], heap_ticks[i]
+    heap_thread[i], heap_thread[smallest] = heap_thread[smallest], heap_thread[i]
+    i = smallest
+
+_kernel_sagged_current_ma = _jit(_sagged_current_ma)
+
+@_jit
+def _kernel_voltage(s, charge_mAh, current_ma, capacity_mAh, number_cells, resistance_ohm, ocv_start, ocv_soc, ocv_voltage, ocv_slope):
+  # Source.voltage_at with OCVCurve.cell_voltage, for one source of the concatenated curves. Each source has
+  # one slope fewer than table points, so its slopes start s entries before its points.
+  soc = (charge_mAh / capacity_mAh[s])*100.0
+  first = ocv_start[s]
+  last = ocv_start[s+1] - 1
+  if soc <= ocv_soc[first]:
+    cell_voltage = ocv_voltage[first]
+  elif soc >= ocv_soc[last]:
+    cell_voltage = ocv_voltage[last]
+  else:
+    i = first
+    while ocv_soc[i+1] <= soc:
+      i = i + 1
+    cell_voltage = ocv_voltage[i] + ocv_slope[i - s]*(soc - ocv_soc[i])
+  cell_voltage = cell_voltage - resistance_ohm[s]*(current_ma*0.001)
+  return number_cells[s] * cell_voltage
+
+@_jit
+def _step_kernel(end_t, stop_at_empty, clock, state, empty,
+                 source_regulator_start, regulator_thread_start, regulator_quiescent_current_ma, regulator_is_switching,
+                 regulator_output_voltage, regulator_efficiency, regulator_max_current_output_ma, thread_regulator,
+                 thread_stage_start, thread_num_stages, stage_current_ma, stage_ticks,
+                 capacity_mAh, number_cells, resistance_ohm, min_input_voltage, ocv_start, ocv_soc, ocv_voltage, ocv_slope, solve_voltage, unsettled,
+                 charge_mAh, net_energy_J, energy_in_J, energy_out_J, charge_out_mAh, peak_current_ma, min_voltage,
+                 source_voltages, source_currents_ma, regulator_output_ma, regulator_output_mAs,
+                 thread_stage_index, thread_last_change_t, thread_current_ma, thread_stage_entered_t, stage_time_sec,
+                 heap_ticks, heap_thread, regulator_changed,
+                 harvest_next_t, harvest_pending, harvest_J, charge_efficiency,
+                 record, history_t, history_values, log_kind, log_index, log_t, log_value, rows):
+  # clock holds the current ticks, state the current time, the system peak current and the time of the next
+  # event when returning for a harvest, empty the empty time, source and reason (1 dropout, 2 empty) and rows
+  # the rows used in the history buffers and the message log
+  num_sources = len(source_regulator_start) - 1
+  num_regulators = len(regulator_output_ma)
+  num_threads = len(heap_ticks)
+  idle_ticks = np.int64(1.0e6 * TICKS_PER_SEC)
+  current_ticks = clock[0]
+  current_t = state[0]
+  history_row = rows[0]
+  log_row = rows[1]
+  # Earliest harvest not handed over yet
+  harvest_t = np.inf
+  for s in range(num_sources):
+    if harvest_pending[s] == 0 and harvest_next_t[s] < harvest_t:
+      harvest_t = harvest_next_t[s]
+  while(current_t < end_t):
+    if num_threads > 0:
+      next_ticks = heap_ticks[0]
+    else:
+      next_ticks = current_ticks + idle_ticks
+    next_t = next_ticks / TICKS_PER_SEC
+    if next_t >= harvest_t:
+      clock[0] = current_ticks
+      state[0] = current_t
+      state[2] = next_t
+      rows[0] = history_row
+      rows[1] = log_row
+      return KERNEL_HARVEST
+    if (record and history_row == history_t.shape[1]) or log_row + num_regulators + 2*num_sources > len(log_kind):
+      clock[0] = current_ticks
+      state[0] = current_t
+      rows[0] = history_row
+      rows[1] = log_row
+      return KERNEL_FLUSH
+    shortest_dt = (next_ticks - current_ticks) / TICKS_PER_SEC
+
+    # Calculate energy use by each thread
+    for s in range(num_sources):
+      total_source_current_ma = 0.0
+      switching_mW = 0.0
+      for r in range(source_regulator_start[s], source_regulator_start[s+1]):
+        total_regulator_output_current_ma = regulator_output_ma[r]
+        regulator_output_mAs[r] = regulator_output_mAs[r] + total_regulator_output_current_ma*shortest_dt
+        if total_regulator_output_current_ma > regulator_max_current_output_ma[r]:
+          log_kind[log_row] = KERNEL_OVERCURRENT
+          log_index[log_row] = r
+          log_t[log_row] = current_t
+          log_value[log_row] = total_regulator_output_current_ma
+          log_row = log_row + 1
+        total_source_current_ma = total_source_current_ma + regulator_quiescent_current_ma[r]
+        if regulator_is_switching[r]:
+          if solve_voltage[s]:
+            switching_mW = switching_mW + (regulator_output_voltage[r] / regulator_efficiency[r])*total_regulator_output_current_ma
+          else:
+            input_voltage = _kernel_voltage(s, charge_mAh[s], total_regulator_output_current_ma, capacity_mAh, number_cells, resistance_ohm,
+                                            ocv_start, ocv_soc, ocv_voltage, ocv_slope)
+            total_source_current_ma = total_source_current_ma + (regulator_output_voltage[r] / (input_voltage * regulator_efficiency[r]))*total_regulator_output_current_ma
+        else:
+          total_source_current_ma = total_source_current_ma + total_regulator_output_current_ma
+      if solve_voltage[s]:
+        open_circuit_voltage = _kernel_voltage(s, charge_mAh[s], 0.0, capacity_mAh, number_cells, resistance_ohm, ocv_start, ocv_soc, ocv_voltage, ocv_slope)
+        total_source_current_ma, settled = _kernel_sagged_current_ma(total_source_current_ma, switching_mW, open_circuit_voltage,
+                                                                     number_cells[s]*resistance_ohm[s])
+        if not settled and unsettled[s] == 0:
+          unsettled[s] = 1
+          log_kind[log_row] = KERNEL_UNSETTLED
+          log_index[log_row] = s
+          log_t[log_row] = current_t
+          log_value[log_row] = total_source_current_ma
+          log_row = log_row + 1
+
+      source_voltage = _kernel_voltage(s, charge_mAh[s], total_source_current_ma, capacity_mAh, number_cells, resistance_ohm,
+                                       ocv_start, ocv_soc, ocv_voltage, ocv_slope)
+      source_voltages[s] = source_voltage
+      source_currents_ma[s] = total_source_current_ma
+      if total_source_current_ma > peak_current_ma[s]:
+        peak_current_ma[s] = total_source_current_ma
+      if source_voltage < min_voltage[s]:
+        min_voltage[s] = source_voltage
+
+      if record:
+        history_t[s, history_row] = current_t
+        history_values[s, history_row, 0] = total_source_current_ma
+        history_values[s, history_row, 1] = source_voltage
+        history_values[s, history_row, 2] = charge_mAh[s]
+        for r in range(source_regulator_start[s], source_regulator_start[s+1]):
+          history_values[s, history_row, 3 + r - source_regulator_start[s]] = regulator_output_ma[r]
+    if record:
+      history_row = history_row + 1
+
+    total_system_current_ma = 0.0
+    for s in range(num_sources):
+      total_system_current_ma = total_system_current_ma + source_currents_ma[s]
+    if total_system_current_ma > state[1]:
+      state[1] = total_system_current_ma
+
+    # Increment time
+    current_ticks = next_ticks
+    current_t = next_t
+
+    for s in range(num_sources):
+      source_voltage = source_voltages[s]
+      total_source_current_ma = source_currents_ma[s]
+      was_charged = charge_mAh[s] > 0.0
+
+      if harvest_pending[s] != 0:
+        harvest_pending[s] = 0
+        if harvest_next_t[s] < harvest_t:
+          harvest_t = harvest_next_t[s]
+        if(charge_mAh[s] < capacity_mAh[s]):
+          J_charged = charge_efficiency[s] * harvest_J[s]
+          energy_in_J[s] = energy_in_J[s] + J_charged
+          net_energy_J[s] = net_energy_J[s] + J_charged
+          charge_mAh[s] = charge_mAh[s] + (0.277778*J_charged/source_voltage)
+
+      J_discharged = shortest_dt * source_voltage * (total_source_current_ma * 0.001)
+      energy_out_J[s] = energy_out_J[s] + J_discharged
+      charge_out_mAh[s] = charge_out_mAh[s] + (0.277778*J_discharged/source_voltage)
+      net_energy_J[s] = net_energy_J[s] - J_discharged
+      charge_mAh[s] = charge_mAh[s] - (0.277778*J_discharged/source_voltage)
+
+      if charge_mAh[s] > capacity_mAh[s]:
+        charge_mAh[s] = capacity_mAh[s]
+
+      if was_charged and charge_mAh[s] <= 0.0:
+        log_kind[log_row] = KERNEL_EMPTY
+        log_index[log_row] = s
+        log_t[log_row] = current_t
+        log_value[log_row] = 0.0
+        log_row = log_row + 1
+
+      if stop_at_empty and empty[1] < 0:
+        if source_voltage < min_input_voltage[s]:
+          empty[0], empty[1], empty[2] = current_t - shortest_dt, s, 1
+        elif charge_mAh[s] <= 0.0:
+          empty[0], empty[1], empty[2] = current_t, s, 2
+
+    if empty[1] >= 0:
+      break
+
+    # Update thread timing and stages, only for the threads that change stage now
+    while num_threads > 0 and heap_ticks[0] == current_ticks:
+      i = heap_thread[0]
+      stage_time_sec[thread_stage_start[i] + thread_stage_index[i]] += current_t - thread_stage_entered_t[i]
+      thread_stage_entered_t[i] = current_t
+      stage_index = thread_stage_index[i] + 1
+      if(stage_index >= thread_num_stages[i]):
+        stage_index = 0 # cyclical
+      thread_stage_index[i] = stage_index
+      thread_last_change_t[i] = current_t
+      thread_current_ma[i] = stage_current_ma[thread_stage_start[i] + stage_index]
+      # The thread goes straight back into the queue in place of the entry just taken
+      heap_ticks[0] = current_ticks + stage_ticks[thread_stage_start[i] + stage_index]
+      _kernel_sift_down(heap_ticks, heap_thread, 0)
+      regulator_changed[thread_regulator[i]] = True
+
+    for r in range(num_regulators):
+      if regulator_changed[r]:
+        regulator_changed[r] = False
+        total_regulator_output_current_ma = 0.0
+        for i in range(regulator_thread_start[r], regulator_thread_start[r+1]):
+          total_regulator_output_current_ma = total_regulator_output_current_ma + thread_current_ma[i]
+        regulator_output_ma[r] = total_regulator_output_current_ma
+
+  clock[0] = current_ticks
+  state[0] = current_t
+  rows[0] = history_row
+  rows[1] = log_row
+  return KERNEL_DONE
+
+def _kernel_unsupported(sources, hooks, instrument):
+  # Why the kernel cannot step these sources, or None when it can
+  if instrument:
+    return "instrumentation times the parts of the Python loop"
+  if hooks.has_callbacks():
+    return "callbacks are called from the Python loop"
+  for source in sources:
+    if (type(source).voltage_at is not Source.voltage_at or type(source).get_current_voltage is not Source.get_current_voltage or
+        type(source.ocv_curve) is not OCVCurve):
+      return "source {0} has its own voltage model".format(source.name)
+    for regulator in source.regulators:
+      if isinstance(regulator.efficiency, EfficiencyCurve):
+        return "regulator {0} has an efficiency curve".format(regulator.name)
+  return None
+
+######### Hyperperiod Lifetime Engine #########
+# Without energy harvesting every thread is strictly periodic, so the whole run is one repeating pattern
+# with a period equal to the least common multiple of the thread cycle times. That hyperperiod is simulated
+# exactly once and the charge depletion is then extrapolated cycle by cycle, only re-evaluating the load
+# a few times within each soc_table voltage segment.
+
+# Cycle times are matched as rationals to within 1/HYPERPERIOD_MAX_DENOMINATOR seconds
+HYPERPERIOD_MAX_DENOMINATOR = 1000000
+# Above this many stage changes per hyperperiod the stepping simulation is used instead
+HYPERPERIOD_MAX_EVENTS = 2000000
+# Each voltage segment is crossed in at least this many stretches, since in steep segments the current drawn
+# by switching regulators changes along the segment
+HYPERPERIOD_SEGMENT_STRETCHES = 32
+
+def hyperperiod_sec(threads, max_denominator=HYPERPERIOD_MAX_DENOMINATOR):
+  period = None
+  for thread in threads:
+    cycle = Fraction(thread.cycle_time_sec()).limit_denominator(max_denominator)
+    if period is None:
+      period = cycle
+    else:
+      # lcm(a/b, c/d) = lcm(a, c) / gcd(b, d) for reduced fractions
+      period = Fraction(math.lcm(period.numerator, cycle.numerator), math.gcd(period.denominator, cycle.denominator))
+  if period is None:
+    return None
+  return float(period)
+
+def _hyperperiod_schedule(compiled, period_sec):
+  # Builds the exact load over one hyperperiod as interval durations and the output current of each regulator
+  num_events = 0
+  boundaries = [np.array([0.0, period_sec])]
+  for i in range(len(compiled.threads)):
+    cycle_time_sec = compiled.thread_cycle_time_sec(i)
+    num_cycles = int(round(period_sec / cycle_time_sec))
+    num_events = num_events + num_cycles*int(compiled.thread_num_stages[i])
+    if num_events > HYPERPERIOD_MAX_EVENTS:
+      return None
+    stage_starts = np.cumsum(compiled.stage_delta_t_sec[compiled.thread_stages(i)]) - compiled.stage_delta_t_sec[compiled.thread_stages(i)]
+    boundaries.append((np.arange(num_cycles)[:, None]*cycle_time_sec + stage_starts[None, :]).ravel())
+
+  # Rounding merges stage changes that coincide up to floating point error
+  t = np.unique(np.round(np.concatenate(boundaries), 9))
+  t = t[t <= period_sec]
+  durations = np.diff(t)
+  midpoints = t[:-1] + 0.5*durations
+
+  currents = np.zeros((len(durations), len(compiled.regulators)))
+  for i in range(len(compiled.threads)):
+    stage_ends = np.cumsum(compiled.stage_delta_t_sec[compiled.thread_stages(i)])
+    stage_currents = compiled.stage_current_ma[compiled.thread_stages(i)]
+    stage_index = np.searchsorted(stage_ends, np.mod(midpoints, compiled.thread_cycle_time_sec(i)), side='right')
+    r = compiled.thread_regulator[i]
+    currents[:, r] = currents[:, r] + stage_currents[np.minimum(stage_index, compiled.thread_num_stages[i]-1)]
+  return t[:-1], durations, currents
+
+def _cycle_drain(compiled, s, durations, currents, charge_mAh):
+  # Current drawn from source s for each load interval, holding its state of charge fixed over the intervals
+  source = compiled.sources[s]
+  source_current_ma = np.zeros(len(durations))
+  for column, r in enumerate(range(compiled.source_regulator_start[s], compiled.source_regulator_start[s+1])):
+    output_current_ma = currents[:, column]
+    source_current_ma = source_current_ma + compiled.regulator_quiescent_current_ma[r]
+    if compiled.regulator_is_switching[r]:
+      input_voltage = source.voltage_at(charge_mAh, output_current_ma)
+      efficiency = compiled.regulator_efficiency[r] if compiled.regulator_efficiency_curve[r] is None else \
+                   compiled.regulator_efficiency_curve[r].efficiency(output_current_ma, input_voltage)
+      source_current_ma = source_current_ma + (compiled.regulator_output_voltage[r] / (input_voltage * efficiency))*output_current_ma
+    else:
+      source_current_ma = source_current_ma + output_current_ma
+  if source.solve_voltage:
+    # Every interval solved as Source.solve_current does, from the estimate above
+    for iteration in range(SAG_MAX_ITERATIONS):
+      source_voltage = source.voltage_at(charge_mAh, source_current_ma)
+      next_current_ma = sum(compiled.regulators[r].input_current_ma(currents[:, column], source_voltage)
+                            for column, r in enumerate(range(compiled.source_regulator_start[s], compiled.source_regulator_start[s+1])))
+      converged = np.all(np.abs(next_current_ma - source_current_ma) <= SAG_RTOL*np.abs(next_current_ma))
+      source_current_ma = next_current_ma
+      if converged:
+        break
+  source_voltage = source.voltage_at(charge_mAh, source_current_ma)
+
+  charge_mAh = float(0.277778*0.001*np.sum(durations*source_current_ma))
+  energy_J = float(0.001*np.sum(durations*source_voltage*source_current_ma))
+  return charge_mAh, energy_J, source_voltage, source_current_ma
+
+def _rotate_schedule(period_sec, start_t, durations, currents, phase_sec):
+  # The same repeating schedule seen from phase_sec into the hyperperiod, with the interval it falls in split
+  if phase_sec <= 0.0:
+    return start_t, durations, currents
+  end_t = start_t + durations
+  i = min(int(np.searchsorted(end_t, phase_sec, side='right')), len(durations) - 1)
+  rotated_start_t = np.concatenate([[0.0], start_t[i+1:] - phase_sec, start_t[:i+1] + (period_sec - phase_sec)])
+  rotated_durations = np.concatenate([[end_t[i] - phase_sec], durations[i+1:], durations[:i], [phase_sec - start_t[i]]])
+  rotated_currents = np.concatenate([currents[i:], currents[:i+1]])
+  keep = rotated_durations > 0.0
+  return rotated_start_t[keep], rotated_durations[keep], rotated_currents[keep]
+
+def _cycle_combos(durations, currents):
+  # Identical load combinations only need to be evaluated once per cycle
+  combos, inverse = np.unique(currents, axis=0, return_inverse=True)
+  return combos, np.bincount(inverse.reshape(-1), weights=durations, minlength=len(combos))
+
+def _hyperperiod_stretch(compiled, s, combo_durations, combos, charge_mAh, max_cycles):
+  # Number of cycles the load of source s is extrapolated over from charge_mAh, with the charge and energy
+  # drawn per cycle over that stretch
+  source = compiled.sources[s]
+  charge_bounds_mAh = source.ocv_curve.soc_table*source.capacity_mAh/100.0
+  segment_span_mAh = np.diff(charge_bounds_mAh)
+  cycle_charge_mAh = _cycle_drain(compiled, s, combo_durations, combos, charge_mAh)[0]
+  cycles = max_cycles
+  segment = np.searchsorted(charge_bounds_mAh, charge_mAh, side='right') - 1
+  if cycle_charge_mAh > 0.0 and segment >= 0:
+    # Run until the charge crosses into the next segment down, or a fraction of the segment is used
+    stretch_mAh = min(charge_mAh - charge_bounds_mAh[segment], segment_span_mAh[min(segment, len(segment_span_mAh)-1)]/HYPERPERIOD_SEGMENT_STRETCHES)
+    cycles = min(cycles, int(stretch_mAh // cycle_charge_mAh) + 1)
+  # Evaluating the load halfway through the stretch follows the voltage curve within the segment
+  cycle_charge_mAh, cycle_energy_J = _cycle_drain(compiled, s, combo_durations, combos, charge_mAh - 0.5*cycles*cycle_charge_mAh)[:2]
+  return cycles, cycle_charge_mAh, cycle_energy_J
+
+def _hyperperiod_failure(compiled, s, period_sec, durations, currents, sim_time_sec, min_input_voltage):
+  # First time source s is empty or its voltage under load falls below min_input_voltage along with which
+  # of the two happened, or None if neither does within the run. Follows the same stretches as the
+  # extrapolation and interpolates within the one where it happens.
+  source = compiled.sources[s]
+  columns = slice(compiled.source_regulator_start[s], compiled.source_regulator_start[s+1])
+  combos, combo_durations = _cycle_combos(durations, currents[:, columns])
+  charge_mAh = source.current_charge_mAh
+  if charge_mAh <= 0.0:
+    return 0.0, 'empty'
+  if np.min(_cycle_drain(compiled, s, combo_durations, combos, charge_mAh)[2]) < min_input_voltage:
+    return 0.0, 'dropout'
+
+  num_cycles = int(math.ceil(sim_time_sec / period_sec))
+  cycles_done = 0
+  while cycles_done < num_cycles:
+    cycles, cycle_charge_mAh = _hyperperiod_stretch(compiled, s, combo_durations, combos, charge_mAh, num_cycles - cycles_done)[:2]
+    end_charge_mAh = charge_mAh - cycles*cycle_charge_mAh
+    fraction = None
+    if end_charge_mAh <= 0.0:
+      fraction = charge_mAh/(charge_mAh - end_charge_mAh)
+      reason = 'empty'
+    end_voltage = np.min(_cycle_drain(compiled, s, combo_durations, combos, end_charge_mAh)[2])
+    if end_voltage < min_input_voltage:
+      start_voltage = np.min(_cycle_drain(compiled, s, combo_durations, combos, charge_mAh)[2])
+      voltage_fraction = (start_voltage - min_input_voltage)/(start_voltage - end_voltage)
+      if fraction is None or voltage_fraction < fraction:
+        fraction = voltage_fraction
+        reason = 'dropout'
+    if fraction is not None:
+      failure_t = (cycles_done + fraction*cycles)*period_sec
+      return (failure_t, reason) if failure_t < sim_time_sec else None
+    charge_mAh = end_charge_mAh
+    cycles_done = cycles_done + cycles
+  return None
+
+######### Monte Carlo #########
+# The load timeline does not depend on the weather, so it is scheduled once and reduced to per step sums.
+# Every cloud realization is then advanced through the steps together, with the state of charge and cloud
+# random walk held as arrays over realizations.
+
+MONTE_CARLO_BLOCK_EVENTS = 4096
+
+def _load_event_blocks(compiled, sim_time_sec, block_events=MONTE_CARLO_BLOCK_EVENTS):
+  # Same stage change schedule as a fresh run of the stepping loop, with every thread entering its first stage
+  # at zero, whatever stage an earlier run left it in. Yields the event times, the time step ending at each
+  # event and the regulator output currents held over that step.
+  stage_current_ma = _stage_reader(compiled.stage_current_ma)
+  stage_ticks = _stage_reader(compiled.stage_ticks)
+  thread_stage_start = compiled.thread_stage_start.tolist()
+  thread_num_stages = compiled.thread_num_stages.tolist()
+  thread_regulator = compiled.thread_regulator.tolist()
+  regulator_thread_start = compiled.regulator_thread_start.tolist()
+  num_regulators = len(compiled.regulators)
+  thread_stage_index = [0]*len(compiled.threads)
+  thread_current_ma = [stage_current_ma[thread_stage_start[i]] for i in range(len(compiled.threads))]
+  regulator_output_ma = [sum(thread_current_ma[regulator_thread_start[r]:regulator_thread_start[r+1]]) for r in range(num_regulators)]
+
+  queue = [(stage_ticks[thread_stage_start[i]], i) for i in range(len(compiled.threads))]
+  heapq.heapify(queue)
+  idle_ticks = int(1.0e6 * TICKS_PER_SEC)
+
+  times = []
+  steps = []
+  currents = []
+  current_ticks = 0
+  current_t = 0.0
+  while current_t < sim_time_sec:
+    next_ticks = queue[0][0] if len(queue) > 0 else current_ticks + idle_ticks
+    steps.append((next_ticks - current_ticks) / TICKS_PER_SEC)
+    currents.append(list(regulator_output_ma))
+    current_ticks = next_ticks
+    current_t = current_ticks / TICKS_PER_SEC
+    times.append(current_t)
+
+    changed_regulators = set()
+    while len(queue) > 0 and queue[0][0] == current_ticks:
+      i = heapq.heappop(queue)[1]
+      stage_index = thread_stage_index[i] + 1
+      if stage_index >= thread_num_stages[i]:
+        stage_index = 0
+      thread_stage_index[i] = stage_index
+      thread_current_ma[i] = stage_current_ma[thread_stage_start[i] + stage_index]
+      heapq.heappush(queue, (current_ticks + stage_ticks[thread_stage_start[i] + stage_index], i))
+      changed_regulators.add(thread_regulator[i])
+    for r in changed_regulators:
+      regulator_output_ma[r] = sum(thread_current_ma[regulator_thread_start[r]:regulator_thread_start[r+1]])
+
+    if len(times) == block_events:
+      yield times, steps, currents
+      times, steps, currents = [], [], []
+  if len(times) > 0:
+    yield times, steps, currents
+
+######### Profiling Hooks #########
+# The stepping loop reports notable moments of a run through a ProfileHooks object. Without callbacks the
+# defaults print the same errors as always. Stage change and state of charge callbacks are only checked for
+# when given, so a run without them does no extra work per event.
+
+class ProfileHooks:
+  def __init__(self, on_stage_change=None, on_soc_below=None, soc_thresholds_pct=(), on_regulator_overcurrent=None, on_source_empty=None):
+    # on_stage_change(system, t, thread, stage_index) after a thread enters a stage
+    # on_soc_below(system, t, source, threshold_pct) when a source falls below one of soc_thresholds_pct,
+    #   again after it has recovered above that threshold
+    # on_regulator_overcurrent(system, t, regulator, current_ma) for every step the regulator is over its maximum
+    # on_source_empty(system, t, source) when a source runs out of charge
+    if on_soc_below is None and len(soc_thresholds_pct) > 0:
+      raise ValueError("soc_thresholds_pct needs an on_soc_below callback")
+    self.on_stage_change = on_stage_change
+    self.on_soc_below = on_soc_below
+    self.soc_thresholds_pct = sorted(soc_thresholds_pct, reverse=True)
+    self.on_regulator_overcurrent = on_regulator_overcurrent
+    self.on_source_empty = on_source_empty
+
+  def has_callbacks(self):
+    return any(callback is not None for callback in (self.on_stage_change, self.on_soc_below, self.on_regulator_overcurrent, self.on_source_empty))
+
+  def needs_stepping(self):
+    return self.on_stage_change is not None or len(self.soc_thresholds_pct) > 0
+
+  def regulator_overcurrent(self, system, t, regulator, current_ma):
+    if self.on_regulator_overcurrent is None:
+      print("Error: Regulator {0} cannot provide enough current, at t={1}".format(regulator.name, t))
+    else:
+      self.on_regulator_overcurrent(system, t, regulator, current_ma)
+
+  def source_empty(self, system, t, source):
+    if self.on_source_empty is None:
+      print("Error: Source {0} has reached an empty state of charge, at t={1}".format(source.name, t))
+    else:
+      self.on_source_empty(system, t, source)
+
+######### Independent Sources #########
+# Sources share nothing but the clock, so each one can be stepped through its own timeline, including in a
+# worker process, see EmbeddedSystem._split_profile.
+
+def _run_source_timeline(system, sim_time_sec, start_t, record_time_history, instrument, backend='auto'):
+  system.sim_time_sec = sim_time_sec
+  system._step_through(system.sources, start_t, record_time_history, False, ProfileHooks(), instrument, time.perf_counter(), backend)
+  return system
+
+def _copy_run_state(source, other):
+  # Copies the run state of a source that was run elsewhere into the matching objects of this one
+  source.__dict__.update({name: value for name, value in other.__dict__.items() if name not in ('regulators', 'energy_harvesting')})
+  if source.energy_harvesting is not None:
+    source.energy_harvesting.__dict__.update(other.energy_harvesting.__dict__)
+  for regulator, other_regulator in zip(source.regulators, other.regulators):
+    regulator.__dict__.update({name: value for name, value in other_regulator.__dict__.items() if name != 'threads'})
+    for thread, other_thread in zip(regulator.threads, other_regulator.threads):
+      thread.__dict__.update({name: value for name, value in other_thread.__dict__.items() if name != 'stages'})
+
+######### Event Streams #########
+# EmbeddedSystem.iter_events yields one Event per step of the stepping loop, and iter_event_blocks the same
+# events EVENT_BLOCK_SIZE at a time as arrays.
+
+Event = collections.namedtuple('Event', ['t', 'dt', 'current_ma', 'voltage', 'charge_mAh', 'stage'])
+EVENT_BLOCK_SIZE = 4096
+
+def _event_block_arrays(block, num_events, num_sources, num_threads):
+  # The first num_events rows of the lists the stepping loop writes events into, in the order of the fields of
+  # Event, as the arrays iter_event_blocks yields
+  t, dt, current_ma, voltage, charge_mAh, stage = block
+  return {
+    't': np.array(t[:num_events]),
+    'dt': np.array(dt[:num_events]),
+    'current_ma': np.array(current_ma[:num_events*num_sources]).reshape(num_events, num_sources),
+    'voltage': np.array(voltage[:num_events*num_sources]).reshape(num_events, num_sources),
+    'charge_mAh': np.array(charge_mAh[:num_events*num_sources]).reshape(num_events, num_sources),
+    'stage': np.array(stage[:num_events*num_threads], dtype=np.int64).reshape(num_events, num_threads),
+  }
 
 ######### Embedded System is Highest Level #########
 # Embedded system class has sources, which have regulators, which have threads, which have components
 # In this way, even systems with multiple batteries, multiple power rails, and lots of components turning
 # on and off can be analyzed easily
 
+# Bumped whenever the contents of EmbeddedSystem.snapshot() change
+SNAPSHOT_VERSION = 1
+CSV_CHUNK_ROWS = 65536
+PLOT_CHUNK_ROWS = 1048576
+
 class EmbeddedSystem:
   def __init__(self, name, sources):
     self.name = name
     self.sources = sources
-    self.time = []
-    self.system_power_mW = []
-    self.system_current_mA = []
     self.sim_time_sec = None
+    self.current_t = 0.0
+    self.peak_current_mA = 0.0
+    self.empty_t = None
+    self.empty_source = None
+    self.empty_reason = None
+    self.instrumentation = None
+    self._source_end_t = None
+    self._system_history_cache = None
 
-  def power_profile(self, sim_time_sec, record_time_history=False):
-    self.sim_time_sec=sim_time_sec
+  def reset(self):
+    # Returns all run state (thread stages, source charge, harvesting random walk and histories) to the start
+    self.sim_time_sec = None
+    self.current_t = 0.0
+    self.peak_current_mA = 0.0
+    self.empty_t = None
+    self.empty_source = None
+    self.empty_reason = None
+    self.instrumentation = None
+    self._source_end_t = None
     for source in self.sources:
-      source.net_energy_J = 0.0
-    current_t = 0.0
+      source.reset()
 
-    while(current_t < sim_time_sec):
-      
-      # Determine increment
-      shortest_dt = 1.0e6
+  def compile(self):
+    return CompiledSystem(self.sources)
+
+  def _structure(self):
+    return [[[thread.num_stages for thread in reg.threads] for reg in source.regulators] for source in self.sources]
+
+  def snapshot(self):
+    # Complete run state as compressed bytes, including the cloud generators and the global np.random state
+    # used by panels without a seed. Histories are not included.
+    state = {
+      'version': SNAPSHOT_VERSION,
+      'structure': self._structure(),
+      'system': (self.sim_time_sec, self.current_t, self.peak_current_mA, self.empty_t, self.empty_source, self.empty_reason),
+      'np_random': np.random.get_state(),
+      'sources': [],
+    }
+    for source in self.sources:
+      panel = source.energy_harvesting
+      state['sources'].append({
+        'charge': (source.current_charge_mAh, source.net_energy_J, source.energy_in_J, source.energy_out_J, source.charge_out_mAh,
+                   source.peak_current_ma, source.min_voltage),
+        'panel': None if panel is None else (panel.random_walk_val, panel.last_time_s, panel.step_start_t, panel.next_step_t,
+                                             panel.integrated_until_t, panel.rng.bit_generator.state if panel.rng is not None else None),
+        'regulators': [reg.output_charge_mAh for reg in source.regulators],
+        'threads': [[(thread.stage_index, thread.last_stage_change_t, thread.next_stage_change_t,
+                      list(thread.stage_time_sec) if isinstance(thread.stage_time_sec, list) else np.array(thread.stage_time_sec))
+                     for thread in reg.threads] for reg in source.regulators],
+      })
+    return zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+
+  def restore(self, snapshot):
+    # Puts the system back into the state of a snapshot taken from it or an identically structured system,
+    # after which power_profile(..., extend=True) continues from that point. Histories are dropped, and the
+    # global np.random state is left alone unless a panel without a seed draws from it.
+    state = pickle.loads(zlib.decompress(snapshot))
+    if state['version'] != SNAPSHOT_VERSION:
+      raise ValueError("Snapshot version {0} is not supported".format(state['version']))
+    if state['structure'] != self._structure():
+      raise ValueError("Snapshot was taken from a system with different sources, regulators, threads or stages")
+    self.sim_time_sec, self.current_t, self.peak_current_mA, self.empty_t, self.empty_source, self.empty_reason = state['system']
+    self._source_end_t = None
+    # The global np.random state is only the system's own when one of its panels has no seed
+    if any(source.energy_harvesting is not None and source.energy_harvesting.seed is None for source in self.sources):
+      np.random.set_state(state['np_random'])
+    for source, source_state in zip(self.sources, state['sources']):
+      (source.current_charge_mAh, source.net_energy_J, source.energy_in_J, source.energy_out_J, source.charge_out_mAh,
+       source.peak_current_ma, source.min_voltage) = source_state['charge']
+      panel = source.energy_harvesting
+      if panel is not None:
+        panel.random_walk_val, panel.last_time_s, panel.step_start_t, panel.next_step_t, panel.integrated_until_t, rng_state = source_state['panel']
+        if rng_state is not None:
+          panel.rng = np.random.default_rng()
+          panel.rng.bit_generator.state = rng_state
+        panel.history = None
+      source.history = None
+      for reg, output_charge_mAh, thread_states in zip(source.regulators, source_state['regulators'], source_state['threads']):
+        reg.output_charge_mAh = output_charge_mAh
+        reg.history = None
+        for thread, thread_state in zip(reg.threads, thread_states):
+          # In the order snapshot stores them
+          stage_index, last_stage_change_t, next_stage_change_t, stage_time_sec = thread_state
+          thread.stage_index = stage_index
+          thread.last_stage_change_t = last_stage_change_t
+          thread.next_stage_change_t = next_stage_change_t
+          thread.stage_time_sec = _stage_time_rows(stage_time_sec)
+
+  def _start_history(self, policy):
+    # Every source records its own current, voltage, charge and regulator output currents, and its panel its
+    # power and cloud random walk. Without a policy nothing is recorded, so memory stays flat over any run.
+    self._system_history_cache = None
+    for s, source in enumerate(self.sources):
+      columns = ['current_ma', 'voltage', 'charge_mAh'] + ['regulator_{0}_current_ma'.format(r) for r in range(len(source.regulators))]
+      harvesting_columns = ['power_W', 'random_walk']
+      if policy is not None:
+        self._attach_history(source, policy.create(columns, "source_{0}".format(s)),
+                             policy.create(harvesting_columns, "source_{0}_harvesting".format(s)) if source.energy_harvesting is not None else None)
+      else:
+        self._attach_history(source, None, None)
+
+  def _attach_history(self, source, history, harvesting_history):
+    source.history = history
+    for r, regulator in enumerate(source.regulators):
+      regulator.history = history
+      regulator.history_column = 'regulator_{0}_current_ma'.format(r)
+    if source.energy_harvesting is not None:
+      source.energy_harvesting.history = harvesting_history
+
+  def _histories(self):
+    # Recorded histories under the names _start_history gives them
+    histories = {}
+    for source in self.sources:
+      if source.history is not None:
+        histories[source.history.name] = source.history
+        if source.energy_harvesting is not None and source.energy_harvesting.history is not None:
+          histories[source.energy_harvesting.history.name] = source.energy_harvesting.history
+    return histories
+
+  def load_history(self, directory):
+    # Attaches the memory-mapped histories of a run streamed to a HistorySink, for plotting and summaries
+    histories = load_history(directory)
+    for s, source in enumerate(self.sources):
+      self._attach_history(source, histories.get("source_{0}".format(s)), histories.get("source_{0}_harvesting".format(s)))
+      for regulator in source.regulators:
+        if regulator.history is not None:
+          regulator.output_charge_mAh = regulator.history.integral(regulator.history_column)/3600.0
+    if self.sim_time_sec is None:
+      self.sim_time_sec = max(history.end_t for history in histories.values())
+
+  def _close_history(self, end_t, sources=None):
+    for source in (self.sources if sources is None else sources):
+      if source.history is not None:
+        source.history.close(end_t)
+      if source.energy_harvesting is not None and source.energy_harvesting.history is not None:
+        source.energy_harvesting.history.close(end_t)
+
+  def _system_history(self):
+    # System totals are the sum over sources, which may have been recorded at different times. They are kept
+    # until a source's history is replaced, records another event or is closed.
+    recorded = [source for source in self.sources if source.history is not None]
+    key = [(source.history, source.history.num_events, source.history.end_t) for source in recorded]
+    if self._system_history_cache is not None:
+      cached_key, totals = self._system_history_cache
+      if len(cached_key) == len(key) and all(a[0] is b[0] and a[1:] == b[1:] for a, b in zip(cached_key, key)):
+        return totals
+    if len(recorded) == 0:
+      totals = np.array([]), np.array([]), np.array([])
+    else:
+      current_t, current_mA = _sum_step_series([(source.time, source.current_history_ma) for source in recorded])
+      power_t, power_mW = _sum_step_series([(source.time, source.current_history_ma*source.voltage_history) for source in recorded])
+      totals = current_t, current_mA, power_mW
+    self._system_history_cache = (key, totals)
+    return totals
+
+  @property
+  def time(self):
+    return self._system_history()[0]
+
+  @property
+  def system_current_mA(self):
+    return self._system_history()[1]
+
+  @property
+  def system_power_mW(self):
+    return self._system_history()[2]
+
+  def power_profile(self, sim_time_sec, record_time_history=False, use_hyperperiod=False, history=None, stop_at_empty=False, extend=False,
+                    hooks=None, instrument=False, split_sources=False, processes=1, backend='auto'):
+    # history is a HistoryPolicy that sets the dtype and decimation of the recorded series, or a HistorySink
+    # to stream them to disk while the run progresses. With stop_at_empty the run ends early once a source is
+    # empty or falls below a regulator's dropout voltage, see empty_t, empty_source and empty_reason.
+    # Time starts over at zero with every thread in its first stage and the statistics cleared, while the
+    # sources keep their charge. With extend the previous run instead continues for sim_time_sec more
+    # seconds, appending to its statistics and, when recording, to its histories.
+    # hooks is a ProfileHooks receiving stage changes, state of charge thresholds and errors. With instrument
+    # the stepping loop counts its events and times its parts into instrumentation, see print_instrumentation.
+    # With split_sources every source steps through only its own stage changes, one after another in this
+    # process, or in up to processes worker processes when processes is more than 1 or None for one per CPU,
+    # see _split_profile.
+    # backend 'auto' steps through time in the compiled kernel when Numba is installed and the run needs
+    # nothing from the Python loop, 'python' always uses the Python loop and 'kernel' uses the kernel even
+    # without Numba, see _step_kernel. Both give identical results.
+    if backend not in STEP_BACKENDS:
+      raise ValueError("backend must be one of {0}".format(", ".join(STEP_BACKENDS)))
+    run_start_sec = time.perf_counter()
+    source_start_t = self._source_end_t if extend and self._source_end_t is not None else None
+    if hooks is None:
+      hooks = ProfileHooks()
+    if history is None and record_time_history:
+      history = HistoryPolicy()
+    record_time_history = history is not None
+    start_t = self._start_run(sim_time_sec, history, extend)
+
+    if use_hyperperiod:
+      if any(source.energy_harvesting is not None for source in self.sources):
+        print("Note: hyperperiod mode requires a system without energy harvesting, stepping through time instead")
+      elif hooks.needs_stepping():
+        print("Note: hyperperiod mode cannot report stage changes or state of charge thresholds, stepping through time instead")
+      elif self._hyperperiod_profile(self.sim_time_sec - start_t, record_time_history, stop_at_empty, start_t, hooks):
+        self._close_history(self.sim_time_sec)
+        if instrument:
+          self.instrumentation = {'engine': 'hyperperiod', 'wall_sec': time.perf_counter() - run_start_sec,
+                                  'history_bytes': self._history_nbytes()}
+        return
+      else:
+        print("Note: hyperperiod has more than {0} stage changes, stepping through time instead".format(HYPERPERIOD_MAX_EVENTS))
+
+    if split_sources and len(self.sources) > 1:
+      if stop_at_empty:
+        print("Note: stop_at_empty needs a shared timeline, stepping all sources together instead")
+      else:
+        if processes != 1 and (hooks.has_callbacks() or isinstance(history, HistorySink)):
+          print("Note: callbacks and histories streamed to disk stay in this process, stepping sources one after another instead")
+          processes = 1
+        self._split_profile(source_start_t if source_start_t is not None else [start_t]*len(self.sources), record_time_history,
+                            hooks, instrument, processes, run_start_sec, backend)
+        return
+    self._step_through(self.sources, start_t, record_time_history, stop_at_empty, hooks, instrument, run_start_sec, backend)
+
+  def _start_run(self, sim_time_sec, history, extend):
+    # Sets up a run of sim_time_sec from the start or, with extend, from where the last run ended, and
+    # returns its start time
+    self._source_end_t = None
+    self.instrumentation = None
+    start_t = self.current_t if extend else 0.0
+    self.sim_time_sec = start_t + sim_time_sec
+    self.empty_t = None
+    self.empty_source = None
+    self.empty_reason = None
+    if not (extend and history is not None and all(source.history is not None for source in self.sources)):
+      self._start_history(history)
+    if not extend:
+      self.peak_current_mA = 0.0
       for source in self.sources:
+        source.reset_statistics()
+        if source.energy_harvesting is not None:
+          source.energy_harvesting.restart()
         for regulator in source.regulators:
+          regulator.output_charge_mAh = 0.0
           for thread in regulator.threads:
-            dt = thread.next_stage_change_t - current_t
-            if dt < shortest_dt:
-              shortest_dt = dt 
+            thread.reset()
+    return start_t
+
+  def iter_events(self, sim_time_sec, history=None, stop_at_empty=False, extend=False, hooks=None):
+    # Runs like power_profile, yielding an Event for every step of the stepping loop as it is taken: its start
+    # time t, its length dt, the current_ma, voltage and charge_mAh at its start of every source and the stage
+    # of every thread over it, in the order of the sources and their regulators' threads. Nothing is recorded
+    # unless history is given. The run only starts when the first event is asked for. When the consumer stops
+    # early, the system is left as a run ending after the last event taken, so extend carries on from there.
+    if hooks is None:
+      hooks = ProfileHooks()
+    start_t = self._start_run(sim_time_sec, history, extend)
+    yield from self._step_events(self.sources, start_t, history is not None, stop_at_empty, hooks, False, time.perf_counter(), True)
+
+  def iter_event_blocks(self, sim_time_sec, block_events=EVENT_BLOCK_SIZE, history=None, stop_at_empty=False, extend=False, hooks=None):
+    # Same as iter_events with up to block_events events at a time, as a dict of arrays with one row per event:
+    # t and dt, current_ma, voltage and charge_mAh with a column per source and stage with a column per thread.
+    # The stepping loop writes the events straight into buffers of block_events rows.
+    if block_events < 1:
+      raise ValueError("block_events must be at least 1")
+    if hooks is None:
+      hooks = ProfileHooks()
+    start_t = self._start_run(sim_time_sec, history, extend)
+    yield from self._step_events(self.sources, start_t, history is not None, stop_at_empty, hooks, False, time.perf_counter(), False, block_events)
+
+  def _step_through(self, sources, start_t, record_time_history, stop_at_empty, hooks, instrument, run_start_sec, backend='auto'):
+    # Steps the given sources together from start_t to sim_time_sec, on the merged timeline of their threads
+    if backend != 'python':
+      reason = _kernel_unsupported(sources, hooks, instrument)
+      if reason is None and (backend == 'kernel' or numba is not None):
+        self._kernel_step_through(sources, start_t, record_time_history, stop_at_empty, hooks)
+        return
+      if reason is not None and backend == 'kernel':
+        print("Note: the stepping kernel cannot be used since {0}, stepping in Python instead".format(reason))
+    for event in self._step_events(sources, start_t, record_time_history, stop_at_empty, hooks, instrument, run_start_sec, False):
+      pass
+
+  def _step_events(self, sources, start_t, record_time_history, stop_at_empty, hooks, instrument, run_start_sec, emit, block_events=None):
+    # The stepping loop, yielding an Event after every step when emit is set, the events of every block_events
+    # steps as arrays when that is given, and otherwise running to the end without yielding. It works on the
+    # compiled arrays, read through plain lists since indexing a list is much cheaper than indexing a NumPy
+    # array one element at a time.
+    compiled = CompiledSystem(sources)
+    sources = compiled.sources
+    source_regulator_start = compiled.source_regulator_start.tolist()
+    regulator_thread_start = compiled.regulator_thread_start.tolist()
+    regulator_quiescent_current_ma = compiled.regulator_quiescent_current_ma.tolist()
+    regulator_is_switching = compiled.regulator_is_switching.tolist()
+    regulator_output_voltage = compiled.regulator_output_voltage.tolist()
+    regulator_efficiency = compiled.regulator_efficiency.tolist()
+    regulator_efficiency_curve = compiled.regulator_efficiency_curve
+    # Sources solving their voltage in closed form, as the kernel does, or through Source.solve_current, whose
+    # solutions are cached per source
+    source_solve_closed = [source.solve_voltage and source._sags_linearly() for source in sources]
+    source_solve_iterated = [source.solve_voltage and not source._sags_linearly() for source in sources]
+    source_drop_ohm = [source.number_cells*source.internal_resistance_ohm for source in sources]
+    source_unsettled = [False]*len(sources)
+    sag_cache = [{} for source in sources]
+    regulator_max_current_output_ma = compiled.regulator_max_current_output_ma.tolist()
+    thread_regulator = compiled.thread_regulator.tolist()
+    thread_stage_start = compiled.thread_stage_start.tolist()
+    thread_num_stages = compiled.thread_num_stages.tolist()
+    stage_current_ma = _stage_reader(compiled.stage_current_ma)
+    stage_ticks = _stage_reader(compiled.stage_ticks)
+
+    num_sources = len(sources)
+    num_regulators = len(compiled.regulators)
+    thread_stage_index = [thread.stage_index for thread in compiled.threads]
+    thread_last_change_t = [thread.last_stage_change_t for thread in compiled.threads]
+    thread_current_ma = [stage_current_ma[thread_stage_start[i] + thread_stage_index[i]] for i in range(len(compiled.threads))]
+    regulator_output_ma = [sum(thread_current_ma[regulator_thread_start[r]:regulator_thread_start[r+1]]) for r in range(num_regulators)]
+
+    # Running statistics, carried on from earlier parts of the run and written back at the end
+    regulator_output_mAs = [3600.0*(regulator.output_charge_mAh or 0.0) for regulator in compiled.regulators]
+    source_energy_in_J = [source.energy_in_J for source in sources]
+    source_energy_out_J = [source.energy_out_J for source in sources]
+    source_charge_out_mAh = [source.charge_out_mAh for source in sources]
+    source_peak_current_ma = [source.peak_current_ma for source in sources]
+    source_min_voltage = [source.min_voltage if source.min_voltage is not None else float('inf') for source in sources]
+    stage_time_sec = _stage_rows(_concatenate_rows([thread.stage_time_sec for thread in compiled.threads]))
+    thread_stage_entered_t = [start_t]*len(compiled.threads)
+    source_min_input_voltage = [source.min_input_voltage() for source in sources]
+
+    # Hooks and instrumentation are only checked for in the loop when they are in use
+    on_stage_change = hooks.on_stage_change
+    watch_soc = len(hooks.soc_thresholds_pct) > 0
+    soc_thresholds_mAh = [[0.01*pct*source.capacity_mAh for pct in hooks.soc_thresholds_pct] for source in sources]
+    # How many thresholds each source is below. A threshold fires again only once the source has recovered above it.
+    soc_level = [sum(1 for threshold_mAh in thresholds if source.current_charge_mAh < threshold_mAh)
+                 for source, thresholds in zip(sources, soc_thresholds_mAh)]
+    if instrument:
+      clock = time.perf_counter
+      num_events = 0
+      thread_steps = [0]*len(compiled.threads)
+      min_dt = float('inf')
+      max_dt = 0.0
+      scheduling_sec = currents_sec = logging_sec = charge_sec = harvesting_sec = 0.0
+      mark = clock()
+
+    # Stage changes are kept in a priority queue on an integer clock, so only the threads that are due get
+    # touched and coincident transitions compare exactly instead of within an epsilon
+    queue = [(int(round(thread.next_stage_change_t * TICKS_PER_SEC)), i) for i, thread in enumerate(compiled.threads)]
+    heapq.heapify(queue)
+    idle_ticks = int(1.0e6 * TICKS_PER_SEC)
+
+    if block_events is not None:
+      # Events are written into preallocated lists, row after row, as writing single elements of a list is much
+      # cheaper than of an array. They become arrays once a block is full.
+      num_threads = len(compiled.threads)
+      block = [[0.0]*block_events, [0.0]*block_events, [0.0]*(block_events*num_sources), [0.0]*(block_events*num_sources),
+               [0.0]*(block_events*num_sources), [0]*(block_events*num_threads)]
+      block_t, block_dt, block_current_ma, block_voltage, block_charge_mAh, block_stage = block
+      row = 0
+
+    end_t = self.sim_time_sec
+    current_ticks = int(round(start_t * TICKS_PER_SEC))
+    current_t = start_t
+    # The run state is written back however the loop ends, also when the consumer closes the generator at
+    # any event or drops it without closing it
+    try:
+      while(current_t < end_t):
       
-      # Calculate energy use by each thread
-      total_system_power_mW = 0.0
-      total_system_power_mA = 0.0
-      for source in self.sources:
-        total_source_current_ma = 0.0
-        for regulator in source.regulators:
-          total_regulator_output_current_ma = 0.0
-          for thread in regulator.threads:
-            for component in thread.stages[thread.stage_index].components:
-              total_regulator_output_current_ma = total_regulator_output_current_ma + component.current_ma
+        # Determine increment
+        if len(queue) > 0:
+          next_ticks = queue[0][0]
+        else:
+          next_ticks = current_ticks + idle_ticks
+        shortest_dt = (next_ticks - current_ticks) / TICKS_PER_SEC
+        if instrument:
+          num_events = num_events + 1
+          min_dt = min(min_dt, shortest_dt)
+          max_dt = max(max_dt, shortest_dt)
+          now = clock()
+          scheduling_sec = scheduling_sec + now - mark
+          mark = now
+      
+        # Calculate energy use by each thread
+        source_voltages = []
+        source_currents_ma = []
+        for s in range(num_sources):
+          source = sources[s]
+          total_source_current_ma = 0.0
+          switching_mW = 0.0
+          for r in range(source_regulator_start[s], source_regulator_start[s+1]):
+            total_regulator_output_current_ma = regulator_output_ma[r]
+            regulator_output_mAs[r] = regulator_output_mAs[r] + total_regulator_output_current_ma*shortest_dt
           
-          # Check for violations of capability
-          if regulator.max_current_output_ma is not None and total_regulator_output_current_ma > regulator.max_current_output_ma:
-            print("Error: Regulator {0} cannot provide enough current, at t={1}".format(regulator.name, current_t))
-
-          # Sum up over regulators, with quiescent current
-          total_source_current_ma = total_source_current_ma + regulator.quiescent_current_ma 
-          if regulator.is_switching:
-            # Compute with efficiency
-            # TODO not quite right due to lowered source voltage
-            total_source_current_ma = total_source_current_ma + (regulator.output_voltage / (source.get_current_voltage(total_regulator_output_current_ma) * regulator.efficiency))*total_regulator_output_current_ma
-            # TODO future do efficiency curve vs. current
-          else:
-            # Linear regulator, so output current is input current
-            total_source_current_ma = total_source_current_ma + total_regulator_output_current_ma
+            # Check for violations of capability
+            if total_regulator_output_current_ma > regulator_max_current_output_ma[r]:
+              hooks.regulator_overcurrent(self, current_t, compiled.regulators[r], total_regulator_output_current_ma)
+
+            if source_solve_iterated[s]:
+              continue
+            # Sum up over regulators, with quiescent current
+            total_source_current_ma = total_source_current_ma + regulator_quiescent_current_ma[r]
+            if regulator_is_switching[r]:
+              if source_solve_closed[s]:
+                # The power drawn, turned into a current at the sagged voltage below
+                if regulator_efficiency_curve[r] is None:
+                  efficiency = regulator_efficiency[r]
+                else:
+                  efficiency = regulator_efficiency_curve[r].efficiency(total_regulator_output_current_ma)
+                switching_mW = switching_mW + (regulator_output_voltage[r] / efficiency)*total_regulator_output_current_ma
+                continue
+              # Compute with efficiency, at the source voltage sagged by this regulator's output current alone.
+              # This understates the sag and is kept only to compare with earlier results, see Source.
+              input_voltage = source.get_current_voltage(total_regulator_output_current_ma)
+              if regulator_efficiency_curve[r] is None:
+                efficiency = regulator_efficiency[r]
+              else:
+                efficiency = regulator_efficiency_curve[r].efficiency(total_regulator_output_current_ma, input_voltage)
+              total_source_current_ma = total_source_current_ma + (regulator_output_voltage[r] / (input_voltage * efficiency))*total_regulator_output_current_ma
+            else:
+              # Linear regulator, so output current is input current
+              total_source_current_ma = total_source_current_ma + total_regulator_output_current_ma
+          if source_solve_closed[s]:
+            total_source_current_ma, settled = _sagged_current_ma(total_source_current_ma, switching_mW, source.get_current_voltage(0.0), source_drop_ohm[s])
+            if not settled and not source_unsettled[s]:
+              source_unsettled[s] = True
+              print("Error: Source {0} cannot supply its regulators, its voltage does not settle under the load".format(source.name))
+          elif source_solve_iterated[s]:
+            total_source_current_ma = source.solve_current(regulator_output_ma[source_regulator_start[s]:source_regulator_start[s+1]], sag_cache[s])
+
+          source_voltage = source.get_current_voltage(total_source_current_ma)
+          source_voltages.append(source_voltage)
+          source_currents_ma.append(total_source_current_ma)
+          if total_source_current_ma > source_peak_current_ma[s]:
+            source_peak_current_ma[s] = total_source_current_ma
+          if source_voltage < source_min_voltage[s]:
+            source_min_voltage[s] = source_voltage
 
-          # Store per regulator
+          # Log per source, the values hold until the next event
           if record_time_history:
-            regulator.total_regulator_output_current_ma.append(total_regulator_output_current_ma)
-
-        source_voltage = source.get_current_voltage(total_source_current_ma)
-        # Calculate power in and out of sources
-        total_system_power_mW = total_system_power_mW + (source_voltage * total_source_current_ma)
-        total_system_power_mA = total_system_power_mA + total_source_current_ma
-
-        # Log per source
-        if record_time_history:
-          source.time.append(current_t)
-          source.charge_history_time.append(current_t)
-          source.charge_history_mAh.append(source.current_charge_mAh)
-          source.voltage_history.append(source_voltage)
-          source.current_history_ma.append(total_source_current_ma)
-
-      # Log for whole system
-      if record_time_history:
-        self.time.append(current_t)
-        self.system_power_mW.append(total_system_power_mW)
-        self.system_current_mA.append(total_system_power_mA)
+            if instrument:
+              logging_start = clock()
+            source.history.append(current_t, [total_source_current_ma, source_voltage, source.current_charge_mAh] +
+                                  regulator_output_ma[source_regulator_start[s]:source_regulator_start[s+1]])
+            if instrument:
+              logging_sec = logging_sec + clock() - logging_start
 
-      # Increment time
-      current_t = current_t + shortest_dt
+        total_system_current_ma = sum(source_currents_ma)
+        if total_system_current_ma > self.peak_current_mA:
+          self.peak_current_mA = total_system_current_ma
+        if instrument:
+          now = clock()
+          currents_sec = currents_sec + now - mark
+          mark = now
+        if emit:
+          event = (current_t, shortest_dt, tuple(source_currents_ma), tuple(source_voltages), tuple(source.current_charge_mAh for source in sources),
+                   tuple(thread_stage_index))
+        elif block_events is not None:
+          block_t[row] = current_t
+          block_dt[row] = shortest_dt
+          block_current_ma[row*num_sources:(row + 1)*num_sources] = source_currents_ma
+          block_voltage[row*num_sources:(row + 1)*num_sources] = source_voltages
+          block_charge_mAh[row*num_sources:(row + 1)*num_sources] = [source.current_charge_mAh for source in sources]
+          block_stage[row*num_threads:(row + 1)*num_threads] = thread_stage_index
+          row = row + 1
 
-      # Log again after time increment to get correct square profiles on plots
-      if record_time_history:
-        self.time.append(current_t)
-        self.system_power_mW.append(total_system_power_mW)
-        self.system_current_mA.append(total_system_power_mA)
+        # Increment time
+        current_ticks = next_ticks
+        current_t = current_ticks / TICKS_PER_SEC
 
-        for source in self.sources:
-          for regulator in source.regulators:
-            regulator.total_regulator_output_current_ma.append(regulator.total_regulator_output_current_ma[-1])
-          source.time.append(current_t)
-          source.voltage_history.append(source.voltage_history[-1])
-          source.current_history_ma.append(source.current_history_ma[-1])
+        for s in range(num_sources):
+          # Each source is charged and discharged with its own voltage and current
+          source = sources[s]
+          source_voltage = source_voltages[s]
+          total_source_current_ma = source_currents_ma[s]
+          was_charged = source.current_charge_mAh > 0.0
 
-      for source in self.sources:
-        # Energy harvesting if added, after logging
+          # Energy harvesting if added, after logging. The panel's energy is credited once one of its own
+          # harvest steps has passed
+          panel = source.energy_harvesting
+          if panel is not None and current_t >= panel.next_step_t:
+            if instrument:
+              harvesting_start = clock()
+            harvested_J = panel.harvest_until(current_t)
+            if instrument:
+              harvesting_sec = harvesting_sec + clock() - harvesting_start
+            if(source.current_charge_mAh < source.capacity_mAh):
+              J_charged = panel.charge_efficiency * harvested_J
+              source_energy_in_J[s] = source_energy_in_J[s] + J_charged
+              source.net_energy_J = source.net_energy_J + J_charged
+              source.current_charge_mAh = source.current_charge_mAh + (0.277778*J_charged/source_voltage)
+
+          J_discharged = shortest_dt * source_voltage * (total_source_current_ma * 0.001)
+          source_energy_out_J[s] = source_energy_out_J[s] + J_discharged
+          source_charge_out_mAh[s] = source_charge_out_mAh[s] + (0.277778*J_discharged/source_voltage)
+          source.net_energy_J = source.net_energy_J - J_discharged
+          source.current_charge_mAh = source.current_charge_mAh - (0.277778*J_discharged/source_voltage)
+
+          if source.current_charge_mAh > source.capacity_mAh:
+            source.current_charge_mAh = source.capacity_mAh
+
+          if was_charged and source.current_charge_mAh <= 0.0:
+            hooks.source_empty(self, current_t, source)
+
+          if watch_soc:
+            thresholds = soc_thresholds_mAh[s]
+            while soc_level[s] < len(thresholds) and source.current_charge_mAh < thresholds[soc_level[s]]:
+              hooks.on_soc_below(self, current_t, source, hooks.soc_thresholds_pct[soc_level[s]])
+              soc_level[s] = soc_level[s] + 1
+            while soc_level[s] > 0 and source.current_charge_mAh >= thresholds[soc_level[s] - 1]:
+              soc_level[s] = soc_level[s] - 1
+
+          if stop_at_empty and self.empty_t is None:
+            if source_voltage < source_min_input_voltage[s]:
+              # The voltage was already too low over the step just taken
+              self.empty_t, self.empty_source, self.empty_reason = current_t - shortest_dt, source.name, 'dropout'
+            elif source.current_charge_mAh <= 0.0:
+              self.empty_t, self.empty_source, self.empty_reason = current_t, source.name, 'empty'
+        if instrument:
+          now = clock()
+          charge_sec = charge_sec + now - mark
+          mark = now
+
+        if self.empty_t is not None:
+          self.sim_time_sec = current_t
+          if emit:
+            yield Event(*event)
+          break
+
+        # Update thread timing and stages, only for the threads that change stage now
+        changed_regulators = set()
+        while len(queue) > 0 and queue[0][0] == current_ticks:
+          i = heapq.heappop(queue)[1]
+          stage_time_sec[thread_stage_start[i] + thread_stage_index[i]] += current_t - thread_stage_entered_t[i]
+          thread_stage_entered_t[i] = current_t
+          stage_index = thread_stage_index[i] + 1
+          if(stage_index >= thread_num_stages[i]):
+            stage_index = 0 # cyclical
+          thread_stage_index[i] = stage_index
+          thread_last_change_t[i] = current_t
+          thread_current_ma[i] = stage_current_ma[thread_stage_start[i] + stage_index]
+          heapq.heappush(queue, (current_ticks + stage_ticks[thread_stage_start[i] + stage_index], i))
+          changed_regulators.add(thread_regulator[i])
+          if instrument:
+            thread_steps[i] = thread_steps[i] + 1
+          if on_stage_change is not None:
+            on_stage_change(self, current_t, compiled.threads[i], stage_index)
+
+        for r in changed_regulators:
+          regulator_output_ma[r] = sum(thread_current_ma[regulator_thread_start[r]:regulator_thread_start[r+1]])
+
+        if emit:
+          yield Event(*event)
+        elif block_events is not None and row == block_events:
+          yield _event_block_arrays(block, row, num_sources, num_threads)
+          row = 0
+
+      # The last, partly filled block, which also holds the event a source ran empty in
+      if block_events is not None and row > 0:
+        yield _event_block_arrays(block, row, num_sources, num_threads)
+    except GeneratorExit:
+      # The consumer stopped, so the run ends after the last event taken
+      self.sim_time_sec = current_t
+      raise
+    finally:
+      # Credit the harvest of the last, unfinished harvest step
+      for s in range(num_sources):
+        source = sources[s]
         if source.energy_harvesting is not None:
-          harvested_power_W = source.energy_harvesting.calculate_power(current_t)
-          if(source.current_charge_mAh < source.capacity_mAh):
-            J_charged = source.energy_harvesting.charge_efficiency * shortest_dt * harvested_power_W
+          harvested_J = source.energy_harvesting.harvest_until(current_t, partial=True)
+          if harvested_J > 0.0 and source.current_charge_mAh < source.capacity_mAh:
+            J_charged = source.energy_harvesting.charge_efficiency * harvested_J
+            source_energy_in_J[s] = source_energy_in_J[s] + J_charged
             source.net_energy_J = source.net_energy_J + J_charged
-            source.current_charge_mAh = source.current_charge_mAh + (0.277778*J_charged/source_voltage)
+            source.current_charge_mAh = min(source.current_charge_mAh + (0.277778*J_charged/source_voltages[s]), source.capacity_mAh)
 
-        J_discharged = shortest_dt * source_voltage * (total_source_current_ma * 0.001)
-        source.net_energy_J = source.net_energy_J - J_discharged
-        source.current_charge_mAh = source.current_charge_mAh - (0.277778*J_discharged/source_voltage)
+      for r, regulator in enumerate(compiled.regulators):
+        regulator.output_charge_mAh = regulator_output_mAs[r]/3600.0
+      for s, source in enumerate(sources):
+        source.energy_in_J = source_energy_in_J[s]
+        source.energy_out_J = source_energy_out_J[s]
+        source.charge_out_mAh = source_charge_out_mAh[s]
+        source.peak_current_ma = source_peak_current_ma[s]
+        source.min_voltage = source_min_voltage[s] if source_min_voltage[s] < float('inf') else None
+      for i, thread in enumerate(compiled.threads):
+        stage_time_sec[thread_stage_start[i] + thread_stage_index[i]] += current_t - thread_stage_entered_t[i]
+        thread.stage_time_sec = stage_time_sec[thread_stage_start[i]:thread_stage_start[i] + thread_num_stages[i]]
 
-        if source.current_charge_mAh > source.capacity_mAh:
-          source.current_charge_mAh = source.capacity_mAh
+      # Leave the threads where the run stopped
+      for change_ticks, i in queue:
+        thread = compiled.threads[i]
+        thread.stage_index = thread_stage_index[i]
+        thread.last_stage_change_t = thread_last_change_t[i]
+        thread.next_stage_change_t = change_ticks / TICKS_PER_SEC
 
-      # Update thread timing and stages
-      for source in self.sources:
-        for regulator in source.regulators:
-          for thread in regulator.threads:
-            # epsilon added for fpu reasons
-            if current_t >= (thread.next_stage_change_t - 1e-7):
-              thread.stage_index = thread.stage_index + 1
-              thread.last_stage_change_t = current_t
+      self.current_t = current_t
+      if record_time_history:
+        self._close_history(current_t, sources)
 
-              if(thread.stage_index >= thread.num_stages):
-                thread.stage_index = 0 # cyclical
+      if instrument:
+        self.instrumentation = {
+          'engine': 'step',
+          'wall_sec': time.perf_counter() - run_start_sec,
+          'events': num_events,
+          'min_dt_sec': min_dt if num_events > 0 else None,
+          'max_dt_sec': max_dt if num_events > 0 else None,
+          # Logging is timed within the current summation and harvesting within the charge update, so both are
+          # taken out of them here
+          'time_sec': {
+            'scheduling': scheduling_sec,
+            'currents': currents_sec - logging_sec,
+            'logging': logging_sec,
+            'charge': charge_sec - harvesting_sec,
+            'harvesting': harvesting_sec,
+          },
+          'threads': [{'name': thread.name, 'steps': thread_steps[i]} for i, thread in enumerate(compiled.threads)],
+          'history_bytes': self._history_nbytes(),
+        }
 
-              thread.next_stage_change_t = current_t + thread.stages[thread.stage_index].delta_t_sec
+  def _kernel_step_through(self, sources, start_t, record_time_history, stop_at_empty, hooks):
+    # Same as _step_through, with the loop run by _step_kernel over arrays of the compiled system and its run
+    # state. Messages logged by the kernel are replayed through the hooks in order each time it returns.
+    compiled = CompiledSystem(sources)
+    sources = compiled.sources
+    regulators = compiled.regulators
+    threads = compiled.threads
+    curves = [source.ocv_curve for source in sources]
+    thread_stage_index = np.array([thread.stage_index for thread in threads], dtype=np.int64)
+    thread_current_ma = compiled.stage_current_ma[compiled.thread_stage_start[:-1] + thread_stage_index]
+    regulator_thread_start = compiled.regulator_thread_start.tolist()
+    regulator_output_ma = np.array([sum(thread_current_ma[regulator_thread_start[r]:regulator_thread_start[r+1]].tolist())
+                                    for r in range(len(regulators))], dtype=float)
+    queue = [(int(round(thread.next_stage_change_t * TICKS_PER_SEC)), i) for i, thread in enumerate(threads)]
+    heapq.heapify(queue)
+    panels = [source.energy_harvesting for source in sources]
+    num_columns = 3 + max(len(source.regulators) for source in sources)
+    history_rows = KERNEL_HISTORY_ROWS if record_time_history else 1
 
-        if source.current_charge_mAh <= 0.0:
-          print("Error: Source {0} has reached an empty state of charge, at t={1}".format(source.name, current_t))
-          break
+    clock = np.array([int(round(start_t * TICKS_PER_SEC))], dtype=np.int64)
+    state = np.array([start_t, self.peak_current_mA, 0.0])
+    empty = np.array([0.0, -1.0, 0.0])
+    charge_mAh = np.array([source.current_charge_mAh for source in sources], dtype=float)
+    net_energy_J = np.array([source.net_energy_J for source in sources], dtype=float)
+    energy_in_J = np.array([source.energy_in_J for source in sources], dtype=float)
+    energy_out_J = np.array([source.energy_out_J for source in sources], dtype=float)
+    charge_out_mAh = np.array([source.charge_out_mAh for source in sources], dtype=float)
+    peak_current_ma = np.array([source.peak_current_ma for source in sources], dtype=float)
+    min_voltage = np.array([source.min_voltage if source.min_voltage is not None else np.inf for source in sources], dtype=float)
+    source_voltages = np.zeros(len(sources))
+    source_currents_ma = np.zeros(len(sources))
+    regulator_output_mAs = np.array([3600.0*(regulator.output_charge_mAh or 0.0) for regulator in regulators], dtype=float)
+    thread_last_change_t = np.array([thread.last_stage_change_t for thread in threads], dtype=float)
+    thread_stage_entered_t = np.full(len(threads), start_t, dtype=float)
+    stage_time_sec = _concatenate_rows([thread.stage_time_sec for thread in threads])
+    heap_ticks = np.array([ticks for ticks, i in queue], dtype=np.int64)
+    heap_thread = np.array([i for ticks, i in queue], dtype=np.int64)
+    regulator_changed = np.zeros(len(regulators), dtype=bool)
+    harvest_next_t = np.array([panel.next_step_t if panel is not None else np.inf for panel in panels], dtype=float)
+    harvest_pending = np.zeros(len(sources), dtype=np.int64)
+    harvest_J = np.zeros(len(sources))
+    charge_efficiency = np.array([panel.charge_efficiency if panel is not None else 0.0 for panel in panels], dtype=float)
+    history_t = np.zeros((len(sources), history_rows))
+    history_values = np.zeros((len(sources), history_rows, num_columns))
+    log_kind = np.zeros(KERNEL_LOG_ROWS, dtype=np.int64)
+    log_index = np.zeros(KERNEL_LOG_ROWS, dtype=np.int64)
+    log_t = np.zeros(KERNEL_LOG_ROWS)
+    log_value = np.zeros(KERNEL_LOG_ROWS)
+    rows = np.zeros(2, dtype=np.int64)
+
+    arguments = (
+      float(self.sim_time_sec), bool(stop_at_empty), clock, state, empty,
+      compiled.source_regulator_start.astype(np.int64), compiled.regulator_thread_start.astype(np.int64), compiled.regulator_quiescent_current_ma,
+      compiled.regulator_is_switching, compiled.regulator_output_voltage, compiled.regulator_efficiency, compiled.regulator_max_current_output_ma,
+      compiled.thread_regulator.astype(np.int64), compiled.thread_stage_start.astype(np.int64), compiled.thread_num_stages,
+      np.asarray(compiled.stage_current_ma), np.asarray(compiled.stage_ticks),
+      np.array([source.capacity_mAh for source in sources], dtype=float), np.array([source.number_cells for source in sources], dtype=float),
+      np.array([source.internal_resistance_ohm for source in sources], dtype=float),
+      np.array([source.min_input_voltage() for source in sources], dtype=float),
+      np.cumsum([0] + [len(curve.soc_table) for curve in curves]).astype(np.int64), np.concatenate([curve.soc_table for curve in curves]),
+      np.concatenate([curve.cell_voltage_table for curve in curves]), np.concatenate([curve.slopes for curve in curves]),
+      np.array([source.solve_voltage for source in sources], dtype=bool), np.zeros(len(sources), dtype=np.int64),
+      charge_mAh, net_energy_J, energy_in_J, energy_out_J, charge_out_mAh, peak_current_ma, min_voltage,
+      source_voltages, source_currents_ma, regulator_output_ma, regulator_output_mAs,
+      thread_stage_index, thread_last_change_t, thread_current_ma, thread_stage_entered_t, np.asarray(stage_time_sec),
+      heap_ticks, heap_thread, regulator_changed,
+      harvest_next_t, harvest_pending, harvest_J, charge_efficiency,
+      bool(record_time_history), history_t, history_values, log_kind, log_index, log_t, log_value, rows)
+    while True:
+      status = _step_kernel(*arguments)
+      for k in range(rows[1]):
+        if log_kind[k] == KERNEL_OVERCURRENT:
+          hooks.regulator_overcurrent(self, float(log_t[k]), regulators[log_index[k]], float(log_value[k]))
+        elif log_kind[k] == KERNEL_UNSETTLED:
+          print("Error: Source {0} cannot supply its regulators, its voltage does not settle under the load".format(sources[log_index[k]].name))
+        else:
+          hooks.source_empty(self, float(log_t[k]), sources[log_index[k]])
+      rows[1] = 0
+      if record_time_history:
+        for s, source in enumerate(sources):
+          source.history.append_rows(history_t[s, :rows[0]], history_values[s, :rows[0], :3 + len(source.regulators)])
+        rows[0] = 0
+      if status == KERNEL_DONE:
+        break
+      if status == KERNEL_HARVEST:
+        # The panels due at the next event harvest here, and the kernel credits the energy at that event
+        next_t = float(state[2])
+        for s, panel in enumerate(panels):
+          if panel is not None and harvest_pending[s] == 0 and next_t >= harvest_next_t[s]:
+            harvest_J[s] = panel.harvest_until(next_t)
+            harvest_pending[s] = 1
+            harvest_next_t[s] = panel.next_step_t
 
-  def export_to_csv(self, filename):
-    if len(self.time) > 0:
-      csv_output = np.transpose(np.array([np.array(self.time), np.array(self.system_current_mA)]))
-      np.savetxt(filename, csv_output, header='time [s], current [mA]', delimiter = ", ", comments='')
+    current_t = float(state[0])
+    self.peak_current_mA = float(state[1])
+    if empty[1] >= 0:
+      self.empty_t = float(empty[0])
+      self.empty_source = sources[int(empty[1])].name
+      self.empty_reason = 'dropout' if empty[2] == 1 else 'empty'
+      self.sim_time_sec = current_t
+    for s, source in enumerate(sources):
+      source.current_charge_mAh = float(charge_mAh[s])
+      source.net_energy_J = float(net_energy_J[s])
+      source.energy_out_J = float(energy_out_J[s])
+      source.charge_out_mAh = float(charge_out_mAh[s])
+      source.peak_current_ma = float(peak_current_ma[s])
+      source.min_voltage = float(min_voltage[s]) if min_voltage[s] < np.inf else None
+
+      # Credit the harvest of the last, unfinished harvest step
+      if source.energy_harvesting is not None:
+        harvested_J = source.energy_harvesting.harvest_until(current_t, partial=True)
+        if harvested_J > 0.0 and source.current_charge_mAh < source.capacity_mAh:
+          J_charged = source.energy_harvesting.charge_efficiency * harvested_J
+          energy_in_J[s] = energy_in_J[s] + J_charged
+          source.net_energy_J = source.net_energy_J + J_charged
+          source.current_charge_mAh = min(source.current_charge_mAh + (0.277778*J_charged/float(source_voltages[s])), source.capacity_mAh)
+      source.energy_in_J = float(energy_in_J[s])
+    for r, regulator in enumerate(regulators):
+      regulator.output_charge_mAh = float(regulator_output_mAs[r])/3600.0
+
+    thread_stage_start = compiled.thread_stage_start.tolist()
+    stage_time_sec = _stage_rows(stage_time_sec)
+    for i, thread in enumerate(threads):
+      stage_time_sec[thread_stage_start[i] + thread_stage_index[i]] += current_t - float(thread_stage_entered_t[i])
+      thread.stage_time_sec = stage_time_sec[thread_stage_start[i]:thread_stage_start[i+1]]
+    # Leave the threads where the run stopped
+    for change_ticks, i in zip(heap_ticks.tolist(), heap_thread.tolist()):
+      thread = threads[i]
+      thread.stage_index = int(thread_stage_index[i])
+      thread.last_stage_change_t = float(thread_last_change_t[i])
+      thread.next_stage_change_t = change_ticks / TICKS_PER_SEC
+
+    self.current_t = current_t
+    if record_time_history:
+      self._close_history(current_t, sources)
+
+  def _split_profile(self, source_start_t, record_time_history, hooks, instrument, processes, run_start_sec, backend='auto'):
+    # Sources only share the clock, so each can step through its own timeline from its own start. Sources run
+    # in worker processes come back as copies whose run state is copied into the sources here. Panels without
+    # a seed then draw their clouds from each worker's np.random. The system peak current is taken from the
+    # recorded histories, or is the sum of the source peaks when nothing is recorded.
+    previous_peak_mA = self.peak_current_mA
+    runs = []
+    if processes == 1:
+      for source, start_t in zip(self.sources, source_start_t):
+        self._step_through([source], start_t, record_time_history, False, hooks, instrument, time.perf_counter(), backend)
+        runs.append((self.current_t, self.instrumentation))
+    else:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_run_source_timeline, EmbeddedSystem(self.name, [source]), self.sim_time_sec, start_t, record_time_history, instrument,
+                                   backend)
+                   for source, start_t in zip(self.sources, source_start_t)]
+        for source, future in zip(self.sources, futures):
+          system = future.result()
+          _copy_run_state(source, system.sources[0])
+          runs.append((system.current_t, system.instrumentation))
+
+    self._source_end_t = [end_t for end_t, stats in runs]
+    self.current_t = max(self._source_end_t)
+    if record_time_history:
+      current_t, current_ma = self._system_history()[:2]
+      in_run = current_t >= min(source_start_t)
+      self.peak_current_mA = max([previous_peak_mA] + current_ma[in_run].tolist())
     else:
+      self.peak_current_mA = max(previous_peak_mA, sum(source.peak_current_ma for source in self.sources))
+
+    self.instrumentation = None
+    if instrument:
+      stats = [stats for end_t, stats in runs]
+      self.instrumentation = {
+        'engine': 'split',
+        'wall_sec': time.perf_counter() - run_start_sec,
+        'events': sum(run['events'] for run in stats),
+        'min_dt_sec': min([run['min_dt_sec'] for run in stats if run['min_dt_sec'] is not None], default=None),
+        'max_dt_sec': max([run['max_dt_sec'] for run in stats if run['max_dt_sec'] is not None], default=None),
+        'time_sec': {part: sum(run['time_sec'][part] for run in stats) for part in stats[0]['time_sec']},
+        'threads': [thread for run in stats for thread in run['threads']],
+        'history_bytes': self._history_nbytes(),
+      }
+
+  def _history_nbytes(self):
+    # Memory held by the recorded series. Streamed histories only count the chunk still in memory.
+    nbytes = 0
+    for source in self.sources:
+      for history in (source.history, source.energy_harvesting.history if source.energy_harvesting is not None else None):
+        if isinstance(history, HistoryRecorder):
+          nbytes = nbytes + history.nbytes
+    return nbytes
+
+  def print_instrumentation(self):
+    if self.instrumentation is None:
+      print("Note: no instrumentation, run power_profile with instrument=True")
+      return
+    stats = self.instrumentation
+    print("Instrumentation of {0}, {1} engine".format(self.name, stats['engine']))
+    print("  Wall time: {0:.3f} s".format(stats['wall_sec']))
+    if 'events' in stats:
+      print("  Events: {0}, {1:.0f} per second".format(stats['events'], stats['events']/stats['wall_sec'] if stats['wall_sec'] > 0.0 else float('inf')))
+      if stats['events'] > 0:
+        print("  Time step: {0:.3g} s to {1:.3g} s".format(stats['min_dt_sec'], stats['max_dt_sec']))
+      for part, part_sec in stats['time_sec'].items():
+        print("  {0}: {1:.3f} s ({2:.1f}%)".format(part.capitalize(), part_sec, 100.0*part_sec/stats['wall_sec'] if stats['wall_sec'] > 0.0 else 0.0))
+      for thread in stats['threads']:
+        print("  Thread {0}: {1} stage changes".format(thread['name'], thread['steps']))
+    print("  History: {0:.1f} kB".format(stats['history_bytes']/1000.0))
+
+  def _hyperperiod_profile(self, sim_time_sec, record_time_history, stop_at_empty=False, t0=0.0, hooks=None):
+    # Runs from t0 for sim_time_sec. Threads are assumed to have all started at the beginning of their first
+    # stage at time zero, as they do in a power_profile run and its extensions.
+    if hooks is None:
+      hooks = ProfileHooks()
+    compiled = self.compile()
+    period_sec = hyperperiod_sec(compiled.threads)
+    if period_sec is None:
+      # Nothing ever changes stage, so the whole run is a single cycle
+      period_sec = sim_time_sec
+    schedule = _hyperperiod_schedule(compiled, period_sec)
+    if schedule is None:
+      return False
+    start_t, durations, currents = _rotate_schedule(period_sec, *schedule, math.fmod(t0, period_sec))
+
+    if stop_at_empty:
+      # Find the first failure over the whole run, then extrapolate only up to it
+      failure_t = None
+      for s, source in enumerate(compiled.sources):
+        failure = _hyperperiod_failure(compiled, s, period_sec, durations, currents, sim_time_sec, source.min_input_voltage())
+        if failure is not None and (failure_t is None or failure[0] < failure_t):
+          failure_t, self.empty_reason = failure
+          self.empty_source = source.name
+      if failure_t is not None:
+        sim_time_sec = failure_t
+        self.empty_t = t0 + failure_t
+        self.sim_time_sec = self.empty_t
+
+    num_cycles = int(sim_time_sec // period_sec)
+    remaining_sec = sim_time_sec - num_cycles*period_sec
+    in_partial = start_t < remaining_sec
+    partial_durations = np.minimum(durations[in_partial], remaining_sec - start_t[in_partial])
+    partial_currents = currents[in_partial]
+
+    # Check for violations of capability, once for the whole run since the load repeats
+    for r, regulator in enumerate(compiled.regulators):
+      violations = np.nonzero((currents[:, r] > compiled.regulator_max_current_output_ma[r]) & (start_t < sim_time_sec))[0]
+      if len(violations) > 0:
+        hooks.regulator_overcurrent(self, t0 + start_t[violations[0]], regulator, currents[violations[0], r])
+
+    # The first hyperperiod is logged event by event, later stretches as one row of their average load
+    detail_end_t = min(period_sec, sim_time_sec)
+    in_detail = start_t < detail_end_t
+
+    for s, source in enumerate(compiled.sources):
+      columns = slice(compiled.source_regulator_start[s], compiled.source_regulator_start[s+1])
+      source_currents = currents[:, columns]
+      cycle_output_current_ma = np.sum(durations[:, None]*source_currents, axis=0)/period_sec
+      partial_output_current_ma = np.sum(partial_durations[:, None]*partial_currents[:, columns], axis=0)/max(remaining_sec, 1.0e-12)
+      for r, regulator in enumerate(source.regulators):
+        regulator.output_charge_mAh = regulator.output_charge_mAh + float(num_cycles*period_sec*cycle_output_current_ma[r] + remaining_sec*partial_output_current_ma[r])/3600.0
+
+      combos, combo_durations = _cycle_combos(durations, source_currents)
+
+      if record_time_history:
+        detail_durations = np.minimum(durations[in_detail], detail_end_t - start_t[in_detail])
+        detail_voltage, detail_current_ma = _cycle_drain(compiled, s, detail_durations, source_currents[in_detail], source.current_charge_mAh)[2:]
+        for i in range(len(detail_durations)):
+          source.history.append(t0 + start_t[i], [detail_current_ma[i], detail_voltage[i], source.current_charge_mAh] + source_currents[i].tolist())
+
+      cycles_done = 0
+      while cycles_done < num_cycles:
+        cycles, cycle_charge_mAh, cycle_energy_J = _hyperperiod_stretch(compiled, s, combo_durations, combos, source.current_charge_mAh,
+                                                                        num_cycles - cycles_done)
+        self._apply_hyperperiod_drain(source, cycles*cycle_charge_mAh, cycles*cycle_energy_J, t0 + cycles_done*period_sec, cycles*period_sec,
+                                      cycle_output_current_ma, t0 + detail_end_t, hooks)
+        cycles_done = cycles_done + cycles
+
+      if len(partial_durations) > 0:
+        partial_charge_mAh, partial_energy_J = _cycle_drain(compiled, s, partial_durations, partial_currents[:, columns], source.current_charge_mAh)[:2]
+        self._apply_hyperperiod_drain(source, partial_charge_mAh, partial_energy_J, t0 + num_cycles*period_sec, remaining_sec,
+                                      partial_output_current_ma, t0 + detail_end_t, hooks)
+
+    # Switching regulators draw the most at the lowest voltage, so the peaks and the lowest voltage are taken
+    # at the final charge
+    in_run = start_t < sim_time_sec
+    total_current_ma = np.zeros(np.count_nonzero(in_run))
+    for s, source in enumerate(compiled.sources):
+      columns = slice(compiled.source_regulator_start[s], compiled.source_regulator_start[s+1])
+      source_voltage, source_current_ma = _cycle_drain(compiled, s, durations[in_run], currents[in_run][:, columns], source.current_charge_mAh)[2:]
+      total_current_ma = total_current_ma + source_current_ma
+      if len(source_current_ma) > 0:
+        source.peak_current_ma = max(source.peak_current_ma, float(np.max(source_current_ma)))
+        min_voltage = float(np.min(source_voltage))
+        source.min_voltage = min_voltage if source.min_voltage is None else min(source.min_voltage, min_voltage)
+    if len(total_current_ma) > 0:
+      self.peak_current_mA = max(self.peak_current_mA, float(np.max(total_current_ma)))
+
+    # Leave the threads where the run stopped, as the stepping loop does
+    end_ticks = int(round((t0 + sim_time_sec) * TICKS_PER_SEC))
+    for i, thread in enumerate(compiled.threads):
+      if isinstance(thread.stage_time_sec, list):
+        thread.stage_time_sec = [stage_sec + end_sec - start_sec for stage_sec, end_sec, start_sec in
+                                 zip(thread.stage_time_sec, thread.stage_time_over(t0 + sim_time_sec), thread.stage_time_over(t0))]
+      else:
+        thread.stage_time_sec[:] = thread.stage_time_sec + thread.stage_time_over(t0 + sim_time_sec) - thread.stage_time_over(t0)
+      stage_ticks = compiled.stage_ticks[compiled.thread_stages(i)]
+      phase_ticks = end_ticks % int(np.sum(stage_ticks))
+      stage_end_ticks = np.cumsum(stage_ticks)
+      thread.stage_index = int(np.searchsorted(stage_end_ticks, phase_ticks, side='right'))
+      stage_start_ticks = end_ticks - phase_ticks + int(stage_end_ticks[thread.stage_index] - stage_ticks[thread.stage_index])
+      thread.last_stage_change_t = stage_start_ticks / TICKS_PER_SEC
+      thread.next_stage_change_t = (stage_start_ticks + int(stage_ticks[thread.stage_index])) / TICKS_PER_SEC
+    self.current_t = t0 + sim_time_sec
+    return True
+
+  def _apply_hyperperiod_drain(self, source, charge_mAh, energy_J, start_t, span_sec, output_current_ma, detail_end_t, hooks):
+    if source.history is not None and start_t + span_sec > detail_end_t:
+      row_t = max(start_t, detail_end_t)
+      average_current_ma = charge_mAh/(0.277778*0.001*span_sec)
+      if charge_mAh > 0.0:
+        average_voltage = 0.277778*energy_J/charge_mAh
+      else:
+        average_voltage = source.get_current_voltage(0.0)
+      row_charge_mAh = source.current_charge_mAh - charge_mAh*(row_t - start_t)/span_sec
+      source.history.append(row_t, [average_current_ma, average_voltage, row_charge_mAh] + output_current_ma.tolist())
+
+    if source.current_charge_mAh > 0.0 and source.current_charge_mAh - charge_mAh <= 0.0:
+      empty_t = start_t + span_sec*source.current_charge_mAh/charge_mAh
+      hooks.source_empty(self, empty_t, source)
+    source.current_charge_mAh = source.current_charge_mAh - charge_mAh
+    source.net_energy_J = source.net_energy_J - energy_J
+    source.energy_out_J = source.energy_out_J + energy_J
+    source.charge_out_mAh = source.charge_out_mAh + charge_mAh
+
+  def _history_end_t(self):
+    return max(source.history.end_t for source in self.sources if source.history is not None)
+
+  def export_history(self, directory):
+    # Writes every recorded series as raw binary columns with a manifest, the layout of a HistorySink: the
+    # system current and power as "system", and per source its current, voltage, charge and regulator output
+    # currents as "source_<s>" and its harvesting as "source_<s>_harvesting". load_history reads them back
+    # memory-mapped, and EmbeddedSystem.load_history attaches them to a system of the same structure.
+    if len(self.time) == 0:
       print("In order to export profiles, you must set record_time_history to True")
+      return
+    os.makedirs(directory, exist_ok=True)
+    end_t = self._history_end_t()
+    current_t, current_mA, power_mW = self._system_history()
+    integrals = [_step_integral(current_t, current_mA, end_t), _step_integral(current_t, power_mW, end_t)]
+    manifest = {'system': _write_series(directory, 'system', ['current_ma', 'power_mW'], current_t, np.column_stack([current_mA, power_mW]),
+                                        len(current_t), end_t, integrals)}
+    for name, history in self._histories().items():
+      time, values = history._arrays()
+      manifest[name] = _write_series(directory, name, history.columns, time, values, history.num_events, history.end_t, history._integrals)
+    _write_manifest(directory, manifest)
+
+  def export_to_csv(self, filename, all_series=False, chunk_rows=CSV_CHUNK_ROWS):
+    # Writes the system current as a square profile, two rows per recorded time. With all_series every
+    # recorded series follows as a column, each holding its value at the row's time. Rows are merged from the
+    # sources' histories, formatted and written chunk_rows at a time, so neither the whole profile nor the
+    # summed system series are ever held.
+    recorded = [source for source in self.sources if source.history is not None]
+    if sum(len(source.history) for source in recorded) == 0:
+      print("In order to export profiles, you must set record_time_history to True")
+      return
+    end_t = self._history_end_t()
+    header = ['time [s]', 'current [mA]']
+    series = []
+    if all_series:
+      header.append('power [mW]')
+      for name, history in self._histories().items():
+        header = header + ["{0} {1}".format(name, column) for column in history.columns]
+        series.append(history._arrays())
+      # Harvesting is recorded on its own grid, so the rows follow every series' changes
+      times = [series_t for series_t, series_values in series]
+    else:
+      times = [source.time for source in recorded]
+    source_series = [(source.time, source.current_history_ma, source.voltage_history) for source in recorded]
+    with open(filename, 'w') as f:
+      f.write(', '.join(header) + '\n')
+      for chunk_t, next_t, ranges in _merged_step_times(times, chunk_rows):
+        if len(recorded) == 1 and not all_series:
+          start, end = ranges[0]
+          columns = [source_series[0][1][start:end]]
+        else:
+          # System totals are the sum over the sources, as in _system_history
+          columns = [sum(_step_values_at(t, current_ma, chunk_t) for t, current_ma, voltage in source_series)]
+        if all_series:
+          columns.append(sum(_step_values_at(t, current_ma, chunk_t)*_step_values_at(t, voltage, chunk_t) for t, current_ma, voltage in source_series))
+          for series_t, series_values in series:
+            columns = columns + [_step_values_at(series_t, series_values[:, c], chunk_t) for c in range(series_values.shape[1])]
+        edges_t = _step_profile(chunk_t, columns[0], next_t if next_t is not None else end_t)[0]
+        rows = np.column_stack([edges_t] + [np.repeat(column, 2) for column in columns])
+        np.savetxt(f, rows, delimiter = ", ")
 
   
+  def _plot_system_power(self, window):
+    # Row times and values of the system power, only summed over the window when there are several sources
+    recorded = [source for source in self.sources if source.history is not None]
+    if len(recorded) == 1:
+      current_ma, voltage = recorded[0].current_history_ma, recorded[0].voltage_history
+      return recorded[0].time, lambda start, end: current_ma[start:end]*voltage[start:end]
+    series = []
+    for source in recorded:
+      start, end = _window_rows(source.time, window)
+      series.append((source.time[start:end], source.current_history_ma[start:end]*source.voltage_history[start:end]))
+    power_t, power_mW = _sum_step_series(series)
+    return power_t, _column_rows(power_mW)
+
   def plot(self, show_energy_harvest=True, show_power_breakdown=True, show_charge_history=True,
-           show_voltage_history=True, show_current_history=True):
+           show_voltage_history=True, show_current_history=True, time_window=None, resolution=None):
+    # time_window is (start_sec, end_sec) to zoom into, by default the whole run. Every series is reduced to
+    # the lowest and highest values within each of resolution pixels, by default the figure's width.
+    def plot_series(ax, t, values, end_t, step=True, **kwargs):
+      ax.plot(*_plot_series(t, values, end_t, time_window, resolution, step), **kwargs)
+      if time_window is not None:
+        ax.set_xlim(time_window)
+
+    # Sources without a recorded history, such as those of a run without record_time_history, are left out
+    recorded = [source for source in self.sources if source.history is not None]
+    if len(recorded) == 0:
+      print("Note: nothing to plot, set record_time_history to True to record the time history")
+      return
+
     if show_energy_harvest:
       is_any_harvesting = False
-      for source in self.sources:
-        if source.energy_harvesting is not None:
+      for source in recorded:
+        if source.energy_harvesting is not None and source.energy_harvesting.history is not None:
           is_any_harvesting = True
 
       if is_any_harvesting:
         fig = plt.figure()
         ax = plt.axes()
-        for source in self.sources:
-          if source.energy_harvesting is not None:
-            ax.plot(source.energy_harvesting.time, source.energy_harvesting.power_history_W, 
-                  label = "Charging of source {0} has capacity factor {1:.1f}".format(source.name, source.energy_harvesting.capacity_factor()))
+        for source in recorded:
+          if source.energy_harvesting is not None and source.energy_harvesting.history is not None:
+            panel = source.energy_harvesting
+            plot_series(ax, panel.time, _column_rows(panel.power_history_W), panel.history.end_t, step=False,
+                        label = "Charging of source {0} has capacity factor {1:.1f}".format(source.name, panel.capacity_factor()))
         plt.title("Energy Harvesting for All Sources")
         plt.legend()
         plt.grid()
@@ -305,10 +2893,11 @@ class EmbeddedSystem:
     if show_power_breakdown:
       fig = plt.figure()
       ax = plt.axes() 
-      ax.plot(self.time, self.system_power_mW, label="System Power")
-      for source in self.sources:
-          battery_power = np.multiply(np.array(source.current_history_ma),np.array(source.voltage_history))
-          plt.plot(source.time, battery_power, label = "Power from {0}".format(source.name))
+      plot_series(ax, *self._plot_system_power(time_window), self._history_end_t(), label="System Power")
+      for source in recorded:
+          current_ma, voltage = source.current_history_ma, source.voltage_history
+          plot_series(ax, source.time, lambda start, end: current_ma[start:end]*voltage[start:end], source.history.end_t,
+                      label = "Power from {0}".format(source.name))
       plt.title("Total System Power and Power from All Sources")
       plt.legend()
       plt.grid()
@@ -318,8 +2907,9 @@ class EmbeddedSystem:
     if show_charge_history:
       fig = plt.figure()
       ax = plt.axes()
-      for source in self.sources:
-          ax.plot(source.charge_history_time, source.charge_history_mAh, label = "Charge history for {0}".format(source.name))
+      for source in recorded:
+          plot_series(ax, source.charge_history_time, _column_rows(source.charge_history_mAh), source.history.end_t, step=False,
+                      label = "Charge history for {0}".format(source.name))
       plt.title("Charge History of All Sources")
       plt.legend()
       plt.grid()
@@ -329,8 +2919,9 @@ class EmbeddedSystem:
     if show_voltage_history:
       fig = plt.figure()
       ax = plt.axes()
-      for source in self.sources:
-          ax.plot(source.time, source.voltage_history, label = "Voltage history for {0}".format(source.name))
+      for source in recorded:
+          plot_series(ax, source.time, _column_rows(source.voltage_history), source.history.end_t,
+                      label = "Voltage history for {0}".format(source.name))
       plt.title("Voltage of All Sources")
       plt.legend()
       plt.grid()
@@ -340,10 +2931,12 @@ class EmbeddedSystem:
     if show_current_history:
       fig = plt.figure()
       ax = plt.axes()
-      for source in self.sources:
-          ax.plot(source.time, source.current_history_ma, label = "Current history for {0}".format(source.name))
+      for source in recorded:
+          plot_series(ax, source.time, _column_rows(source.current_history_ma), source.history.end_t,
+                      label = "Current history for {0}".format(source.name))
           for reg in source.regulators:
-              ax.plot(source.time, reg.total_regulator_output_current_ma, label = "Current history for regulator {0} on source {1}".format(reg.name, source.name))
+              plot_series(ax, source.time, _column_rows(reg.total_regulator_output_current_ma), source.history.end_t,
+                          label = "Current history for regulator {0} on source {1}".format(reg.name, source.name))
       plt.title("Current of All Sources and Regulators")
       plt.legend()
       plt.grid()
@@ -352,35 +2945,1195 @@ class EmbeddedSystem:
 
     plt.show()
   
+  def time_to_empty(self, max_time_sec=20*365*86400.0, use_hyperperiod=True):
+    # Simulates until the first source is empty or can no longer supply a regulator above its dropout
+    # voltage, and returns that time in seconds, or None if it lasts past max_time_sec. Unlike the battery
+    # life in print_summary this follows the voltage curve and resistive sag down to the end.
+    if not any(source.energy_harvesting is not None for source in self.sources):
+      self.power_profile(max_time_sec, use_hyperperiod=use_hyperperiod, stop_at_empty=True)
+      return self.empty_t
+
+    # With harvesting the run goes a day at a time and returns None as soon as a whole day leaves every source
+    # with no less charge than it started the day with, as the days after it harvest alike
+    elapsed_sec = 0.0
+    while elapsed_sec < max_time_sec:
+      day_sec = min(86400.0, max_time_sec - elapsed_sec)
+      start_charge_mAh = [source.current_charge_mAh for source in self.sources]
+      self.power_profile(day_sec, stop_at_empty=True, extend=elapsed_sec > 0.0)
+      if self.empty_t is not None:
+        return self.empty_t
+      elapsed_sec += day_sec
+      if day_sec == 86400.0 and all(source.current_charge_mAh >= charge_mAh for source, charge_mAh in zip(self.sources, start_charge_mAh)):
+        return None
+    return None
+
+  def monte_carlo(self, sim_time_sec, realizations=1000, seed=None, step_sec=60.0, percentiles=(5, 25, 50, 75, 95)):
+    # Runs many independent cloud realizations of the energy harvesting at once and returns, for every source,
+    # the final state of charge, time at empty (inf if never empty) and capacity factor of each realization
+    # along with their percentiles. Each solar panel draws from its own generator spawned from seed, and the
+    # system itself is left as it was. Like power_profile without extend, the realizations start from zero with
+    # the threads in their first stage and the panel clocks restarted, from the sources' present charge.
+    #
+    # The load is scheduled once and binned into steps of step_sec. Within a step the clouds and the open
+    # circuit voltage are held, and switching regulator currents use a series expansion in the cell voltage
+    # of the exact per event sums. Steps well below clouds_tau match the stepping loop statistically.
+    # Efficiency curves are taken at the source voltage at the start of the run, and sources that solve their
+    # voltage are treated like the others, with each regulator sagging the source by its own current.
+    if realizations < 1:
+      raise ValueError("realizations must be at least 1")
+    if step_sec <= 0.0:
+      raise ValueError("step_sec must be positive")
+    compiled = self.compile()
+    sources = compiled.sources
+    panels = [source.energy_harvesting for source in sources]
+    generators = [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(len(sources))]
+    num_bins = max(int(math.ceil(sim_time_sec / step_sec)), 1)
+
+    # Per step sums over the load events, each event's step is booked to the bin it ends in
+    duration_sec = np.zeros(num_bins)
+    linear_mAs = np.zeros((len(sources), num_bins))
+    switching_moments = np.zeros((len(compiled.regulators), 3, num_bins))
+    end_t = 0.0
+    for times, steps, currents in _load_event_blocks(compiled, sim_time_sec):
+      t = np.array(times)
+      dt = np.array(steps)
+      currents = np.array(currents).reshape(len(times), len(compiled.regulators))
+      bins = np.minimum(np.ceil(t / step_sec).astype(int) - 1, num_bins - 1)
+      end_t = times[-1]
+      duration_sec += np.bincount(bins, dt, num_bins)
+      for s, source in enumerate(sources):
+        for r in range(compiled.source_regulator_start[s], compiled.source_regulator_start[s+1]):
+          weight = dt * currents[:, r]
+          if compiled.regulator_is_switching[r]:
+            curve = compiled.regulator_efficiency_curve[r]
+            if curve is not None:
+              weight = weight / curve.efficiency(currents[:, r], source.voltage_at(source.current_charge_mAh, currents[:, r]))
+            drop = source.internal_resistance_ohm*(currents[:, r]*0.001)
+            for m in range(3):
+              switching_moments[r, m] += np.bincount(bins, weight, num_bins)
+              weight = weight * drop
+          else:
+            linear_mAs[s] += np.bincount(bins, weight, num_bins)
+
+    # Harvesting is integrated exactly over each step, as SolarPanel does over its own steps
+    bin_edges = np.arange(num_bins + 1)*step_sec
+    bin_edges[-1] = end_t
+    clear_sky_Ws = [panel.clear_sky_energy(bin_edges[:-1], bin_edges[1:]) if panel is not None else None for panel in panels]
+
+    charge_mAh = [np.full(realizations, float(source.current_charge_mAh)) for source in sources]
+    random_walk = [np.zeros(realizations) for source in sources]
+    cloud_sum_J = [np.zeros(realizations) for source in sources]
+    time_at_empty_sec = [np.full(realizations, np.inf) for source in sources]
+    quiescent_ma = [float(np.sum(compiled.regulator_quiescent_current_ma[compiled.source_regulator_start[s]:compiled.source_regulator_start[s+1]]))
+                    for s in range(len(sources))]
+    last_t = [0.0]*len(panels)
+
+    for j in range(num_bins):
+      step_end_t = bin_edges[j + 1]
+      for s, source in enumerate(sources):
+        charge = charge_mAh[s]
+        cell_voltage = source.ocv_curve.cell_voltage((charge / source.capacity_mAh)*100.0)
+
+        # Load charge in mA*s, switching regulators expand 1/(cell voltage - resistive drop) in the cell voltage
+        load_mAs = quiescent_ma[s]*duration_sec[j] + linear_mAs[s, j]
+        inverse_cell_voltage = 1.0/cell_voltage
+        for r in range(compiled.source_regulator_start[s], compiled.source_regulator_start[s+1]):
+          if compiled.regulator_is_switching[r]:
+            moments = switching_moments[r, :, j]
+            load_mAs = load_mAs + (compiled.regulator_output_voltage[r] / (source.number_cells * compiled.regulator_efficiency[r])) * \
+                       inverse_cell_voltage*(moments[0] + inverse_cell_voltage*(moments[1] + inverse_cell_voltage*moments[2]))
+        start_charge = charge.copy()
+
+        panel = panels[s]
+        if panel is not None:
+          f = np.exp(-(step_end_t - last_t[s])/panel.clouds_tau)
+          random_walk[s] = f*random_walk[s] + np.sqrt(1.0-f**2.0) * generators[s].standard_normal(realizations)
+          last_t[s] = step_end_t
+          cloud_factor = np.where(np.abs(random_walk[s]) > panel.clouds_cover, 0.1, 1.0)
+          cloud_sum_J[s] += cloud_factor*clear_sky_Ws[s][j]
+          mean_current_ma = load_mAs/duration_sec[j] if duration_sec[j] > 0.0 else 0.0
+          source_voltage = source.number_cells*(cell_voltage - source.internal_resistance_ohm*(mean_current_ma*0.001))
+          charge += np.where(charge < source.capacity_mAh, 0.277778*panel.charge_efficiency*cloud_factor*clear_sky_Ws[s][j]/source_voltage, 0.0)
+
+        charge -= 0.277778*0.001*load_mAs
+        np.minimum(charge, source.capacity_mAh, out=charge)
+
+        # Empty times are interpolated within the step
+        emptied = (start_charge > 0.0) & (charge <= 0.0) & np.isinf(time_at_empty_sec[s])
+        if emptied.any():
+          time_at_empty_sec[s][emptied] = step_end_t - (step_end_t - bin_edges[j])*(-charge[emptied]/(start_charge[emptied] - charge[emptied]))
+
+    results = {'realizations': realizations, 'seed': seed, 'step_sec': step_sec, 'percentiles': list(percentiles), 'sources': []}
+    for s, source in enumerate(sources):
+      final_soc_pct = 100.0*charge_mAh[s]/source.capacity_mAh
+      capacity_factor = cloud_sum_J[s]/max(end_t, step_sec)/panels[s].rated_power_W if panels[s] is not None else None
+      results['sources'].append({
+        'name': source.name,
+        'final_soc_pct': final_soc_pct,
+        'time_at_empty_sec': time_at_empty_sec[s],
+        'capacity_factor': capacity_factor,
+        'final_soc_pct_percentiles': np.percentile(final_soc_pct, percentiles),
+        # Realizations that never empty are inf, so take the nearest realization rather than interpolating
+        'time_at_empty_sec_percentiles': np.percentile(time_at_empty_sec[s], percentiles, method='nearest'),
+        'empty_fraction': float(np.mean(np.isfinite(time_at_empty_sec[s]))),
+        'capacity_factor_percentiles': np.percentile(capacity_factor, percentiles) if capacity_factor is not None else None,
+      })
+    return results
+
+  def summary(self):
+    sources = []
+    regulators = []
+    threads = []
+    for source in self.sources:
+      battery_life_sec = None
+      if source.energy_harvesting is None:
+        # Battery life is computed assuming this section is meaningfully long and we calculate
+        # total battery life from a full battery
+        drain_mAh_per_second = (source.initial_charge_mAh - source.current_charge_mAh) / self.sim_time_sec
+        battery_life_sec = source.capacity_mAh / drain_mAh_per_second if drain_mAh_per_second > 0.0 else float('inf')
+      sources.append({
+        'name': source.name,
+        'capacity_mAh': source.capacity_mAh,
+        'initial_charge_mAh': source.initial_charge_mAh,
+        'charge_mAh': source.current_charge_mAh,
+        'soc_pct': 100.0*source.current_charge_mAh/source.capacity_mAh,
+        'net_energy_J': source.net_energy_J,
+        'energy_in_J': source.energy_in_J,
+        'energy_out_J': source.energy_out_J,
+        'average_current_ma': 3600.0*source.charge_out_mAh/self.sim_time_sec,
+        'peak_current_ma': source.peak_current_ma,
+        'min_voltage': source.min_voltage,
+        'battery_life_sec': battery_life_sec,
+      })
+      for reg in source.regulators:
+        regulators.append({
+          'source': source.name,
+          'name': reg.name,
+          'output_voltage': reg.output_voltage,
+          'output_charge_mAh': reg.output_charge_mAh if reg.output_charge_mAh is not None else 0.0,
+        })
+        for thread in reg.threads:
+          threads.append({
+            'regulator': reg.name,
+            'name': thread.name,
+            'stage_time_sec': _rows_list(thread.stage_time_sec),
+            'duty_cycles': thread.duty_cycles(),
+          })
+    return {'name': self.name, 'sim_time_sec': self.sim_time_sec, 'peak_current_mA': self.peak_current_mA,
+            'empty_t': self.empty_t, 'empty_source': self.empty_source, 'empty_reason': self.empty_reason,
+            'average_current_mA': sum(source['average_current_ma'] for source in sources),
+            'sources': sources, 'regulators': regulators, 'threads': threads}
+
+  def attribution(self):
+    # Breaks the charge and energy of the last run down by source, regulator, thread, component and mode.
+    # Stage times come from whole thread cycles over the run, so this costs the same for any horizon.
+    # Switching regulator input is taken at the run's average source voltage. Source charge and energy
+    # include each regulator's conversion loss, and quiescent current is a row with no thread or component.
+    rows = []
+    for source in self.sources:
+      if source.charge_out_mAh > 0.0:
+        source_voltage = source.energy_out_J/(3.6*source.charge_out_mAh)
+      else:
+        source_voltage = source.get_current_voltage()
+      for reg in source.regulators:
+        # Source charge and energy per mA*s at the regulator output
+        if reg.is_switching:
+          # An efficiency curve is taken at the regulator's average output current
+          efficiency = reg.efficiency_at(3600.0*(reg.output_charge_mAh or 0.0)/self.sim_time_sec, source_voltage)
+          input_mAs_per_mAs = reg.output_voltage/(source_voltage*efficiency)
+          input_J_per_mAs = 0.001*reg.output_voltage/efficiency
+        else:
+          input_mAs_per_mAs = 1.0
+          input_J_per_mAs = 0.001*source_voltage
+        regulator_rows = {}
+        for thread in reg.threads:
+          for stage, stage_sec in zip(thread.stages, thread.stage_time_over(self.sim_time_sec)):
+            for component in stage.components:
+              key = (thread.name, component.name, component.mode_name)
+              if key not in regulator_rows:
+                regulator_rows[key] = {'source': source.name, 'regulator': reg.name, 'thread': thread.name, 'component': component.name,
+                                       'mode': component.mode_name, 'time_sec': 0.0, 'output_charge_mAh': 0.0, 'source_charge_mAh': 0.0,
+                                       'output_energy_J': 0.0, 'source_energy_J': 0.0, 'loss_energy_J': 0.0}
+              row = regulator_rows[key]
+              output_mAs = component.current_ma*stage_sec
+              row['time_sec'] = row['time_sec'] + stage_sec
+              row['output_charge_mAh'] = row['output_charge_mAh'] + output_mAs/3600.0
+              row['source_charge_mAh'] = row['source_charge_mAh'] + input_mAs_per_mAs*output_mAs/3600.0
+              row['output_energy_J'] = row['output_energy_J'] + 0.001*reg.output_voltage*output_mAs
+              row['source_energy_J'] = row['source_energy_J'] + input_J_per_mAs*output_mAs
+              row['loss_energy_J'] = row['source_energy_J'] - row['output_energy_J']
+        rows.extend(regulator_rows.values())
+
+        quiescent_mAs = reg.quiescent_current_ma*self.sim_time_sec
+        rows.append({'source': source.name, 'regulator': reg.name, 'thread': None, 'component': None, 'mode': 'Quiescent',
+                     'time_sec': self.sim_time_sec, 'output_charge_mAh': 0.0, 'source_charge_mAh': quiescent_mAs/3600.0,
+                     'output_energy_J': 0.0, 'source_energy_J': 0.001*source_voltage*quiescent_mAs,
+                     'loss_energy_J': 0.001*source_voltage*quiescent_mAs})
+    return rows
+
+  def print_attribution(self, by=('component', 'mode')):
+    # Totals of the attribution rows grouped by any of source, regulator, thread, component and mode
+    totals = {}
+    for row in self.attribution():
+      key = tuple(row[name] for name in by)
+      if key not in totals:
+        totals[key] = [0.0, 0.0]
+      totals[key][0] = totals[key][0] + row['source_charge_mAh']
+      totals[key][1] = totals[key][1] + row['source_energy_J']
+    total_mAh = sum(charge_mAh for charge_mAh, energy_J in totals.values())
+
+    print(".........................................................")
+    print("{0}, Source Charge (mAh), Share (%), Source Energy (J)".format(", ".join(name.capitalize() for name in by)))
+    for key, (charge_mAh, energy_J) in sorted(totals.items(), key=lambda item: -item[1][0]):
+      share = 100.0*charge_mAh/total_mAh if total_mAh > 0.0 else 0.0
+      print("{0}, {1:.4f}, {2:.2f}, {3:.4f}".format(", ".join(str(name) for name in key), charge_mAh, share, energy_J))
+    print(".........................................................")
+
   def print_summary(self):
+    summary = self.summary()
 
     print(".........................................................")
     print("Source, Regulator, Regulator Output Voltage (V) , Regulator Total Current (mAh), Run Time (s)")
-    for source in self.sources:
-      for reg in source.regulators:
-        current_total_mAh = 0.0
-        for i in range(1,len(reg.total_regulator_output_current_ma)):
-          current_total_mAh = current_total_mAh + (reg.total_regulator_output_current_ma[i])*(source.time[i] - source.time[i-1])/3600.0
-        print("{0}, {1}, {2:.2f}, {3:.4f}, {4:.2f}".format(source.name, reg.name, reg.output_voltage, current_total_mAh, self.sim_time_sec))
+    for reg in summary['regulators']:
+      print("{0}, {1}, {2:.2f}, {3:.4f}, {4:.2f}".format(reg['source'], reg['name'], reg['output_voltage'], reg['output_charge_mAh'], summary['sim_time_sec']))
     print(".........................................................")
 
-    for source in self.sources:
-      if source.energy_harvesting is not None:
-        if source.current_charge_mAh > source.initial_charge_mAh:
-          print("Charge of source {0} has increased by {1:.2f}% to {2:.2f}% total state of charge".format(source.name, 
-                    100.0*(source.current_charge_mAh-source.initial_charge_mAh)/source.capacity_mAh, 100.0*source.current_charge_mAh/source.capacity_mAh))
+    for source in summary['sources']:
+      if source['battery_life_sec'] is None:
+        if source['charge_mAh'] > source['initial_charge_mAh']:
+          print("Charge of source {0} has increased by {1:.2f}% to {2:.2f}% total state of charge".format(source['name'], 
+                    100.0*(source['charge_mAh']-source['initial_charge_mAh'])/source['capacity_mAh'], source['soc_pct']))
         else:
-          print("Charge of source {0} has decreased by {1:.2f}% to {2:.2f}% total state of charge".format(source.name, 
-                    100.0*(source.initial_charge_mAh-source.current_charge_mAh)/source.capacity_mAh, 100.0*source.current_charge_mAh/source.capacity_mAh))
+          print("Charge of source {0} has decreased by {1:.2f}% to {2:.2f}% total state of charge".format(source['name'], 
+                    100.0*(source['initial_charge_mAh']-source['charge_mAh'])/source['capacity_mAh'], source['soc_pct']))
           
       else:
-        # Battery life is computed assuming this section is meaningfully long and we calculate
-        # total battery life from a full battery
-        drain_mAh_per_second = (source.initial_charge_mAh - source.current_charge_mAh) / self.sim_time_sec
-        battery_life_seconds = source.capacity_mAh / drain_mAh_per_second
+        battery_life_seconds = source['battery_life_sec']
         if battery_life_seconds < 24*3600:
           print("Battery life is {0:.2f} hours".format(battery_life_seconds / 3600.0))
         elif battery_life_seconds < 365*24*3600:
           print("Battery life is {0:.2f} days".format(battery_life_seconds / (24.0*3600.0)))
         else:
-          print("Battery life is {0:.2f} years".format(battery_life_seconds / (24.0*3600.0*365.0)))
\ No newline at end of file
+          print("Battery life is {0:.2f} years".format(battery_life_seconds / (24.0*3600.0*365.0)))
+
+######### Result Cache #########
+# A ResultCache keeps finished runs in a directory, one entry per run configuration, named by a hash of
+# everything that decides the outcome of the run: the whole Source/Regulator/Thread/Stage tree, the sources'
+# starting charge, the panels' cloud generators, sim_time_sec and the run options. An entry holds the
+# system's snapshot after the run and, for recorded runs, its histories, which are memory-mapped back on a
+# hit. Entries are written to a temporary directory and renamed into place, so processes sharing the cache
+# never see a partial entry, and the least recently used entries are removed beyond max_bytes.
+
+CACHE_VERSION = 1
+CACHE_SNAPSHOT = "snapshot.bin"
+
+def _configuration(system):
+  # Everything about the system that decides a run, apart from the stage tables hashed separately
+  sources = []
+  for source in system.sources:
+    panel = source.energy_harvesting
+    sources.append({
+      'type': type(source).__name__,
+      'name': source.name,
+      'number_cells': source.number_cells,
+      'capacity_mAh': source.capacity_mAh,
+      'initial_charge_mAh': source.initial_charge_mAh,
+      'charge_mAh': source.current_charge_mAh,
+      'internal_resistance_ohm': source.internal_resistance_ohm,
+      'solve_voltage': source.solve_voltage,
+      'ocv_curve': [source.ocv_curve.soc_table.tolist(), source.ocv_curve.cell_voltage_table.tolist()],
+      'panel': None if panel is None else {
+        'rated_power_W': panel.rated_power_W, 'charge_efficiency': panel.charge_efficiency, 't_offset_sec': panel.t_offset_sec,
+        'clouds_tau': panel.clouds_tau, 'clouds_cover': panel.clouds_cover, 'step_sec': panel.step_sec, 'seed': panel.seed,
+        'random_walk_val': panel.random_walk_val, 'rng': panel.rng.bit_generator.state if panel.rng is not None else None,
+      },
+      'regulators': [{
+        'name': reg.name, 'output_voltage': reg.output_voltage, 'is_switching': reg.is_switching,
+        'efficiency': reg.efficiency.as_dict() if isinstance(reg.efficiency, EfficiencyCurve) else reg.efficiency,
+        'quiescent_current_ma': reg.quiescent_current_ma, 'max_current_output_ma': reg.max_current_output_ma, 'dropout_voltage': reg.dropout_voltage,
+        'threads': [{
+          'type': type(thread).__name__,
+          'name': thread.name,
+          'components': None if isinstance(thread, TraceThread) else
+                        [[(component.name, component.mode_name, component.current_ma) for component in stage.components] for stage in thread.stages],
+        } for thread in reg.threads],
+      } for reg in source.regulators],
+    })
+  return {'name': system.name, 'sources': sources}
+
+def config_hash(system, sim_time_sec, **options):
+  # Hex digest identifying a run of system for sim_time_sec with the given power_profile options
+  digest = hashlib.sha256()
+  digest.update(json.dumps({'version': CACHE_VERSION, 'snapshot_version': SNAPSHOT_VERSION, 'sim_time_sec': sim_time_sec,
+                            'options': options, 'system': _configuration(system)}, sort_keys=True, default=str).encode())
+  for thread in system.compile().threads:
+    for array in thread.stage_arrays():
+      for start in range(0, len(array), STAGE_TABLE_MEMORY_ROWS):
+        digest.update(np.ascontiguousarray(array[start:start + STAGE_TABLE_MEMORY_ROWS], dtype='<f8').tobytes())
+  return digest.hexdigest()
+
+class ResultCache:
+  def __init__(self, directory, max_bytes=2**30):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    os.makedirs(directory, exist_ok=True)
+
+  def _entry(self, key):
+    return os.path.join(self.directory, key)
+
+  def profile(self, system, sim_time_sec, record_time_history=False, use_hyperperiod=False, history=None, stop_at_empty=False,
+              split_sources=False):
+    # Same as system.power_profile, leaving the system as that run would and returning its summary, but taken
+    # from the cache when the same run was stored before. Runs drawing clouds from np.random are not cached.
+    if any(source.energy_harvesting is not None and source.energy_harvesting.rng is None for source in system.sources):
+      print("Note: solar panels without a seed give a different run every time, running without the cache")
+      system.power_profile(sim_time_sec, record_time_history=record_time_history, use_hyperperiod=use_hyperperiod, history=history,
+                           stop_at_empty=stop_at_empty, split_sources=split_sources)
+      return system.summary()
+    if history is None and record_time_history:
+      history = HistoryPolicy()
+    policy = None if history is None else (history.dtype.str, history.keep_every, history.bucket_sec)
+    key = config_hash(system, sim_time_sec, history=policy, use_hyperperiod=use_hyperperiod, stop_at_empty=stop_at_empty,
+                      split_sources=split_sources)
+    if self._load(key, system, history is not None):
+      self.hits = self.hits + 1
+      return system.summary()
+
+    self.misses = self.misses + 1
+    system.power_profile(sim_time_sec, use_hyperperiod=use_hyperperiod, history=history, stop_at_empty=stop_at_empty,
+                         split_sources=split_sources)
+    self._store(key, system, history is not None)
+    return system.summary()
+
+  def _load(self, key, system, recorded):
+    entry = self._entry(key)
+    try:
+      with open(os.path.join(entry, CACHE_SNAPSHOT), 'rb') as f:
+        snapshot = f.read()
+      histories = load_history(entry) if recorded else None
+      os.utime(entry)
+    except OSError:
+      # Missing, or removed by another process while being read
+      return False
+    system.restore(snapshot)
+    if histories is not None:
+      # The snapshot already holds the run's totals, the histories are only attached
+      for s, source in enumerate(system.sources):
+        system._attach_history(source, histories.get("source_{0}".format(s)), histories.get("source_{0}_harvesting".format(s)))
+    return True
+
+  def _store(self, key, system, recorded):
+    temp_entry = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+    with open(os.path.join(temp_entry, CACHE_SNAPSHOT), 'wb') as f:
+      f.write(system.snapshot())
+    if recorded:
+      save_history(temp_entry, system._histories())
+    try:
+      os.rename(temp_entry, self._entry(key))
+    except OSError:
+      # Another process stored the same run first
+      shutil.rmtree(temp_entry, ignore_errors=True)
+    self._evict(keep=key)
+
+  def entries(self):
+    # (key, bytes, last used time) of every stored entry, least recently used first
+    entries = []
+    for entry in os.scandir(self.directory):
+      if entry.name.startswith(".") or not entry.is_dir():
+        continue
+      try:
+        size = sum(f.stat().st_size for f in os.scandir(entry.path))
+        entries.append((entry.name, size, entry.stat().st_mtime))
+      except OSError:
+        continue
+    return sorted(entries, key=lambda entry: entry[2])
+
+  def _evict(self, keep=None):
+    entries = self.entries()
+    total_bytes = sum(size for key, size, used_t in entries)
+    for key, size, used_t in entries:
+      if total_bytes <= self.max_bytes:
+        break
+      if key == keep:
+        continue
+      self._remove(key)
+      total_bytes = total_bytes - size
+
+  def _remove(self, key):
+    # Renamed away first, so readers see either the whole entry or none of it
+    temp_entry = os.path.join(self.directory, ".tmp-remove-{0}-{1}".format(os.getpid(), key))
+    try:
+      os.rename(self._entry(key), temp_entry)
+    except OSError:
+      return
+    shutil.rmtree(temp_entry, ignore_errors=True)
+
+  def clear(self):
+    for key, size, used_t in self.entries():
+      self._remove(key)
+
+######### System Specifications #########
+# A system can be described by a JSON or TOML spec instead of a script. Components and threads are defined
+# once by key under "components" and "threads", in the spec itself or in the files it lists under "include",
+# and referenced by key wherever they are used, next to entries written out in place. The spec's own
+# definitions take precedence over included ones. A thread given by key takes the key as its name unless it
+# names itself.
+#
+#   spec_version = 1
+#   include = ["common.toml"]
+#
+#   [components.mcu_active]
+#   name = "MCU"
+#   mode_name = "Active"
+#   current_ma = 3.0
+#
+#   [threads.report]
+#   stages = [{delta_t_sec = 0.05, components = ["mcu_active"]},
+#             {delta_t_sec = 1799.95, components = [{name = "MCU", mode_name = "Sleep", current_ma = 0.0008}]}]
+#
+#   [system]
+#   name = "Sensor node"
+#   [[system.sources]]
+#   type = "LithiumCoinCellBattery"
+#   name = "CR2032"
+#   number_cells = 1
+#   capacity_mAh = 210.0
+#   initial_charge_mAh = 210.0
+#   internal_resistance_ohm = 60.0
+#   regulators = [{name = "1.8V Rail", output_voltage = 1.8, is_switching = false, quiescent_current_ma = 0.000025,
+#                  threads = ["report"]}]
+#
+# Optional entries may be left out, or given as null in JSON. A regulator's efficiency is a number or a table
+# of EfficiencyCurve arguments, a source may give its own ocv_curve as a table of OCVCurve arguments and its
+# energy_harvesting as a table of SolarPanel arguments, and a thread may be {"trace": {...}} with the
+# TraceThread arguments, its filename relative to the spec. Source types are looked up in SPEC_SOURCE_TYPES.
+#
+# SpecLoader caches each built system under a hash of the spec file, and in a shared directory keeps the merged
+# spec as JSON. The entry records the hashes of the included files and traces it was built from and is used
+# only while they still match, so loading an unchanged variant again skips reading and merging its files, and
+# within one loader also validation and building.
+
+SPEC_VERSION = 1
+SPEC_SOURCE_TYPES = {'Source': Source, 'LithiumIonBattery': LithiumIonBattery, 'LithiumCoinCellBattery': LithiumCoinCellBattery}
+
+# Entries of every kind of table: name -> (kinds, required). 'number' takes ints and floats, None is null.
+_SPEC_FIELDS = {
+  'spec': {'spec_version': (('int',), False), 'include': (('list',), False), 'components': (('dict',), False),
+           'threads': (('dict',), False), 'system': (('dict',), True)},
+  'component': {'name': (('str',), True), 'mode_name': (('str',), True), 'current_ma': (('number',), True)},
+  'thread': {'name': (('str',), False), 'stages': (('list',), True)},
+  'trace': {'name': (('str',), True), 'filename': (('str',), True), 'sample_period_sec': (('number',), True), 'dtype': (('str',), False),
+            'scale_ma': (('number',), False), 'tolerance_ma': (('number', None), False), 'start_sample': (('int',), False),
+            'num_samples': (('int', None), False)},
+  'stage': {'delta_t_sec': (('number',), True), 'components': (('list',), True)},
+  'system': {'name': (('str',), True), 'sources': (('list',), True)},
+  'source': {'type': (('str',), True), 'name': (('str',), True), 'number_cells': (('int',), True), 'capacity_mAh': (('number',), True),
+             'initial_charge_mAh': (('number',), True), 'internal_resistance_ohm': (('number',), True), 'regulators': (('list',), True),
+             'energy_harvesting': (('dict', None), False), 'ocv_curve': (('dict', None), False), 'solve_voltage': (('bool',), False)},
+  'regulator': {'name': (('str',), True), 'output_voltage': (('number',), True), 'quiescent_current_ma': (('number',), True),
+                'is_switching': (('bool',), True), 'efficiency': (('number', 'dict'), False), 'max_current_output_ma': (('number', None), False),
+                'dropout_voltage': (('number', None), False), 'threads': (('list',), True)},
+  'panel': {'rated_power_W': (('number',), True), 'charge_efficiency': (('number',), False), 't_offset_sec': (('number',), False),
+            'clouds_tau': (('number',), False), 'clouds_cover': (('number',), False), 'seed': (('int', None), False),
+            'step_sec': (('number', None), False)},
+  'ocv_curve': {'soc_table': (('list',), True), 'cell_voltage_table': (('list',), True)},
+  'efficiency_curve': {'load_ma_table': (('list',), True), 'efficiency_table': (('list',), True), 'input_voltage_table': (('list', None), False)},
+}
+
+def _spec_kind(value, kind):
+  if kind is None:
+    return value is None
+  if kind == 'number':
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+  if kind == 'int':
+    return isinstance(value, int) and not isinstance(value, bool)
+  return isinstance(value, {'str': str, 'bool': bool, 'list': list, 'dict': dict}[kind])
+
+def _check_fields(errors, path, entry, table):
+  # Checks the entry is a table of known entries of the right kinds, returns False when it is not a table
+  if not isinstance(entry, dict):
+    errors.append("{0}: expected a table".format(path))
+    return False
+  fields = _SPEC_FIELDS[table]
+  for name in entry:
+    if name not in fields:
+      errors.append("{0}: unknown entry {1}".format(path, name))
+  for name, (kinds, required) in fields.items():
+    if name not in entry:
+      if required:
+        errors.append("{0}: missing {1}".format(path, name))
+    elif not any(_spec_kind(entry[name], kind) for kind in kinds):
+      errors.append("{0}.{1}: expected {2}".format(path, name, " or ".join("null" if kind is None else kind for kind in kinds)))
+  return True
+
+def _check_positive(errors, path, entry, names, allow_zero=False):
+  for name in names:
+    value = entry.get(name)
+    if _spec_kind(value, 'number') and (value < 0.0 if allow_zero else value <= 0.0):
+      errors.append("{0}.{1}: must be {2}".format(path, name, "at least 0" if allow_zero else "positive"))
+
+def _check_constructor(errors, path, cls, arguments):
+  # Tables passed straight to a constructor are checked by building them
+  try:
+    cls(**arguments)
+  except (ValueError, TypeError) as e:
+    errors.append("{0}: {1}".format(path, e))
+
+def _read_bytes(path):
+  with open(path, 'rb') as f:
+    return f.read()
+
+def _parse_spec(filename, data):
+  # TOML for a .toml file and JSON otherwise
+  if filename.lower().endswith('.toml'):
+    if tomllib is None:
+      raise ValueError("Reading {0} needs tomllib, Python 3.11 or later, or the tomli package".format(filename))
+    try:
+      return tomllib.loads(data.decode('utf-8'))
+    except (tomllib.TOMLDecodeError, UnicodeDecodeError) as e:
+      raise ValueError("{0}: {1}".format(filename, e))
+  try:
+    return json.loads(data)
+  except ValueError as e:
+    raise ValueError("{0}: {1}".format(filename, e))
+
+def _read_spec_files(filename, read, stack=()):
+  # The spec with its included libraries merged in, and the absolute paths of every file read. read(path)
+  # returns a file's bytes.
+  path = os.path.abspath(filename)
+  if path in stack:
+    raise ValueError("{0}: includes itself through {1}".format(filename, " -> ".join(stack)))
+  spec = _parse_spec(path, read(path))
+  if not isinstance(spec, dict):
+    raise ValueError("{0}: expected a table".format(filename))
+  files = [path]
+  includes = spec.get('include', [])
+  if not isinstance(includes, list) or not all(isinstance(include, str) for include in includes):
+    raise ValueError("{0}: include must be a list of file names".format(filename))
+  merged = {'components': {}, 'threads': {}}
+  for include in includes:
+    library, library_files = _read_spec_files(os.path.join(os.path.dirname(path), include), read, stack + (path,))
+    files.extend(library_files)
+    for table in ('components', 'threads'):
+      if not isinstance(library.get(table, {}), dict):
+        raise ValueError("{0}: {1} must be a table".format(include, table))
+      merged[table].update(library.get(table, {}))
+  spec = dict(spec)
+  spec.pop('include', None)
+  for table in ('components', 'threads'):
+    own = spec.get(table, {})
+    if isinstance(own, dict):
+      merged[table].update(own)
+      spec[table] = merged[table]
+  spec['base_dir'] = os.path.dirname(path)
+  return spec, files
+
+def _trace_path(spec, trace):
+  return os.path.join(spec.get('base_dir', ""), trace['filename'])
+
+def _spec_traces(spec):
+  # Trace files used by the spec's threads, for hashing alongside its files
+  paths = []
+  for thread in _spec_thread_entries(spec):
+    if isinstance(thread, dict) and isinstance(thread.get('trace'), dict) and isinstance(thread['trace'].get('filename'), str):
+      paths.append(os.path.abspath(_trace_path(spec, thread['trace'])))
+  return paths
+
+def _spec_thread_entries(spec):
+  system = spec.get('system') if isinstance(spec.get('system'), dict) else {}
+  for source in system.get('sources') or []:
+    for regulator in (source.get('regulators') or [] if isinstance(source, dict) else []):
+      for thread in (regulator.get('threads') or [] if isinstance(regulator, dict) else []):
+        yield thread
+
+def validate_spec(spec):
+  # Every problem found in a spec with its includes merged, as "path: message", empty when it is valid
+  errors = []
+  if not isinstance(spec, dict):
+    return ["spec: expected a table"]
+  if not _check_fields(errors, "spec", {name: value for name, value in spec.items() if name != 'base_dir'}, 'spec'):
+    return errors
+  if 'include' in spec:
+    errors.append("spec.include: included files are merged by read_spec")
+  if spec.get('spec_version', SPEC_VERSION) != SPEC_VERSION:
+    errors.append("spec.spec_version: version {0} is not supported".format(spec['spec_version']))
+  components = spec.get('components') if isinstance(spec.get('components'), dict) else {}
+  threads = spec.get('threads') if isinstance(spec.get('threads'), dict) else {}
+
+  def check_component(path, component):
+    if isinstance(component, str):
+      if component not in components:
+        errors.append("{0}: no component {1}".format(path, component))
+    elif _check_fields(errors, path, component, 'component'):
+      _check_positive(errors, path, component, ['current_ma'], allow_zero=True)
+
+  def check_thread(path, thread):
+    if isinstance(thread, str):
+      if thread not in threads:
+        errors.append("{0}: no thread {1}".format(path, thread))
+      return
+    if isinstance(thread, dict) and 'trace' in thread:
+      if len(thread) != 1:
+        errors.append("{0}: a trace thread has only the trace entry".format(path))
+      trace = thread['trace']
+      if _check_fields(errors, path + ".trace", trace, 'trace'):
+        _check_positive(errors, path + ".trace", trace, ['sample_period_sec', 'tolerance_ma'])
+        if isinstance(trace.get('filename'), str) and not os.path.isfile(_trace_path(spec, trace)):
+          errors.append("{0}.trace.filename: no file {1}".format(path, _trace_path(spec, trace)))
+      return
+    if not _check_fields(errors, path, thread, 'thread') or not isinstance(thread.get('stages'), list):
+      return
+    if len(thread['stages']) == 0:
+      errors.append("{0}.stages: needs at least one stage".format(path))
+    for i, stage in enumerate(thread['stages']):
+      stage_path = "{0}.stages[{1}]".format(path, i)
+      if _check_fields(errors, stage_path, stage, 'stage'):
+        _check_positive(errors, stage_path, stage, ['delta_t_sec'])
+        for j, component in enumerate(stage.get('components') if isinstance(stage.get('components'), list) else []):
+          check_component("{0}.components[{1}]".format(stage_path, j), component)
+
+  for key, component in components.items():
+    check_component("components.{0}".format(key), component)
+  for key, thread in threads.items():
+    if isinstance(thread, str):
+      errors.append("threads.{0}: a library thread cannot refer to another thread".format(key))
+    else:
+      check_thread("threads.{0}".format(key), thread)
+
+  system = spec.get('system')
+  if not isinstance(system, dict):
+    # Already reported with the spec's own entries
+    return errors
+  if not _check_fields(errors, "system", system, 'system') or not isinstance(system.get('sources'), list):
+    return errors
+  if len(system['sources']) == 0:
+    errors.append("system.sources: needs at least one source")
+  for s, source in enumerate(system['sources']):
+    source_path = "system.sources[{0}]".format(s)
+    if not _check_fields(errors, source_path, source, 'source'):
+      continue
+    source_type = SPEC_SOURCE_TYPES.get(source['type']) if isinstance(source.get('type'), str) else None
+    if isinstance(source.get('type'), str) and source_type is None:
+      errors.append("{0}.type: unknown source type {1}, expected one of {2}".format(source_path, source['type'], ", ".join(sorted(SPEC_SOURCE_TYPES))))
+    _check_positive(errors, source_path, source, ['number_cells', 'capacity_mAh'])
+    _check_positive(errors, source_path, source, ['initial_charge_mAh', 'internal_resistance_ohm'], allow_zero=True)
+    if isinstance(source.get('ocv_curve'), dict):
+      if _check_fields(errors, source_path + ".ocv_curve", source['ocv_curve'], 'ocv_curve'):
+        _check_constructor(errors, source_path + ".ocv_curve", OCVCurve, source['ocv_curve'])
+    elif source_type is not None and source_type.ocv_curve is None and not hasattr(source_type, 'soc_table'):
+      errors.append("{0}: a {1} needs an ocv_curve".format(source_path, source['type']))
+    if isinstance(source.get('energy_harvesting'), dict):
+      if _check_fields(errors, source_path + ".energy_harvesting", source['energy_harvesting'], 'panel'):
+        _check_constructor(errors, source_path + ".energy_harvesting", SolarPanel, source['energy_harvesting'])
+    for r, regulator in enumerate(source.get('regulators') if isinstance(source.get('regulators'), list) else []):
+      regulator_path = "{0}.regulators[{1}]".format(source_path, r)
+      if not _check_fields(errors, regulator_path, regulator, 'regulator'):
+        continue
+      _check_positive(errors, regulator_path, regulator, ['output_voltage'])
+      _check_positive(errors, regulator_path, regulator, ['quiescent_current_ma', 'max_current_output_ma', 'dropout_voltage'], allow_zero=True)
+      if isinstance(regulator.get('efficiency'), dict):
+        if _check_fields(errors, regulator_path + ".efficiency", regulator['efficiency'], 'efficiency_curve'):
+          _check_constructor(errors, regulator_path + ".efficiency", EfficiencyCurve, regulator['efficiency'])
+      else:
+        _check_positive(errors, regulator_path, regulator, ['efficiency'])
+      for t, thread in enumerate(regulator.get('threads') if isinstance(regulator.get('threads'), list) else []):
+        check_thread("{0}.threads[{1}]".format(regulator_path, t), thread)
+  return errors
+
+def build_system(spec):
+  # EmbeddedSystem described by a spec with its includes merged, raising ValueError listing every problem
+  errors = validate_spec(spec)
+  if errors:
+    raise ValueError("Invalid system spec:\n  " + "\n  ".join(errors))
+  components = spec.get('components', {})
+  threads = spec.get('threads', {})
+
+  def build_thread(entry, name=None):
+    # Every use builds its own Thread, since threads keep their run state
+    if isinstance(entry, str):
+      return build_thread(threads[entry], entry)
+    if 'trace' in entry:
+      trace = dict(entry['trace'])
+      trace['filename'] = _trace_path(spec, trace)
+      if 'dtype' in trace:
+        trace['dtype'] = np.dtype(trace['dtype'])
+      return TraceThread(**trace)
+    return Thread(name=entry.get('name', name), stages=[
+      Stage(delta_t_sec=stage['delta_t_sec'], components=[
+        Component(**(components[component] if isinstance(component, str) else component)) for component in stage['components']
+      ]) for stage in entry['stages']])
+
+  sources = []
+  for source in spec['system']['sources']:
+    regulators = []
+    for regulator in source['regulators']:
+      arguments = {name: value for name, value in regulator.items() if name != 'threads'}
+      if isinstance(arguments.get('efficiency'), dict):
+        arguments['efficiency'] = EfficiencyCurve(**arguments['efficiency'])
+      regulators.append(VoltageRegulator(threads=[build_thread(thread) for thread in regulator['threads']], **arguments))
+    arguments = {name: value for name, value in source.items() if name not in ('type', 'regulators')}
+    if arguments.get('ocv_curve') is not None:
+      arguments['ocv_curve'] = OCVCurve(**arguments['ocv_curve'])
+    if arguments.get('energy_harvesting') is not None:
+      arguments['energy_harvesting'] = SolarPanel(**arguments['energy_harvesting'])
+    sources.append(SPEC_SOURCE_TYPES[source['type']](regulators=regulators, **arguments))
+  return EmbeddedSystem(name=spec['system']['name'], sources=sources)
+
+def read_spec(filename):
+  # The spec in a file with its includes merged, raising ValueError when it cannot be parsed
+  spec, files = _read_spec_files(filename, _read_bytes)
+  return spec
+
+def load_system(filename):
+  # Reads, validates and builds the system in a spec file, without a cache
+  return build_system(read_spec(filename))
+
+class SpecLoader:
+  def __init__(self, directory=None):
+    # Built systems are kept in memory, and also in directory when given so other processes and later
+    # batches share them
+    self.directory = directory
+    self.hits = 0
+    self.misses = 0
+    self._entries = {}
+    self._file_hashes = {}
+    if directory is not None:
+      os.makedirs(directory, exist_ok=True)
+
+  def _file_hash(self, path):
+    # Hashes are kept while a file's size and modification time are unchanged, so shared libraries and
+    # traces are read once per loader
+    stat = os.stat(path)
+    known = self._file_hashes.get(path)
+    if known is not None and known[0] == (stat.st_size, stat.st_mtime_ns):
+      return known[1]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), b""):
+        digest.update(block)
+    self._file_hashes[path] = ((stat.st_size, stat.st_mtime_ns), digest.hexdigest())
+    return digest.hexdigest()
+
+  def _key(self, path):
+    return hashlib.sha256("{0}|{1}|{2}".format(SPEC_VERSION, path, self._file_hash(path)).encode()).hexdigest()
+
+  def _cached(self, key):
+    entry = self._entries.get(key)
+    if entry is None and self.directory is not None:
+      # Shared entries hold the merged spec as JSON rather than a pickled system, since anyone able to write the
+      # cache directory could otherwise run code here. The system is built from the spec again, which also
+      # rejects entries that are damaged.
+      try:
+        with open(os.path.join(self.directory, key + ".json"), 'rb') as f:
+          stored = json.loads(f.read())
+        entry = {'dependencies': [(path, file_hash) for path, file_hash in stored['dependencies']],
+                 'spec': stored['spec']}
+        entry['system'] = pickle.dumps(build_system(entry['spec']), protocol=pickle.HIGHEST_PROTOCOL)
+      except (OSError, ValueError, TypeError, KeyError):
+        entry = None
+    if entry is None:
+      return None
+    try:
+      if any(self._file_hash(path) != file_hash for path, file_hash in entry['dependencies']):
+        return None
+    except (OSError, TypeError):
+      return None
+    self._entries[key] = entry
+    return entry
+
+  def load(self, filename):
+    # A freshly built EmbeddedSystem for the spec file, raising ValueError when the spec is invalid
+    path = os.path.abspath(filename)
+    key = self._key(path)
+    entry = self._cached(key)
+    if entry is not None:
+      self.hits = self.hits + 1
+      return pickle.loads(entry['system'])
+
+    self.misses = self.misses + 1
+    spec, files = _read_spec_files(path, _read_bytes)
+    system = build_system(spec)
+    entry = {'dependencies': [(dependency, self._file_hash(dependency)) for dependency in files[1:] + _spec_traces(spec)],
+             'spec': spec, 'system': pickle.dumps(system, protocol=pickle.HIGHEST_PROTOCOL)}
+    self._entries[key] = entry
+    if self.directory is not None:
+      # Written aside and renamed into place, so other processes never read a partial entry
+      handle, temp_path = tempfile.mkstemp(prefix=".tmp-", dir=self.directory)
+      with os.fdopen(handle, 'w') as f:
+        json.dump({'dependencies': entry['dependencies'], 'spec': spec}, f)
+      os.replace(temp_path, os.path.join(self.directory, key + ".json"))
+    return system
+
+  def validate(self, filename):
+    # Problems in the spec file as validate_spec gives them, empty for a spec that is cached or valid
+    path = os.path.abspath(filename)
+    try:
+      if self._cached(self._key(path)) is not None:
+        return []
+      spec, files = _read_spec_files(path, _read_bytes)
+    except (OSError, ValueError) as e:
+      return [str(e)]
+    return validate_spec(spec)
+
+  def clear(self):
+    self._entries = {}
+    self._file_hashes = {}
+    if self.directory is not None:
+      for entry in os.scandir(self.directory):
+        if entry.name.endswith(".json"):
+          try:
+            os.remove(entry.path)
+          except OSError:
+            pass
+
+######### Parameter Sweeps #########
+# Parameters are addressed by paths from the system, such as "sources[0].capacity_mAh" or
+# "sources[CR2032].regulators[1.8V Rail].threads[Barometer].stages[2].delta_t_sec". A selector in brackets
+# is either a list index or the name of a list entry.
+
+_PATH_TOKEN = re.compile(r"(?:^|\.)([A-Za-z_]\w*)|\[([^\]]*)\]")
+
+def _resolve_path(system, path, extra_attributes=()):
+  # Walks the path and returns the object holding the final attribute along with that attribute's name.
+  # Names in extra_attributes are accepted without the object having them.
+  steps = []
+  position = 0
+  while position < len(path):
+    match = _PATH_TOKEN.match(path, position)
+    if match is None:
+      raise ValueError("Invalid parameter path {0}".format(path))
+    steps.append(match.groups())
+    position = match.end()
+  if len(steps) == 0 or steps[-1][0] is None:
+    raise ValueError("Parameter path {0} does not end in an attribute".format(path))
+  obj = system
+  for name, selector in steps[:-1]:
+    if name is not None:
+      if not hasattr(obj, name):
+        raise ValueError("Parameter path {0} has no attribute {1}".format(path, name))
+      obj = getattr(obj, name)
+    elif selector.lstrip('-').isdigit():
+      obj = obj[int(selector)]
+    else:
+      matches = [entry for entry in obj if getattr(entry, 'name', None) == selector]
+      if len(matches) != 1:
+        raise ValueError("Parameter path {0} does not select exactly one entry named {1}".format(path, selector))
+      obj = matches[0]
+  if steps[-1][0] not in extra_attributes and not hasattr(obj, steps[-1][0]):
+    raise ValueError("Parameter path {0} has no attribute {1}".format(path, steps[-1][0]))
+  return obj, steps[-1][0]
+
+def get_parameter(system, path):
+  obj, name = _resolve_path(system, path)
+  return getattr(obj, name)
+
+def set_parameter(system, path, value):
+  obj, name = _resolve_path(system, path)
+  setattr(obj, name, value)
+
+def _axis_paths(axis):
+  # A sweep axis is a single path or a tuple of paths that are all set to the same value
+  return (axis,) if isinstance(axis, str) else tuple(axis)
+
+def _axis_label(axis):
+  return ", ".join(_axis_paths(axis))
+
+def _run_sweep_point(system, assignments, sim_time_sec, use_hyperperiod, cache=None):
+  # Runs on a private copy, since threads, sources and solar panels carry run state
+  system = copy.deepcopy(system)
+  for axis, value in assignments:
+    for path in _axis_paths(axis):
+      set_parameter(system, path, value)
+  system.reset()
+  if cache is not None:
+    summary = cache.profile(system, sim_time_sec, use_hyperperiod=use_hyperperiod)
+  else:
+    system.power_profile(sim_time_sec, use_hyperperiod=use_hyperperiod)
+    summary = system.summary()
+  battery_lives = [source['battery_life_sec'] for source in summary['sources'] if source['battery_life_sec'] is not None]
+  row = {_axis_label(axis): value for axis, value in assignments}
+  row['lifetime_sec'] = min(battery_lives) if len(battery_lives) > 0 else None
+  row['final_soc_pct'] = min(source['soc_pct'] for source in summary['sources'])
+  row['peak_current_mA'] = summary['peak_current_mA']
+  return row
+
+def _run_cached_sweep_point(system, assignments, sim_time_sec, use_hyperperiod, cache):
+  # A worker process runs on a copy of the cache, so the hits and misses it counts are sent back with the row
+  hits, misses = cache.hits, cache.misses
+  row = _run_sweep_point(system, assignments, sim_time_sec, use_hyperperiod, cache)
+  return row, cache.hits - hits, cache.misses - misses
+
+def sweep(system, axes, sim_time_sec, use_hyperperiod=False, processes=None, cache=None):
+  # Runs every combination of the axes values, given as {path or tuple of paths: values}, across a process
+  # pool and returns one row per point with the lifetime, lowest final state of charge and peak current.
+  # With a ResultCache, points that were run before are taken from it, and its hits and misses count the
+  # points run in the worker processes as well.
+  axes = list(axes.items())
+  points = [list(zip([axis for axis, values in axes], combination)) for combination in itertools.product(*[values for axis, values in axes])]
+  if processes == 1:
+    return [_run_sweep_point(system, point, sim_time_sec, use_hyperperiod, cache) for point in points]
+  with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+    if cache is None:
+      futures = [executor.submit(_run_sweep_point, system, point, sim_time_sec, use_hyperperiod) for point in points]
+      return [future.result() for future in futures]
+    futures = [executor.submit(_run_cached_sweep_point, system, point, sim_time_sec, use_hyperperiod, cache) for point in points]
+    rows = []
+    for future in futures:
+      row, hits, misses = future.result()
+      cache.hits = cache.hits + hits
+      cache.misses = cache.misses + misses
+      rows.append(row)
+    return rows
+
+def _lifetime_at(system, path, value, max_time_sec, use_hyperperiod):
+  system = copy.deepcopy(system)
+  for axis_path in _axis_paths(path):
+    set_parameter(system, axis_path, value)
+  system.reset()
+  lifetime_sec = system.time_to_empty(max_time_sec, use_hyperperiod=use_hyperperiod)
+  return lifetime_sec if lifetime_sec is not None else max_time_sec
+
+def solve_parameter(system, path, target_lifetime_sec, low, high, rtol=1.0e-3, max_iterations=40, max_time_sec=None, use_hyperperiod=True):
+  # Finds the value of the parameter at path (or tuple of paths) between low and high for which
+  # time_to_empty hits target_lifetime_sec. Lifetime must change monotonically with the parameter. The
+  # bracket is narrowed by false position with the Illinois correction, which keeps bisection's guarantee
+  # but needs far fewer runs when lifetime is close to linear in the parameter, as it is for capacity.
+  if max_time_sec is None:
+    max_time_sec = 2.0*target_lifetime_sec
+  if target_lifetime_sec >= max_time_sec:
+    raise ValueError("max_time_sec must be longer than target_lifetime_sec")
+  evaluations = []
+  low_error = _lifetime_at(system, path, low, max_time_sec, use_hyperperiod) - target_lifetime_sec
+  high_error = _lifetime_at(system, path, high, max_time_sec, use_hyperperiod) - target_lifetime_sec
+  evaluations.extend([(low, low_error + target_lifetime_sec), (high, high_error + target_lifetime_sec)])
+  if low_error*high_error > 0.0:
+    raise ValueError("Target lifetime is not between the lifetimes at {0}={1} and {0}={2}".format(_axis_label(path), low, high))
+
+  value, error = (low, low_error) if abs(low_error) < abs(high_error) else (high, high_error)
+  side = 0
+  for iteration in range(max_iterations):
+    if abs(error) <= rtol*target_lifetime_sec:
+      break
+    value = high - high_error*(high - low)/(high_error - low_error)
+    error = _lifetime_at(system, path, value, max_time_sec, use_hyperperiod) - target_lifetime_sec
+    evaluations.append((value, error + target_lifetime_sec))
+    if error*high_error > 0.0:
+      high, high_error = value, error
+      if side == -1:
+        low_error = 0.5*low_error
+      side = -1
+    else:
+      low, low_error = value, error
+      if side == 1:
+        high_error = 0.5*high_error
+      side = 1
+  return {'value': value, 'lifetime_sec': error + target_lifetime_sec, 'converged': abs(error) <= rtol*target_lifetime_sec,
+          'evaluations': evaluations}
+
+######### Fleet Simulation #########
+# A fleet is many devices built from one system that differ only in a few parameters, given per device as
+# arrays addressed by parameter paths. As in monte_carlo, time is cut into steps of step_sec and every device
+# is advanced through them together, with the state of charge and clouds held as arrays over devices.
+#
+# The load does not depend on the state of charge, so it is computed ahead for blocks of steps. Each thread's
+# charge over a step is integrated exactly from its cycle, shifted by the device's phase_sec, the time into
+# its cycle a thread is at time zero. Switching regulators use the same series expansion as monte_carlo,
+# with threads that share a regulator combined as if uncorrelated within the step. A brown-out is a step in
+# which the voltage at the step's peak load, every thread on its highest stage within the step at once,
+# falls below a regulator's dropout.
+
+FLEET_PARAMETERS = (
+  (Source, ('initial_charge_mAh', 'capacity_mAh', 'internal_resistance_ohm')),
+  (SolarPanel, ('rated_power_W', 't_offset_sec', 'charge_efficiency')),
+  (Thread, ('phase_sec',)),
+)
+# Steps times devices computed ahead at once
+FLEET_BLOCK_SIZE = 1000000
+
+def _fleet_arrays(system, compiled, parameters, num_devices):
+  # Per device values keyed by (object id, attribute), checked against the parameters a fleet may vary
+  values = {}
+  owners = [(source, id(source)) for source in compiled.sources] + \
+           [(source.energy_harvesting, id(source.energy_harvesting)) for source in compiled.sources if source.energy_harvesting is not None] + \
+           [(thread, id(thread)) for thread in compiled.threads]
+  owner_ids = set(owner_id for owner, owner_id in owners)
+  for path, value in parameters.items():
+    obj, name = _resolve_path(system, path, extra_attributes=('phase_sec',))
+    if id(obj) not in owner_ids or not any(isinstance(obj, kind) and name in names for kind, names in FLEET_PARAMETERS):
+      raise ValueError("Parameter {0} cannot vary across a fleet".format(path))
+    value = np.asarray(value, dtype=np.float64)
+    if value.ndim == 0:
+      value = np.full(num_devices, float(value))
+    elif value.shape != (num_devices,):
+      raise ValueError("Parameter {0} has {1} values for {2} devices".format(path, value.size, num_devices))
+    values[(id(obj), name)] = value
+  def get(obj, name):
+    if (id(obj), name) in values:
+      return values[(id(obj), name)]
+    return np.full(num_devices, float(getattr(obj, name, 0.0)))
+  return get
+
+def _thread_cycle_integrals(u, knots, cumulative, cycle_time_sec):
+  # Integral of a thread's current raised to some power from the start of its cycle up to time u
+  cycles = np.floor(u / cycle_time_sec)
+  return cycles*cumulative[-1] + np.interp(u - cycles*cycle_time_sec, knots, cumulative)
+
+def _fleet_load_block(compiled, threads, edges, phase_sec, num_devices):
+  # For steps between edges returns, per regulator, the output charge moments in mA^k*s for k = 1, 2, 3 and
+  # the peak output current, each as steps by devices
+  durations = np.diff(edges)[:, None]
+  num_regulators = len(compiled.regulators)
+  shape = (len(edges) - 1, num_devices)
+  means = [[] for r in range(num_regulators)]
+  peak_ma = [np.zeros(shape) for r in range(num_regulators)]
+  for i, (regulator, knots, cumulatives, cycle_time_sec, stage_starts, stage_durations, stage_currents) in enumerate(threads):
+    u = edges[:, None] + phase_sec[i][None, :]
+    # Mean of the current, its square and cube over each step
+    means[regulator].append([np.diff(_thread_cycle_integrals(u, knots, cumulative, cycle_time_sec), axis=0)/np.maximum(durations, 1.0e-12)
+                             for cumulative in cumulatives])
+    # Highest stage the thread is in at any time within each step
+    step_start = np.mod(u[:-1], cycle_time_sec)
+    thread_peak_ma = np.zeros(shape)
+    for start, duration, current_ma in zip(stage_starts, stage_durations, stage_currents):
+      within = (np.mod(start - step_start, cycle_time_sec) < durations) | (np.mod(step_start - start, cycle_time_sec) < duration)
+      thread_peak_ma = np.maximum(thread_peak_ma, np.where(within, current_ma, 0.0))
+    peak_ma[regulator] = peak_ma[regulator] + thread_peak_ma
+
+  moments = []
+  for r in range(num_regulators):
+    # Cumulants add over uncorrelated threads, and give the moments of their summed current
+    k1 = sum((a for a, b, c in means[r]), np.zeros(shape))
+    k2 = sum((b - a*a for a, b, c in means[r]), np.zeros(shape))
+    k3 = sum((c - 3.0*a*b + 2.0*a*a*a for a, b, c in means[r]), np.zeros(shape))
+    moments.append((durations*k1, durations*(k2 + k1*k1), durations*(k3 + 3.0*k2*k1 + k1*k1*k1)))
+  return moments, peak_ma
+
+def fleet_profile(system, parameters, sim_time_sec, num_devices=None, step_sec=60.0, seed=None, percentiles=(5, 25, 50, 75, 95)):
+  # Simulates a fleet of devices that are copies of system, except for the parameters given per device as
+  # {path: array or scalar}. Sources may vary initial_charge_mAh, capacity_mAh and internal_resistance_ohm,
+  # solar panels rated_power_W, t_offset_sec and charge_efficiency, and threads phase_sec, such as
+  # "sources[0].regulators[0].threads[LED].phase_sec". Each device's panels draw independent clouds from
+  # generators spawned from seed. Returns the final state of charge, time at empty and first brown-out of
+  # every device and source, each device's lifetime until its first failure (inf if none), and percentiles.
+  if step_sec <= 0.0:
+    raise ValueError("step_sec must be positive")
+  sizes = set(np.size(value) for value in parameters.values() if np.ndim(value) > 0)
+  if num_devices is None:
+    if len(sizes) == 0:
+      raise ValueError("num_devices is needed when no parameter is given per device")
+    num_devices = max(sizes)
+  if num_devices < 1:
+    raise ValueError("num_devices must be at least 1")
+  compiled = system.compile()
+  sources = compiled.sources
+  for regulator, curve in zip(compiled.regulators, compiled.regulator_efficiency_curve):
+    if curve is not None:
+      raise ValueError("Regulator {0} has an efficiency curve, which a fleet cannot follow".format(regulator.name))
+  solved = [source.name for source in sources if source.solve_voltage]
+  if len(solved) > 0:
+    print("Note: fleet_profile cannot solve the voltage of {0}, each regulator sags its source by its own current instead".format(", ".join(solved)))
+  parameter = _fleet_arrays(system, compiled, parameters, num_devices)
+
+  threads = []
+  phase_sec = []
+  for i, thread in enumerate(compiled.threads):
+    stage_durations = compiled.stage_delta_t_sec[compiled.thread_stages(i)]
+    stage_currents = compiled.stage_current_ma[compiled.thread_stages(i)]
+    knots = np.concatenate([[0.0], np.cumsum(stage_durations)])
+    cumulatives = [np.concatenate([[0.0], np.cumsum(stage_durations*stage_currents**k)]) for k in (1, 2, 3)]
+    threads.append((compiled.thread_regulator[i], knots, cumulatives, knots[-1], knots[:-1], stage_durations, stage_currents))
+    phase_sec.append(parameter(thread, 'phase_sec'))
+
+  panels = [source.energy_harvesting for source in sources]
+  generators = [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(len(sources))]
+  capacity_mAh = [parameter(source, 'capacity_mAh') for source in sources]
+  resistance_ohm = [parameter(source, 'internal_resistance_ohm') for source in sources]
+  charge_mAh = [np.minimum(parameter(source, 'initial_charge_mAh'), capacity_mAh[s]) for s, source in enumerate(sources)]
+  panel_scale = [parameter(panel, 'rated_power_W')/panel.rated_power_W if panel is not None else None for panel in panels]
+  panel_shift_sec = [parameter(panel, 't_offset_sec') - panel.t_offset_sec if panel is not None else None for panel in panels]
+  panel_efficiency = [parameter(panel, 'charge_efficiency') if panel is not None else None for panel in panels]
+  random_walk = [np.zeros(num_devices) for source in sources]
+  time_at_empty_sec = [np.full(num_devices, np.inf) for source in sources]
+  brownout_t_sec = [np.full(num_devices, np.inf) for source in sources]
+  quiescent_ma = [float(np.sum(compiled.regulator_quiescent_current_ma[compiled.source_regulator_start[s]:compiled.source_regulator_start[s+1]]))
+                  for s in range(len(sources))]
+  min_input_voltage = [source.min_input_voltage() for source in sources]
+
+  num_bins = max(int(math.ceil(sim_time_sec / step_sec)), 1)
+  edges = np.minimum(np.arange(num_bins + 1)*step_sec, sim_time_sec)
+  block_bins = max(FLEET_BLOCK_SIZE // num_devices, 1)
+  last_t = 0.0
+  for block_start in range(0, num_bins, block_bins):
+    block_edges = edges[block_start:min(block_start + block_bins, num_bins) + 1]
+    moments, peak_ma = _fleet_load_block(compiled, threads, block_edges, phase_sec, num_devices)
+    for j in range(len(block_edges) - 1):
+      step_start_t = block_edges[j]
+      step_end_t = block_edges[j + 1]
+      duration_sec = step_end_t - step_start_t
+      for s, source in enumerate(sources):
+        charge = charge_mAh[s]
+        cell_voltage = source.ocv_curve.cell_voltage((charge / capacity_mAh[s])*100.0)
+        drop_per_ma = resistance_ohm[s]*0.001
+
+        # Load charge in mA*s, as in monte_carlo, and the source current at the step's peak load
+        load_mAs = quiescent_ma[s]*duration_sec
+        peak_source_ma = quiescent_ma[s]
+        inverse_cell_voltage = 1.0/cell_voltage
+        for r in range(compiled.source_regulator_start[s], compiled.source_regulator_start[s+1]):
+          m1, m2, m3 = moments[r][0][j], moments[r][1][j], moments[r][2][j]
+          regulator_peak_ma = peak_ma[r][j]
+          if compiled.regulator_is_switching[r]:
+            conversion = compiled.regulator_output_voltage[r] / (source.number_cells * compiled.regulator_efficiency[r])
+            load_mAs = load_mAs + conversion*inverse_cell_voltage*(m1 + inverse_cell_voltage*drop_per_ma*(m2 + inverse_cell_voltage*drop_per_ma*m3))
+            peak_source_ma = peak_source_ma + conversion*regulator_peak_ma/(cell_voltage - drop_per_ma*regulator_peak_ma)
+          else:
+            load_mAs = load_mAs + m1
+            peak_source_ma = peak_source_ma + regulator_peak_ma
+
+        browned_out = (source.number_cells*(cell_voltage - drop_per_ma*peak_source_ma) < min_input_voltage[s]) & np.isinf(brownout_t_sec[s])
+        if browned_out.any():
+          brownout_t_sec[s][browned_out] = step_start_t
+        start_charge = charge.copy()
+
+        panel = panels[s]
+        if panel is not None:
+          f = np.exp(-(step_end_t - last_t)/panel.clouds_tau)
+          random_walk[s] = f*random_walk[s] + np.sqrt(1.0-f**2.0) * generators[s].standard_normal(num_devices)
+          cloud_factor = np.where(np.abs(random_walk[s]) > panel.clouds_cover, 0.1, 1.0)
+          clear_sky_J = panel_scale[s]*panel.clear_sky_energy(step_start_t + panel_shift_sec[s], step_end_t + panel_shift_sec[s])
+          mean_current_ma = load_mAs/duration_sec if duration_sec > 0.0 else 0.0
+          source_voltage = source.number_cells*(cell_voltage - drop_per_ma*mean_current_ma)
+          charge += np.where(charge < capacity_mAh[s], 0.277778*panel_efficiency[s]*cloud_factor*clear_sky_J/source_voltage, 0.0)
+
+        charge -= 0.277778*0.001*load_mAs
+        np.minimum(charge, capacity_mAh[s], out=charge)
+
+        # Empty times are interpolated within the step
+        emptied = (start_charge > 0.0) & (charge <= 0.0) & np.isinf(time_at_empty_sec[s])
+        if emptied.any():
+          time_at_empty_sec[s][emptied] = step_end_t - duration_sec*(-charge[emptied]/(start_charge[emptied] - charge[emptied]))
+      last_t = step_end_t
+
+  lifetime_sec = np.full(num_devices, np.inf)
+  results = {'devices': num_devices, 'seed': seed, 'step_sec': step_sec, 'percentiles': list(percentiles), 'sources': []}
+  for s, source in enumerate(sources):
+    final_soc_pct = 100.0*charge_mAh[s]/capacity_mAh[s]
+    lifetime_sec = np.minimum(lifetime_sec, np.minimum(time_at_empty_sec[s], brownout_t_sec[s]))
+    results['sources'].append({
+      'name': source.name,
+      'final_soc_pct': final_soc_pct,
+      'time_at_empty_sec': time_at_empty_sec[s],
+      'brownout_t_sec': brownout_t_sec[s],
+      'final_soc_pct_percentiles': np.percentile(final_soc_pct, percentiles),
+      # Devices that never fail are inf, so take the nearest device rather than interpolating
+      'time_at_empty_sec_percentiles': np.percentile(time_at_empty_sec[s], percentiles, method='nearest'),
+      'brownout_t_sec_percentiles': np.percentile(brownout_t_sec[s], percentiles, method='nearest'),
+      'empty_fraction': float(np.mean(np.isfinite(time_at_empty_sec[s]))),
+      'brownout_fraction': float(np.mean(np.isfinite(brownout_t_sec[s]))),
+    })
+  results['lifetime_sec'] = lifetime_sec
+  results['lifetime_sec_percentiles'] = np.percentile(lifetime_sec, percentiles, method='nearest')
+  results['failed_fraction'] = float(np.mean(np.isfinite(lifetime_sec)))
+  return results
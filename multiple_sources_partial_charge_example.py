@@ -17,7 +17,7 @@
 
 import embedded_power_model as epm
 
-if __name__ == "__main__":
+def build_system():
 
     # First, define all threads. This is how we define which components are on, how much current
     # they need, and how long they are on in different modes. All threads are periodic and run forever
@@ -55,6 +55,11 @@ if __name__ == "__main__":
 
 
     this_sys = epm.EmbeddedSystem(name="Example with multiple sources and 1 charging", sources = [source_1, source_2])
+    return this_sys
+
+if __name__ == "__main__":
+
+    this_sys = build_system()
 
     
     this_sys.power_profile(sim_time_sec=3*86400.0, record_time_history=True)
@@ -0,0 +1,33 @@
+import embedded_power_model as epm
+
+def small_system(solar=False, seed=1, switching=True):
+    # Two threads on one rail of a Li-ion cell, optionally with a seeded solar panel
+    sensor = epm.Thread(name="Sensor", stages=[
+        epm.Stage(delta_t_sec=0.2, components=[epm.Component(name="Sensor", mode_name="On", current_ma=1.5)]),
+        epm.Stage(delta_t_sec=2.8, components=[epm.Component(name="Sensor", mode_name="Off", current_ma=0.01)])
+    ])
+    radio = epm.Thread(name="Radio", stages=[
+        epm.Stage(delta_t_sec=0.05, components=[epm.Component(name="Radio", mode_name="TX", current_ma=20.0)]),
+        epm.Stage(delta_t_sec=4.95, components=[epm.Component(name="Radio", mode_name="Sleep", current_ma=0.002)])
+    ])
+    regulator = epm.VoltageRegulator(name="3.3V Rail", output_voltage=3.3, threads=[sensor, radio], quiescent_current_ma=0.02,
+                                     is_switching=switching, efficiency=0.9, max_current_output_ma=100.0)
+    panel = epm.SolarPanel(rated_power_W=0.2, seed=seed, clouds_tau=600.0) if solar else None
+    source = epm.LithiumIonBattery(name="Cell", number_cells=1, regulators=[regulator], capacity_mAh=50.0, initial_charge_mAh=40.0,
+                                   internal_resistance_ohm=0.2, energy_harvesting=panel)
+    return epm.EmbeddedSystem(name="Small", sources=[source])
+
+def two_source_system(solar=True):
+    # Independent sources, each with its own rail and thread
+    sources = []
+    for i in range(2):
+        thread = epm.Thread(name="Node {0}".format(i), stages=[
+            epm.Stage(delta_t_sec=0.5 + 0.1*i, components=[epm.Component(name="Node", mode_name="Active", current_ma=10.0)]),
+            epm.Stage(delta_t_sec=9.5, components=[epm.Component(name="Node", mode_name="Sleep", current_ma=0.05)])
+        ])
+        regulator = epm.VoltageRegulator(name="Rail {0}".format(i), output_voltage=3.3, threads=[thread], quiescent_current_ma=0.02,
+                                         is_switching=True, efficiency=0.9)
+        panel = epm.SolarPanel(rated_power_W=0.3, seed=10 + i, t_offset_sec=3600.0*i) if solar else None
+        sources.append(epm.LithiumIonBattery(name="Cell {0}".format(i), number_cells=1, regulators=[regulator], capacity_mAh=100.0,
+                                             initial_charge_mAh=60.0, internal_resistance_ohm=0.05, energy_harvesting=panel))
+    return epm.EmbeddedSystem(name="Two sources", sources=sources)
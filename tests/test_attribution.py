@@ -0,0 +1,39 @@
+from systems import small_system
+
+def run(switching, sim_time_sec=3600.0):
+    system = small_system(switching=switching)
+    system.sources[0].internal_resistance_ohm = 0.0
+    system.power_profile(sim_time_sec)
+    return system
+
+def test_rows_add_up_to_the_run():
+    system = run(switching=False)
+    rows = system.attribution()
+    assert abs(sum(row['output_charge_mAh'] for row in rows) - system.sources[0].regulators[0].output_charge_mAh) < 1e-9
+    # A linear regulator passes its output current through
+    assert abs(sum(row['source_charge_mAh'] for row in rows) - system.sources[0].charge_out_mAh) < 1e-6
+    assert abs(sum(row['source_energy_J'] for row in rows) - system.sources[0].energy_out_J) < 1e-3*system.sources[0].energy_out_J
+
+def test_switching_rows_include_the_conversion_loss():
+    system = run(switching=True)
+    rows = system.attribution()
+    assert abs(sum(row['output_charge_mAh'] for row in rows) - system.sources[0].regulators[0].output_charge_mAh) < 1e-9
+    assert abs(sum(row['source_charge_mAh'] for row in rows) - system.sources[0].charge_out_mAh) < 1e-3*system.sources[0].charge_out_mAh
+    for row in rows:
+        assert abs(row['loss_energy_J'] - (row['source_energy_J'] - row['output_energy_J'])) < 1e-12
+
+def test_rows_per_mode_over_partial_cycles():
+    rows = run(switching=True, sim_time_sec=1000.1).attribution()
+    times = {(row['component'], row['mode']): row['time_sec'] for row in rows}
+    # 333 whole sensor cycles of 3 s plus 1.1 s, 200 radio cycles of 5 s plus 0.1 s
+    assert abs(times[('Sensor', 'On')] - (333*0.2 + 0.2)) < 1e-9
+    assert abs(times[('Sensor', 'Off')] - (333*2.8 + 0.9)) < 1e-9
+    assert abs(times[('Radio', 'TX')] - (200*0.05 + 0.05)) < 1e-9
+    assert abs(times[('Radio', 'Sleep')] - (200*4.95 + 0.05)) < 1e-9
+    assert times[(None, 'Quiescent')] == 1000.1
+
+def test_print_attribution_groups_rows(capsys):
+    run(switching=True).print_attribution(by=('component',))
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[1] == "Component, Source Charge (mAh), Share (%), Source Energy (J)"
+    assert [line.split(", ")[0] for line in lines[2:-1]] == ['Radio', 'Sensor', 'None']
@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+import benchmark
+
+def test_flatten_summary_keeps_numeric_leaves():
+    values = benchmark.flatten_summary({'name': "System", 'a': 1.0, 'b': {'c': [2.0, None], 'd': "text"}, 'e': None})
+    assert values == {'a': 1.0, 'b.c.0': 2.0, 'b.c.1': None, 'e': None}
+
+def test_compare():
+    golden = {'a': 1.0, 'b': 0.0, 'c': None, 'd': float('inf'), 'gone': 1.0}
+    worst, mismatches = benchmark.compare(golden, {'a': 1.0 + 1e-12, 'b': 1e-13, 'c': None, 'd': float('inf'), 'new': 1.0}, 1e-9, 1e-12)
+    assert worst == pytest.approx(1e-12)
+    assert mismatches == [('gone', 1.0, "missing"), ('new', "missing", 1.0)]
+    worst, mismatches = benchmark.compare({'a': 1.0, 'c': None}, {'a': 1.1, 'c': 0.0}, 1e-9, 1e-12)
+    assert [path for path, expected, actual in mismatches] == ['a', 'c']
+    assert worst == pytest.approx(0.1)
+
+@pytest.mark.parametrize('engine', ['step', 'step_python'])
+def test_cases_match_the_golden_values(engine, tmp_path, capsys):
+    results_file = str(tmp_path / "results.json")
+    assert benchmark.main(["--cases", "nanosleeper", "many_sources", "--engine", engine, "--no-memory", "--json", results_file]) == 0
+    with open(results_file) as f:
+        results = json.load(f)
+    assert [result['status'] for result in results] == ["ok", "ok"]
+    assert all(result['events'] > 0 for result in results)
+
+def test_golden_values_only_come_from_the_stepping_loop(capsys):
+    with pytest.raises(SystemExit):
+        benchmark.main(["--engine", "hyperperiod", "--update-golden"])
+    with pytest.raises(SystemExit):
+        benchmark.main(["--cases", "no_such_case"])
+
+@pytest.mark.parametrize('engine', ['step', 'step_python', 'hyperperiod'])
+def test_engines_match_the_baseline_commit(engine, tmp_path, capsys):
+    results_file = str(tmp_path / "results.json")
+    assert benchmark.main(["--baseline", "--cases", "nanosleeper", "sub_millisecond", "--engine", engine, "--no-memory", "--json", results_file]) == 0
+    with open(results_file) as f:
+        results = json.load(f)
+    assert [result['status'] for result in results] == ["ok", "ok"]
+
+def test_baseline_covers_only_single_source_cases(capsys):
+    with pytest.raises(SystemExit):
+        benchmark.main(["--baseline", "--cases", "many_sources"])
+    with pytest.raises(SystemExit):
+        benchmark.main(["--baseline", "--update-golden"])
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+import embedded_power_model as epm
+from systems import small_system
+
+def test_hit_restores_the_run_and_its_history(tmp_path):
+    cache = epm.ResultCache(str(tmp_path))
+    first = small_system(solar=True)
+    expected = cache.profile(first, 3600.0, record_time_history=True)
+    second = small_system(solar=True)
+    assert cache.profile(second, 3600.0, record_time_history=True) == expected
+    assert (cache.hits, cache.misses) == (1, 1)
+    for name in ('current_ma', 'voltage'):
+        assert np.array_equal(second.sources[0].history.column(name), first.sources[0].history.column(name))
+
+    # The restored system extends exactly as the original does
+    first.power_profile(600.0, extend=True)
+    second.power_profile(600.0, extend=True)
+    assert second.summary() == first.summary()
+
+def test_hit_leaves_the_global_random_state_alone(tmp_path):
+    cache = epm.ResultCache(str(tmp_path))
+    cache.profile(small_system(solar=True), 600.0)
+    np.random.seed(123)
+    expected = np.random.random(3)
+    np.random.seed(123)
+    cache.profile(small_system(solar=True), 600.0)
+    assert cache.hits == 1
+    assert np.array_equal(np.random.random(3), expected)
+
+def test_unseeded_panels_are_not_cached(tmp_path):
+    cache = epm.ResultCache(str(tmp_path))
+    cache.profile(small_system(solar=True, seed=None), 600.0)
+    assert (cache.hits, cache.misses, cache.entries()) == (0, 0, [])
+
+def test_key_follows_the_configuration():
+    system = small_system()
+    key = epm.config_hash(system, 600.0)
+    assert epm.config_hash(small_system(), 600.0) == key
+    assert epm.config_hash(system, 601.0) != key
+    assert epm.config_hash(system, 600.0, use_hyperperiod=True) != key
+    system.sources[0].regulators[0].threads[0].stages[0].components[0].current_ma = 1.6
+    assert epm.config_hash(system, 600.0) != key
+
+def test_eviction_and_clear(tmp_path):
+    cache = epm.ResultCache(str(tmp_path), max_bytes=1)
+    cache.profile(small_system(), 600.0)
+    cache.profile(small_system(), 700.0)
+    assert len(cache.entries()) == 1
+    cache.clear()
+    assert cache.entries() == []
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_sweep_counts_the_points_of_every_process(tmp_path, processes):
+    cache = epm.ResultCache(str(tmp_path))
+    axes = {'sources[0].capacity_mAh': [40.0, 50.0, 60.0]}
+    first = epm.sweep(small_system(), axes, 600.0, processes=processes, cache=cache)
+    assert (cache.hits, cache.misses) == (0, 3)
+    assert epm.sweep(small_system(), axes, 600.0, processes=processes, cache=cache) == first
+    assert (cache.hits, cache.misses) == (3, 3)
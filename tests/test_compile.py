@@ -0,0 +1,27 @@
+import numpy as np
+
+import embedded_power_model as epm
+from systems import small_system, two_source_system
+
+def test_compiled_layout():
+    system = two_source_system()
+    system.sources[0].regulators[0].threads.append(small_system().sources[0].regulators[0].threads[0])
+    compiled = system.compile()
+    assert compiled.source_regulator_start.tolist() == [0, 1, 2]
+    assert compiled.regulator_thread_start.tolist() == [0, 2, 3]
+    assert compiled.thread_regulator.tolist() == [0, 0, 1]
+    assert compiled.thread_num_stages.tolist() == [2, 2, 2]
+    assert compiled.thread_stage_start.tolist() == [0, 2, 4, 6]
+    assert compiled.stage_current_ma.tolist() == [10.0, 0.05, 1.5, 0.01, 10.0, 0.05]
+    assert compiled.stage_delta_t_sec.tolist() == [0.5, 9.5, 0.2, 2.8, 0.6, 9.5]
+    assert compiled.stage_ticks.tolist() == [round(t*epm.TICKS_PER_SEC) for t in compiled.stage_delta_t_sec]
+    assert compiled.thread_cycle_time_sec(1) == 3.0
+    assert compiled.regulator_max_current_output_ma.tolist() == [np.inf, np.inf]
+
+def test_stage_currents_sum_their_components():
+    thread = epm.Thread(name="Busy", stages=[epm.Stage(delta_t_sec=1.0, components=[
+        epm.Component(name="MCU", mode_name="Run", current_ma=3.0), epm.Component(name="Radio", mode_name="RX", current_ma=6.5)])])
+    regulator = epm.VoltageRegulator(name="Rail", output_voltage=3.3, threads=[thread], quiescent_current_ma=0.0, is_switching=False)
+    source = epm.LithiumIonBattery(name="Cell", number_cells=1, regulators=[regulator], capacity_mAh=100.0, initial_charge_mAh=100.0,
+                                   internal_resistance_ohm=0.0)
+    assert epm.EmbeddedSystem(name="Busy", sources=[source]).compile().stage_current_ma.tolist() == [9.5]
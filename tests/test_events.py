@@ -0,0 +1,91 @@
+import gc
+
+import numpy as np
+import pytest
+
+import embedded_power_model as epm
+from systems import small_system
+
+def draining_system():
+    # Empties within a few minutes
+    system = small_system()
+    system.sources[0].current_charge_mAh = 0.05
+    return system
+
+def test_events_match_power_profile():
+    system = small_system(solar=True)
+    events = list(system.iter_events(3600.0))
+    expected = small_system(solar=True)
+    expected.power_profile(3600.0, backend='python')
+    assert system.summary() == expected.summary()
+    assert events[0].t == 0.0
+    assert abs(sum(event.dt for event in events) - 3600.0) < 1e-6
+
+def test_close_leaves_a_run_ending_after_the_last_event():
+    system = small_system(solar=True)
+    events = system.iter_events(3600.0)
+    taken = [next(events) for i in range(50)]
+    events.close()
+    assert system.current_t == system.sim_time_sec == taken[-1].t + taken[-1].dt
+    expected = small_system(solar=True)
+    expected.power_profile(system.sim_time_sec, backend='python')
+    assert system.summary() == expected.summary()
+
+    # Extending carries on as one run would
+    system.power_profile(3600.0 - system.sim_time_sec, extend=True, backend='python')
+    expected = small_system(solar=True)
+    expected.power_profile(3600.0, backend='python')
+    assert system.summary() == expected.summary()
+
+def test_close_at_the_empty_event_writes_back():
+    system = draining_system()
+    events = system.iter_events(3600.0, stop_at_empty=True)
+    for event in events:
+        if system.empty_t is not None:
+            break
+    events.close()
+    assert system.empty_reason is not None
+    assert system.current_t == system.sim_time_sec
+    assert system.sources[0].charge_out_mAh > 0.0
+
+def test_dropped_stream_writes_back():
+    system = small_system()
+    events = system.iter_events(3600.0)
+    for i, event in enumerate(events):
+        if i == 20:
+            break
+    del events
+    gc.collect()
+    assert system.current_t == system.sim_time_sec > 0.0
+    assert system.sources[0].charge_out_mAh > 0.0
+
+@pytest.mark.parametrize('build', [lambda: small_system(solar=True), draining_system])
+def test_blocks_match_events(build):
+    events = list(build().iter_events(3600.0, stop_at_empty=True))
+    blocks = list(build().iter_event_blocks(3600.0, block_events=7, stop_at_empty=True))
+    assert sum(len(block['t']) for block in blocks) == len(events)
+    for field in epm.Event._fields:
+        assert np.array_equal(np.concatenate([block[field] for block in blocks]), [getattr(event, field) for event in events])
+    assert blocks[0]['stage'].shape == (7, 2)
+    assert blocks[0]['current_ma'].shape == (7, 1)
+
+def test_streams_start_when_first_asked():
+    system = small_system()
+    events = system.iter_events(3600.0)
+    blocks = system.iter_event_blocks(3600.0)
+    assert system.sim_time_sec is None
+    next(events)
+    assert system.sim_time_sec == 3600.0
+    events.close()
+    blocks.close()
+
+def test_closed_blocks_write_back():
+    system = small_system()
+    blocks = system.iter_event_blocks(3600.0, block_events=10)
+    block = next(blocks)
+    blocks.close()
+    assert system.current_t == system.sim_time_sec == block['t'][-1] + block['dt'][-1]
+
+def test_block_events_must_be_positive():
+    with pytest.raises(ValueError):
+        next(small_system().iter_event_blocks(3600.0, block_events=0))
@@ -0,0 +1,70 @@
+import numpy as np
+
+import embedded_power_model as epm
+from systems import small_system, two_source_system
+
+def recorded_system():
+    system = two_source_system()
+    system.power_profile(7200.0, record_time_history=True)
+    return system
+
+def test_export_history_round_trips(tmp_path):
+    system = recorded_system()
+    system.export_history(str(tmp_path))
+    histories = epm.load_history(str(tmp_path))
+    assert sorted(histories) == ['source_0', 'source_0_harvesting', 'source_1', 'source_1_harvesting', 'system']
+    for s, source in enumerate(system.sources):
+        assert np.array_equal(histories['source_{0}'.format(s)].column('voltage'), source.history.column('voltage'))
+        assert np.array_equal(histories['source_{0}_harvesting'.format(s)].time, source.energy_harvesting.history.time)
+    total_mAs = sum(source.history.integral('current_ma') for source in system.sources)
+    assert abs(histories['system'].integral('current_ma') - total_mAs) < 1e-9*total_mAs
+
+    # A system of the same structure reads the export back
+    loaded = two_source_system()
+    loaded.sim_time_sec = None
+    loaded.load_history(str(tmp_path))
+    assert np.array_equal(loaded.sources[1].current_history_ma, system.sources[1].current_history_ma)
+
+def test_csv_is_a_square_profile(tmp_path):
+    system = small_system()
+    system.power_profile(600.0, record_time_history=True)
+    filename = str(tmp_path / "profile.csv")
+    system.export_to_csv(filename)
+    rows = np.loadtxt(filename, delimiter=",", skiprows=1)
+    history = system.sources[0].history
+    assert len(rows) == 2*len(history)
+    assert np.array_equal(rows[0::2, 0], history.time)
+    assert np.array_equal(rows[1::2, 0], np.append(history.time[1:], history.end_t))
+    assert np.allclose(rows[0::2, 1], history.column('current_ma'))
+    assert np.array_equal(rows[0::2, 1], rows[1::2, 1])
+
+def test_csv_chunks_do_not_change_the_file(tmp_path):
+    system = recorded_system()
+    whole = str(tmp_path / "whole.csv")
+    chunked = str(tmp_path / "chunked.csv")
+    system.export_to_csv(whole, all_series=True)
+    system.export_to_csv(chunked, all_series=True, chunk_rows=7)
+    with open(whole) as f, open(chunked) as g:
+        assert f.read() == g.read()
+    with open(whole) as f:
+        header = f.readline().strip().split(", ")
+    assert header[:3] == ['time [s]', 'current [mA]', 'power [mW]']
+    assert 'source_1_harvesting power_W' in header
+
+def test_csv_merges_the_sources_a_chunk_at_a_time(tmp_path):
+    system = recorded_system()
+    filename = str(tmp_path / "profile.csv")
+    system.export_to_csv(filename, chunk_rows=5)
+    # The summed system series are never built for the export
+    assert system._system_history_cache is None
+    rows = np.loadtxt(filename, delimiter=",", skiprows=1)
+    assert np.array_equal(rows[0::2, 0], system.time)
+    assert np.array_equal(rows[0::2, 1], system.system_current_mA)
+
+def test_nothing_recorded(tmp_path, capsys):
+    system = small_system()
+    system.power_profile(600.0)
+    system.export_history(str(tmp_path / "export"))
+    system.export_to_csv(str(tmp_path / "profile.csv"))
+    assert capsys.readouterr().out.count("you must set record_time_history to True") == 2
+    assert not (tmp_path / "profile.csv").exists()
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+import embedded_power_model as epm
+from systems import small_system
+
+def test_devices_match_single_runs():
+    charges = [10.0, 20.0, 40.0]
+    results = epm.fleet_profile(small_system(), {'sources[0].initial_charge_mAh': charges}, 86400.0)
+    assert results['devices'] == 3
+    for charge_mAh, final_soc_pct in zip(charges, results['sources'][0]['final_soc_pct']):
+        system = small_system()
+        system.sources[0].initial_charge_mAh = charge_mAh
+        system.reset()
+        system.power_profile(86400.0)
+        assert abs(final_soc_pct - system.summary()['sources'][0]['soc_pct']) < 0.01
+
+def test_lifetime_is_the_first_failure(capsys):
+    results = epm.fleet_profile(small_system(), {'sources[0].initial_charge_mAh': [0.5, 40.0]}, 86400.0)
+    system = small_system()
+    system.sources[0].initial_charge_mAh = 0.5
+    system.reset()
+    lifetime_sec = system.time_to_empty(86400.0)
+    assert abs(results['lifetime_sec'][0] - lifetime_sec) < 60.0
+    assert np.isinf(results['lifetime_sec'][1])
+    assert results['failed_fraction'] == 0.5
+
+def test_scalars_apply_to_every_device():
+    results = epm.fleet_profile(small_system(), {'sources[0].internal_resistance_ohm': 0.5}, 3600.0, num_devices=4)
+    assert np.ptp(results['sources'][0]['final_soc_pct']) == 0.0
+    assert len(results['lifetime_sec']) == 4
+
+@pytest.mark.parametrize('parameters, num_devices', [
+    ({}, None),
+    ({'sources[0].capacity_mAh': 50.0}, 0),
+    ({'sources[0].capacity_mAh': [50.0, 60.0]}, 3),
+    ({'sources[0].regulators[0].output_voltage': [3.0, 3.3]}, None),
+    ({'name': [1.0, 2.0]}, None),
+])
+def test_invalid_fleets(parameters, num_devices):
+    with pytest.raises(ValueError):
+        epm.fleet_profile(small_system(), parameters, 3600.0, num_devices=num_devices)
+
+def test_step_sec_must_be_positive():
+    with pytest.raises(ValueError):
+        epm.fleet_profile(small_system(), {}, 3600.0, num_devices=2, step_sec=0.0)
+
+def test_solved_voltages_are_noted(capsys):
+    system = small_system()
+    system.sources[0].solve_voltage = False
+    epm.fleet_profile(system, {}, 3600.0, num_devices=2)
+    assert "Note" not in capsys.readouterr().out
+    system.sources[0].solve_voltage = True
+    epm.fleet_profile(system, {}, 3600.0, num_devices=2)
+    assert "cannot solve the voltage of Cell" in capsys.readouterr().out
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+import embedded_power_model as epm
+
+def harvested(panel, times):
+    return sum(panel.harvest_until(t) for t in times[:-1]) + panel.harvest_until(times[-1], partial=True)
+
+def test_clear_sky_energy_is_the_integral_of_the_power():
+    panel = epm.SolarPanel(rated_power_W=0.5, t_offset_sec=1800.0)
+    t = np.linspace(0.0, 2*86400.0, 2000001)
+    power = panel.clear_sky_power(t)
+    numeric = np.sum((power[1:] + power[:-1])*0.5*np.diff(t))
+    assert abs(panel.clear_sky_energy(0.0, 2*86400.0) - numeric) < 1e-6*numeric
+    assert np.allclose(panel.clear_sky_energy(np.array([0.0, 3600.0]), np.array([3600.0, 7200.0])),
+                       [panel.clear_sky_energy(0.0, 3600.0), panel.clear_sky_energy(3600.0, 7200.0)])
+
+def test_harvest_does_not_depend_on_the_load_events():
+    coarse = epm.SolarPanel(rated_power_W=0.5, seed=3, clouds_tau=900.0, clouds_cover=0.5)
+    fine = epm.SolarPanel(rated_power_W=0.5, seed=3, clouds_tau=900.0, clouds_cover=0.5)
+    rng = np.random.default_rng(0)
+    fine_times = np.sort(rng.uniform(0.0, 86400.0, 5000)).tolist() + [86400.0]
+    assert abs(harvested(coarse, [10000.0, 50000.0, 86400.0]) - harvested(fine, fine_times)) < 1e-9
+    assert np.array_equal(coarse.history.time, fine.history.time)
+
+def test_without_clouds_the_harvest_is_the_clear_sky_energy():
+    panel = epm.SolarPanel(rated_power_W=0.5, seed=1, clouds_cover=1.0e9, step_sec=600.0)
+    assert abs(harvested(panel, [1234.5, 40000.0, 86400.0 + 77.0]) - panel.clear_sky_energy(0.0, 86400.0 + 77.0)) < 1e-9
+
+def test_every_event_mode():
+    panel = epm.SolarPanel(rated_power_W=0.5, seed=1, clouds_cover=1.0e9, step_sec=None)
+    panel.harvest_until(30000.0)
+    assert abs(panel.harvest_until(30060.0) - 60.0*panel.clear_sky_power(30060.0)) < 1e-12
+    assert panel.harvest_until(30060.0) == 0.0
+
+def test_step_sec_must_be_positive():
+    with pytest.raises(ValueError):
+        epm.SolarPanel(rated_power_W=0.5, step_sec=0.0)
@@ -0,0 +1,79 @@
+import numpy as np
+
+import embedded_power_model as epm
+from systems import small_system
+
+def recorded(policy, t, values):
+    history = epm.HistoryRecorder(['a', 'b'], policy)
+    for row_t, row_values in zip(t, values):
+        history.append(row_t, row_values)
+    history.close(t[-1] + 1.0)
+    return history
+
+def test_rows_span_chunks():
+    t = np.arange(10.0)
+    values = np.column_stack([t, 2.0*t])
+    history = recorded(epm.HistoryPolicy(chunk_rows=3), t, values.tolist())
+    assert len(history) == 10
+    assert np.array_equal(history.time, t)
+    assert np.array_equal(history.column('b'), 2.0*t)
+    # Each row is held until the next, the last until the end of the run
+    assert history.integral('a') == sum(range(10))
+
+def test_append_rows_matches_append():
+    t = np.linspace(0.0, 5.0, 23)
+    values = np.column_stack([np.sin(t), np.cos(t)])
+    for policy in (epm.HistoryPolicy(chunk_rows=4), epm.HistoryPolicy(keep_every=3, chunk_rows=4), epm.HistoryPolicy(bucket_sec=1.0)):
+        expected = recorded(policy, t, values.tolist())
+        history = epm.HistoryRecorder(['a', 'b'], policy)
+        history.append_rows(t[:10], values[:10])
+        history.append_rows(t[10:], values[10:])
+        history.close(t[-1] + 1.0)
+        assert np.array_equal(history.time, expected.time)
+        assert np.array_equal(history.column('a'), expected.column('a'))
+        assert history.integral('b') == expected.integral('b')
+
+def test_decimation_keeps_the_exact_integral():
+    t = np.arange(100.0)
+    values = [[value, 0.0] for value in t]
+    full = recorded(epm.HistoryPolicy(), t, values)
+    decimated = recorded(epm.HistoryPolicy(keep_every=10), t, values)
+    assert np.array_equal(decimated.time, t[::10])
+    assert decimated.integral('a') == full.integral('a')
+
+def test_buckets_keep_minimum_and_maximum():
+    t = np.arange(0.0, 10.0, 0.5)
+    values = [[np.sin(value), 0.0] for value in t]
+    history = recorded(epm.HistoryPolicy(bucket_sec=2.0), t, values)
+    assert len(history) == 10
+    for bucket in range(5):
+        inside = [row[0] for row_t, row in zip(t, values) if bucket*2.0 <= row_t < (bucket + 1)*2.0]
+        assert history.column('a')[2*bucket] == min(inside)
+        assert history.column('a')[2*bucket + 1] == max(inside)
+
+def test_dtype_sets_the_stored_precision():
+    history = recorded(epm.HistoryPolicy(dtype=np.float32, chunk_rows=8), [0.0, 1.0], [[1.0/3.0, 0.0], [0.5, 0.0]])
+    assert history.column('a').dtype == np.float32
+    assert history.nbytes == 8*8 + 8*2*4
+
+def test_policy_applies_to_a_run():
+    full = small_system()
+    full.power_profile(3600.0, record_time_history=True)
+    decimated = small_system()
+    decimated.power_profile(3600.0, history=epm.HistoryPolicy(keep_every=4, dtype=np.float32))
+    assert len(decimated.sources[0].history) == (full.sources[0].history.num_events + 3)//4
+    assert decimated.sources[0].history.column('current_ma').dtype == np.float32
+    assert decimated.summary() == full.summary()
+
+def test_system_totals_follow_the_histories():
+    system = small_system()
+    system.power_profile(600.0, record_time_history=True)
+    assert system.sources[0].history.name == 'source_0'
+    # Summed once and kept while the histories do not change
+    assert system.time is system.time
+    num_rows = len(system.time)
+    system.power_profile(600.0, record_time_history=True, extend=True)
+    assert len(system.time) > num_rows
+    assert np.array_equal(system.system_current_mA, system.sources[0].current_history_ma)
+    system.sources[0].history = None
+    assert len(system.time) == 0
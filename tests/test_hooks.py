@@ -0,0 +1,53 @@
+import pytest
+
+import embedded_power_model as epm
+from systems import small_system
+
+def test_stage_changes_are_reported():
+    changes = []
+    system = small_system()
+    system.power_profile(60.0, hooks=epm.ProfileHooks(on_stage_change=lambda system, t, thread, stage_index: changes.append((t, thread.name, stage_index))),
+                         instrument=True)
+    steps = {thread['name']: thread['steps'] for thread in system.instrumentation['threads']}
+    assert steps == {'Sensor': sum(1 for change in changes if change[1] == 'Sensor'), 'Radio': sum(1 for change in changes if change[1] == 'Radio')}
+    assert changes[:3] == [(pytest.approx(0.05), 'Radio', 1), (pytest.approx(0.2), 'Sensor', 1), (pytest.approx(3.0), 'Sensor', 0)]
+    # Callbacks do not change the run
+    expected = small_system()
+    expected.power_profile(60.0)
+    assert system.summary() == expected.summary()
+
+def test_state_of_charge_thresholds_fire_once_on_the_way_down():
+    crossings = []
+    system = small_system()
+    hooks = epm.ProfileHooks(on_soc_below=lambda system, t, source, threshold_pct: crossings.append(threshold_pct), soc_thresholds_pct=(50.0, 70.0, 20.0))
+    system.power_profile(5*86400.0, hooks=hooks, stop_at_empty=True)
+    assert crossings == [70.0, 50.0, 20.0]
+
+def test_overcurrent_and_empty_callbacks():
+    overcurrents = []
+    empties = []
+    system = small_system()
+    system.sources[0].regulators[0].max_current_output_ma = 5.0
+    system.sources[0].current_charge_mAh = 0.05
+    hooks = epm.ProfileHooks(on_regulator_overcurrent=lambda system, t, regulator, current_ma: overcurrents.append(current_ma),
+                             on_source_empty=lambda system, t, source: empties.append((t, source.name)))
+    system.power_profile(3600.0, hooks=hooks, stop_at_empty=True)
+    assert len(overcurrents) > 0 and min(overcurrents) > 5.0
+    assert empties == [(system.empty_t, 'Cell')]
+
+def test_thresholds_need_a_callback():
+    with pytest.raises(ValueError):
+        epm.ProfileHooks(soc_thresholds_pct=(50.0,))
+
+def test_instrumentation(capsys):
+    system = small_system()
+    system.print_instrumentation()
+    assert "Note: no instrumentation" in capsys.readouterr().out
+    system.power_profile(600.0, instrument=True, record_time_history=True)
+    stats = system.instrumentation
+    assert stats['engine'] == 'step' and stats['events'] > 0
+    assert stats['min_dt_sec'] <= stats['max_dt_sec']
+    assert set(stats['time_sec']) == {'scheduling', 'currents', 'logging', 'charge', 'harvesting'}
+    assert stats['history_bytes'] == system.sources[0].history.nbytes
+    system.print_instrumentation()
+    assert "Thread Radio:" in capsys.readouterr().out
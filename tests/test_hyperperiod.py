@@ -0,0 +1,40 @@
+import pytest
+
+import embedded_power_model as epm
+from systems import small_system
+
+@pytest.mark.parametrize('sim_time_sec', [3600.0, 3*86400.0])
+def test_hyperperiod_matches_stepping(sim_time_sec):
+    stepped = small_system()
+    stepped.power_profile(sim_time_sec, backend='python')
+    hyperperiod = small_system()
+    hyperperiod.power_profile(sim_time_sec, use_hyperperiod=True)
+    for name in ('charge_mAh', 'energy_out_J', 'average_current_ma', 'peak_current_ma', 'min_voltage'):
+        expected = stepped.summary()['sources'][0][name]
+        assert abs(hyperperiod.summary()['sources'][0][name] - expected) <= 1e-5*abs(expected)
+    for thread, expected in zip(hyperperiod.summary()['threads'], stepped.summary()['threads']):
+        assert thread['stage_time_sec'] == pytest.approx(expected['stage_time_sec'], rel=1e-9)
+
+def test_hyperperiod_stops_at_empty():
+    stepped = small_system()
+    stepped.power_profile(30*86400.0, backend='python', stop_at_empty=True)
+    hyperperiod = small_system()
+    hyperperiod.power_profile(30*86400.0, use_hyperperiod=True, stop_at_empty=True)
+    assert hyperperiod.empty_reason == stepped.empty_reason == 'empty'
+    # Within one cycle of the sensor and radio
+    assert abs(hyperperiod.empty_t - stepped.empty_t) < 15.0
+
+def test_harvesting_steps_through_time(capsys):
+    system = small_system(solar=True)
+    system.power_profile(600.0, use_hyperperiod=True, instrument=True)
+    assert "Note: hyperperiod mode requires a system without energy harvesting" in capsys.readouterr().out
+    assert system.instrumentation['engine'] == 'step'
+
+def test_long_hyperperiods_step_through_time(capsys, monkeypatch):
+    monkeypatch.setattr(epm, 'HYPERPERIOD_MAX_EVENTS', 2)
+    system = small_system()
+    system.power_profile(600.0, use_hyperperiod=True)
+    assert "Note: hyperperiod has more than 2 stage changes" in capsys.readouterr().out
+    expected = small_system()
+    expected.power_profile(600.0)
+    assert system.summary() == expected.summary()
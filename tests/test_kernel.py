@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+import embedded_power_model as epm
+from systems import small_system, two_source_system
+
+def run(build, backend, **options):
+    system = build()
+    system.power_profile(options.pop('sim_time_sec', 86400.0), backend=backend, **options)
+    return system
+
+@pytest.mark.parametrize('build', [small_system, lambda: small_system(solar=True), lambda: small_system(switching=False), two_source_system])
+def test_kernel_matches_the_python_loop(build):
+    assert run(build, 'kernel').summary() == run(build, 'python').summary()
+
+def test_kernel_histories_and_buffer_flushes(monkeypatch):
+    expected = run(two_source_system, 'python', record_time_history=True)
+    monkeypatch.setattr(epm, 'KERNEL_HISTORY_ROWS', 100)
+    system = run(two_source_system, 'kernel', record_time_history=True)
+    assert system.summary() == expected.summary()
+    for source, expected_source in zip(system.sources, expected.sources):
+        for name in ('current_ma', 'voltage', 'charge_mAh'):
+            assert np.array_equal(source.history.column(name), expected_source.history.column(name))
+        assert np.array_equal(source.energy_harvesting.history.time, expected_source.energy_harvesting.history.time)
+
+def test_kernel_messages_and_stop_at_empty(monkeypatch, capsys):
+    def draining():
+        system = small_system()
+        system.sources[0].current_charge_mAh = 0.05
+        system.sources[0].regulators[0].max_current_output_ma = 5.0
+        return system
+    expected = run(draining, 'python', stop_at_empty=True)
+    python_out = capsys.readouterr().out
+    monkeypatch.setattr(epm, 'KERNEL_LOG_ROWS', 4)
+    system = run(draining, 'kernel', stop_at_empty=True)
+    assert capsys.readouterr().out == python_out
+    assert (system.empty_t, system.empty_reason) == (expected.empty_t, expected.empty_reason)
+    assert system.summary() == expected.summary()
+
+def test_kernel_extends_a_run():
+    system = run(small_system, 'kernel', sim_time_sec=3600.0)
+    system.power_profile(3600.0, extend=True, backend='kernel')
+    assert system.summary() == run(small_system, 'python', sim_time_sec=7200.0).summary()
+
+def test_unsupported_runs_use_the_python_loop(capsys):
+    system = small_system()
+    system.power_profile(600.0, backend='kernel', instrument=True)
+    assert "Note: the stepping kernel cannot be used since instrumentation times the parts of the Python loop" in capsys.readouterr().out
+    assert system.instrumentation['engine'] == 'step'
+
+def test_invalid_backend():
+    with pytest.raises(ValueError):
+        small_system().power_profile(600.0, backend='gpu')
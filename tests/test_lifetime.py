@@ -0,0 +1,54 @@
+import pytest
+
+import embedded_power_model as epm
+from systems import small_system
+
+CHARGE = ('sources[0].capacity_mAh', 'sources[0].initial_charge_mAh')
+
+def test_time_to_empty_matches_stepping(capsys):
+    lifetime_sec = small_system().time_to_empty(30*86400.0, use_hyperperiod=False)
+    stepped = small_system()
+    stepped.power_profile(30*86400.0, stop_at_empty=True, backend='python')
+    assert lifetime_sec == stepped.empty_t
+    assert abs(small_system().time_to_empty(30*86400.0) - lifetime_sec) < 15.0
+
+def test_time_to_empty_past_the_horizon():
+    assert small_system().time_to_empty(86400.0) is None
+
+def test_dropout_ends_the_run_early(capsys):
+    lifetime_sec = small_system().time_to_empty(30*86400.0)
+    system = small_system()
+    system.sources[0].regulators[0].dropout_voltage = 0.3
+    assert system.time_to_empty(30*86400.0) < lifetime_sec
+    assert system.empty_reason == 'dropout'
+
+def test_solve_parameter_hits_the_target(capsys):
+    target_sec = 10*86400.0
+    result = epm.solve_parameter(small_system(), CHARGE, target_sec, 40.0, 200.0, rtol=1e-3)
+    assert result['converged']
+    assert abs(result['lifetime_sec'] - target_sec) <= 1e-3*target_sec
+    assert len(result['evaluations']) < 10
+    system = small_system()
+    for path in CHARGE:
+        epm.set_parameter(system, path, result['value'])
+    system.reset()
+    assert abs(system.time_to_empty(2*target_sec) - target_sec) <= 1e-3*target_sec
+
+def test_solve_parameter_errors(capsys):
+    with pytest.raises(ValueError):
+        epm.solve_parameter(small_system(), CHARGE, 10*86400.0, 40.0, 200.0, max_time_sec=5*86400.0)
+    with pytest.raises(ValueError):
+        epm.solve_parameter(small_system(), CHARGE, 10*86400.0, 100.0, 200.0)
+
+def test_time_to_empty_stops_once_harvesting_keeps_up():
+    system = small_system(solar=True)
+    assert system.time_to_empty() is None
+    assert system.current_t <= 2*86400.0
+
+def test_time_to_empty_with_harvesting_matches_stepping(capsys):
+    system = small_system(solar=True)
+    system.sources[0].energy_harvesting.rated_power_W = 0.0005
+    stepped = small_system(solar=True)
+    stepped.sources[0].energy_harvesting.rated_power_W = 0.0005
+    stepped.power_profile(30*86400.0, stop_at_empty=True)
+    assert system.time_to_empty(30*86400.0) == stepped.empty_t
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from systems import small_system
+
+def test_without_harvesting_every_realization_matches_stepping():
+    # monte_carlo sags the source by each regulator's own current, as stepping does without solve_voltage
+    system = small_system()
+    system.sources[0].solve_voltage = False
+    results = system.monte_carlo(86400.0, realizations=4, seed=1)
+    source = results['sources'][0]
+    expected = small_system()
+    expected.sources[0].solve_voltage = False
+    expected.power_profile(86400.0)
+    assert np.allclose(source['final_soc_pct'], expected.summary()['sources'][0]['soc_pct'], rtol=1e-6)
+    assert source['capacity_factor'] is None and source['empty_fraction'] == 0.0
+
+def test_seeded_runs_repeat_and_leave_the_system_alone():
+    system = small_system(solar=True)
+    first = system.monte_carlo(86400.0, realizations=50, seed=7)
+    second = system.monte_carlo(86400.0, realizations=50, seed=7)
+    assert np.array_equal(first['sources'][0]['final_soc_pct'], second['sources'][0]['final_soc_pct'])
+    assert not np.array_equal(first['sources'][0]['final_soc_pct'], system.monte_carlo(86400.0, realizations=50, seed=8)['sources'][0]['final_soc_pct'])
+    assert system.sim_time_sec is None and system.sources[0].current_charge_mAh == 40.0
+
+def test_matches_stepping_statistically():
+    results = small_system(solar=True).monte_carlo(2*86400.0, realizations=200, seed=1)
+    final_soc_pct = []
+    for seed in range(20):
+        system = small_system(solar=True, seed=seed)
+        system.power_profile(2*86400.0)
+        final_soc_pct.append(system.summary()['sources'][0]['soc_pct'])
+    assert abs(np.mean(results['sources'][0]['final_soc_pct']) - np.mean(final_soc_pct)) < 0.05
+    assert len(results['sources'][0]['final_soc_pct_percentiles']) == 5
+
+def test_empty_times():
+    system = small_system()
+    system.sources[0].current_charge_mAh = 1.0
+    source = system.monte_carlo(86400.0, realizations=3, seed=1)['sources'][0]
+    expected = small_system()
+    expected.sources[0].current_charge_mAh = 1.0
+    expected.power_profile(86400.0, stop_at_empty=True)
+    assert source['empty_fraction'] == 1.0
+    assert np.allclose(source['time_at_empty_sec'], expected.empty_t, rtol=1e-2)
+
+@pytest.mark.parametrize('arguments', [{'realizations': 0}, {'step_sec': 0.0}])
+def test_invalid_arguments(arguments):
+    with pytest.raises(ValueError):
+        small_system().monte_carlo(3600.0, **arguments)
+
+def test_starts_fresh_after_an_earlier_run():
+    system = small_system(solar=True)
+    system.power_profile(5000.0)
+    charge_mAh = system.sources[0].current_charge_mAh
+    results = system.monte_carlo(3600.0, realizations=20, seed=3)
+    fresh = small_system(solar=True)
+    fresh.sources[0].current_charge_mAh = charge_mAh
+    expected = fresh.monte_carlo(3600.0, realizations=20, seed=3)
+    assert np.array_equal(results['sources'][0]['final_soc_pct'], expected['sources'][0]['final_soc_pct'])
+    assert np.isfinite(results['sources'][0]['capacity_factor']).all()
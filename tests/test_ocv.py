@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+import embedded_power_model as epm
+from systems import small_system
+
+def test_scalar_and_array_lookups_agree():
+    curve = epm.LithiumIonBattery.ocv_curve
+    soc = np.linspace(-10.0, 110.0, 241)
+    voltages = curve.cell_voltage(soc)
+    assert np.array_equal(voltages, np.interp(soc, curve.soc_table, curve.cell_voltage_table))
+    assert np.allclose([curve.cell_voltage(float(value)) for value in soc], voltages, rtol=0.0, atol=1e-12)
+    assert curve.cell_voltage(-5.0) == 2.25 and curve.cell_voltage(150.0) == 4.25
+    assert curve.cell_voltage(np.full((2, 3), 50.0)).shape == (2, 3)
+
+def test_segments():
+    curve = epm.OCVCurve([0.0, 50.0, 100.0], [3.0, 3.5, 4.0])
+    assert [curve.segment(soc) for soc in (-1.0, 0.0, 49.9, 50.0, 100.0, 120.0)] == [0, 0, 0, 1, 1, 1]
+    assert curve.segment(np.array([-1.0, 49.9, 50.0, 120.0])).tolist() == [0, 0, 1, 1]
+
+@pytest.mark.parametrize('soc_table, cell_voltage_table', [
+    ([0.0], [3.0]),
+    ([0.0, 100.0], [3.0, 3.5, 4.0]),
+    ([0.0, 50.0, 50.0], [3.0, 3.5, 4.0]),
+])
+def test_invalid_curves(soc_table, cell_voltage_table):
+    with pytest.raises(ValueError):
+        epm.OCVCurve(soc_table, cell_voltage_table)
+
+def test_source_voltage_sags_with_current():
+    source = small_system().sources[0]
+    charge_mAh = np.array([10.0, 25.0, 40.0])
+    voltages = source.voltage_at(charge_mAh, 100.0)
+    assert np.allclose(voltages, [source.voltage_at(float(charge), 0.0) - 0.02 for charge in charge_mAh])
+    assert source.get_current_voltage() == source.voltage_at(40.0)
+
+def test_sources_may_bring_their_own_curve():
+    system = small_system()
+    curve = epm.OCVCurve([0.0, 100.0], [3.0, 4.0])
+    regulators = system.sources[0].regulators
+    source = epm.LithiumIonBattery(name="Flat", number_cells=2, regulators=regulators, capacity_mAh=50.0, initial_charge_mAh=25.0,
+                                   internal_resistance_ohm=0.0, ocv_curve=curve)
+    assert source.get_current_voltage() == 7.0
+    assert epm.LithiumIonBattery.ocv_curve is not curve
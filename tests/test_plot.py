@@ -0,0 +1,69 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+
+import embedded_power_model as epm
+from systems import small_system, two_source_system
+
+@pytest.fixture(autouse=True)
+def close_figures(monkeypatch):
+    monkeypatch.setattr(plt, "show", lambda: None)
+    yield
+    plt.close('all')
+
+def test_nothing_recorded_prints_a_note(capsys):
+    system = two_source_system()
+    system.power_profile(600.0)
+    system.plot()
+    assert "record_time_history" in capsys.readouterr().out
+    assert plt.get_fignums() == []
+
+def test_sources_without_history_are_left_out():
+    system = two_source_system()
+    system.power_profile(600.0, record_time_history=True)
+    system.sources[1].history = None
+    system.sources[1].energy_harvesting.history = None
+    system.plot(time_window=(100.0, 300.0), resolution=50)
+    assert len(plt.get_fignums()) == 5
+
+def test_series_are_reduced_to_min_and_max_per_pixel():
+    system = small_system()
+    system.power_profile(3600.0, record_time_history=True)
+    source = system.sources[0]
+    current_ma = source.current_history_ma
+    t, values = epm._plot_series(source.time, epm._column_rows(current_ma), source.history.end_t, resolution=100)
+    assert len(t) <= 4*100 + 2
+    assert values.max() == current_ma.max() and values.min() == current_ma.min()
+
+    start_t, end_t = 1000.0, 1200.0
+    t, values = epm._plot_series(source.time, epm._column_rows(current_ma), source.history.end_t, window=(start_t, end_t), resolution=100)
+    assert t.min() >= start_t - 5.0 and t.max() <= end_t + 5.0
+    inside = (source.time >= start_t) & (source.time <= end_t)
+    assert values.max() == pytest.approx(np.max(current_ma[inside]))
+
+def test_short_series_are_plotted_as_steps():
+    t = np.array([0.0, 1.0, 3.0])
+    plot_t, plot_values = epm._plot_series(t, epm._column_rows(np.array([1.0, 2.0, 3.0])), 4.0, resolution=10)
+    assert plot_t.tolist() == [0.0, 1.0, 1.0, 3.0, 3.0, 4.0]
+    assert plot_values.tolist() == [1.0, 1.0, 2.0, 2.0, 3.0, 3.0]
+
+def test_window_rows_start_at_the_row_holding():
+    t = np.array([0.0, 1.0, 3.0, 6.0])
+    assert epm._window_rows(t, None) == (0, 4)
+    assert epm._window_rows(t, (2.0, 5.0)) == (1, 3)
+    assert epm._window_rows(t, (7.0, 9.0)) == (3, 4)
+
+def envelope(points_t, points_values):
+    # Lowest and highest value plotted at each time
+    return {x: (points_values[points_t == x].min(), points_values[points_t == x].max()) for x in np.unique(points_t)}
+
+def test_chunked_reads_give_the_same_strokes(monkeypatch):
+    rng = np.random.default_rng(1)
+    t = np.cumsum(rng.uniform(0.0, 1.0, 5000))
+    values = rng.standard_normal(5000)
+    expected = epm._plot_series(t, epm._column_rows(values), t[-1] + 1.0, resolution=64)
+    # A pixel split across chunks is drawn as two strokes at the same time
+    monkeypatch.setattr(epm, 'PLOT_CHUNK_ROWS', 37)
+    chunked = epm._plot_series(t, epm._column_rows(values), t[-1] + 1.0, resolution=64)
+    assert envelope(*chunked) == envelope(*expected)
+    assert chunked[1][-1] == expected[1][-1] == values[-1]
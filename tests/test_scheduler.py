@@ -0,0 +1,36 @@
+import numpy as np
+
+import embedded_power_model as epm
+from systems import small_system
+
+def coincident_system():
+    # The short thread's transitions coincide with the long thread's at every multiple of one second
+    def thread(name, on_sec, off_sec, current_ma):
+        return epm.Thread(name=name, stages=[
+            epm.Stage(delta_t_sec=on_sec, components=[epm.Component(name=name, mode_name="On", current_ma=current_ma)]),
+            epm.Stage(delta_t_sec=off_sec, components=[epm.Component(name=name, mode_name="Off", current_ma=0.0)])
+        ])
+    regulator = epm.VoltageRegulator(name="Rail", output_voltage=3.3, threads=[thread("Fast", 0.1, 0.4, 2.0), thread("Slow", 0.5, 0.5, 1.0)],
+                                     quiescent_current_ma=0.0, is_switching=False)
+    source = epm.LithiumIonBattery(name="Cell", number_cells=1, regulators=[regulator], capacity_mAh=100.0, initial_charge_mAh=100.0,
+                                   internal_resistance_ohm=0.0)
+    return epm.EmbeddedSystem(name="Coincident", sources=[source])
+
+def test_coincident_transitions_are_exact():
+    system = coincident_system()
+    events = list(system.iter_events(100.0))
+    # Stage changes at 0.0, 0.1, 0.5 and 0.6 s of every second, with the coincident ones taken as one event
+    assert len(events) == 400
+    assert all(abs(event.dt - 0.1) < 1e-9 or abs(event.dt - 0.4) < 1e-9 for event in events)
+    fast, slow = system.summary()['threads']
+    assert np.allclose(fast['stage_time_sec'], [20.0, 80.0], rtol=0.0, atol=1e-9)
+    assert np.allclose(slow['stage_time_sec'], [50.0, 50.0], rtol=0.0, atol=1e-9)
+    assert abs(system.sources[0].regulators[0].output_charge_mAh - (2.0*20.0 + 1.0*50.0)/3600.0) < 1e-12
+
+def test_thread_positions_carry_over_an_extended_run():
+    system = small_system()
+    system.power_profile(1000.0)
+    system.power_profile(1000.0, extend=True)
+    expected = small_system()
+    expected.power_profile(2000.0)
+    assert system.summary() == expected.summary()
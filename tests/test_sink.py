@@ -0,0 +1,49 @@
+import os
+
+import numpy as np
+
+import embedded_power_model as epm
+from systems import small_system
+
+def test_streamed_run_matches_memory(tmp_path):
+    np.random.seed(1)
+    expected = small_system(solar=True)
+    expected.power_profile(7200.0, record_time_history=True)
+    np.random.seed(1)
+    system = small_system(solar=True)
+    sink = epm.HistorySink(str(tmp_path), chunk_rows=64)
+    system.power_profile(7200.0, history=sink)
+    assert system.sources[0].current_charge_mAh == expected.sources[0].current_charge_mAh
+    assert system.sources[0].regulators[0].output_charge_mAh == expected.sources[0].regulators[0].output_charge_mAh
+    assert os.path.exists(os.path.join(str(tmp_path), epm.HISTORY_MANIFEST))
+    # Only one chunk per series is held in memory
+    assert system.sources[0].history.nbytes < expected.sources[0].history.nbytes
+
+    histories = epm.load_history(str(tmp_path))
+    assert sorted(histories) == ['source_0', 'source_0_harvesting']
+    for name in ('current_ma', 'voltage', 'charge_mAh', 'regulator_0_current_ma'):
+        assert np.array_equal(histories['source_0'].column(name), expected.sources[0].history.column(name))
+    assert np.array_equal(histories['source_0_harvesting'].time, expected.sources[0].energy_harvesting.history.time)
+    assert histories['source_0'].end_t == 7200.0
+
+def test_extended_run_appends(tmp_path):
+    expected = small_system()
+    expected.power_profile(1800.0, record_time_history=True)
+    expected.power_profile(1800.0, record_time_history=True, extend=True)
+    system = small_system()
+    sink = epm.HistorySink(str(tmp_path), chunk_rows=16)
+    system.power_profile(1800.0, history=sink)
+    system.power_profile(1800.0, history=sink, extend=True)
+    history = epm.load_history(str(tmp_path))['source_0']
+    assert np.array_equal(history.time, expected.sources[0].history.time)
+    assert history.integral('current_ma') == expected.sources[0].history.integral('current_ma')
+
+def test_system_loads_a_streamed_run(tmp_path):
+    streamed = small_system()
+    streamed.power_profile(3600.0, history=epm.HistorySink(str(tmp_path), dtype=np.float32))
+    system = small_system()
+    system.sim_time_sec = None
+    system.load_history(str(tmp_path))
+    assert system.sim_time_sec == 3600.0
+    assert system.sources[0].history.column('voltage').dtype == np.float32
+    assert abs(system.sources[0].regulators[0].output_charge_mAh - streamed.sources[0].regulators[0].output_charge_mAh) < 1e-9
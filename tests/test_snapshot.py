@@ -0,0 +1,52 @@
+import pickle
+import zlib
+
+import pytest
+
+import embedded_power_model as epm
+from systems import small_system, two_source_system
+
+def test_restore_continues_the_run():
+    expected = small_system(solar=True)
+    expected.power_profile(7200.0, backend='python')
+
+    system = small_system(solar=True)
+    system.power_profile(3600.0, backend='python')
+    snapshot = system.snapshot()
+    system.power_profile(600.0, extend=True)
+
+    restored = small_system(solar=True)
+    restored.restore(snapshot)
+    assert restored.current_t == 3600.0
+    restored.power_profile(3600.0, extend=True, backend='python')
+    assert restored.summary() == expected.summary()
+
+def test_restore_puts_back_the_thread_positions():
+    system = small_system()
+    system.power_profile(1234.5)
+    snapshot = system.snapshot()
+    restored = small_system()
+    restored.restore(snapshot)
+    for thread, restored_thread in zip(system.sources[0].regulators[0].threads, restored.sources[0].regulators[0].threads):
+        assert restored_thread.stage_index == thread.stage_index
+        assert restored_thread.last_stage_change_t == thread.last_stage_change_t
+        assert restored_thread.next_stage_change_t == thread.next_stage_change_t
+        assert list(restored_thread.stage_time_sec) == list(thread.stage_time_sec)
+
+def test_restore_drops_histories():
+    system = small_system(solar=True)
+    system.power_profile(600.0, record_time_history=True)
+    system.restore(system.snapshot())
+    assert system.sources[0].history is None
+    assert system.sources[0].energy_harvesting.history is None
+
+def test_restore_rejects_other_systems():
+    snapshot = small_system().snapshot()
+    with pytest.raises(ValueError):
+        two_source_system().restore(snapshot)
+
+def test_restore_rejects_other_versions():
+    state = pickle.loads(zlib.decompress(small_system().snapshot()))
+    state['version'] = epm.SNAPSHOT_VERSION + 1
+    with pytest.raises(ValueError):
+        small_system().restore(zlib.compress(pickle.dumps(state)))
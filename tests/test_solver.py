@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+import embedded_power_model as epm
+from systems import small_system
+
+def curve_system(solve_voltage, resistance_ohm=0.2):
+    system = small_system()
+    source = system.sources[0]
+    source.solve_voltage = solve_voltage
+    source.internal_resistance_ohm = resistance_ohm
+    source.regulators[0].efficiency = epm.EfficiencyCurve([0.01, 1.0, 50.0], [[0.5, 0.8, 0.9], [0.45, 0.75, 0.85]], [3.0, 4.2])
+    return system
+
+def test_curve_interpolates_and_holds_its_ends():
+    curve = epm.EfficiencyCurve([1.0, 10.0, 100.0], [0.6, 0.8, 0.9])
+    assert curve.efficiency(0.1) == 0.6
+    assert curve.efficiency(1000.0) == 0.9
+    assert abs(curve.efficiency(5.5) - 0.7) < 1e-12
+    assert np.allclose(curve.efficiency(np.array([0.1, 5.5, 55.0])), [0.6, 0.7, 0.85])
+
+def test_curve_with_input_voltage():
+    curve = epm.EfficiencyCurve([1.0, 10.0], [[0.6, 0.8], [0.7, 0.9]], [3.0, 4.0])
+    assert abs(curve.efficiency(1.0, 3.5) - 0.65) < 1e-12
+    assert curve.efficiency(10.0, 5.0) == 0.9
+    assert np.allclose(curve.efficiency(np.array([1.0, 10.0]), np.array([3.5, 2.0])), [0.65, 0.8])
+    with pytest.raises(ValueError):
+        curve.efficiency(1.0)
+
+@pytest.mark.parametrize('arguments', [
+    ([1.0], [0.5]),
+    ([2.0, 1.0], [0.5, 0.6]),
+    ([1.0, 2.0], [0.5, 0.6, 0.7]),
+    ([1.0, 2.0], [0.5, 0.0]),
+    ([1.0, 2.0], [[0.5, 0.6], [0.5, 0.6]], [4.0, 3.0]),
+])
+def test_invalid_curves(arguments):
+    with pytest.raises(ValueError):
+        epm.EfficiencyCurve(*arguments)
+
+def test_solved_current_without_resistance_matches_the_default():
+    source = curve_system(True, resistance_ohm=0.0).sources[0]
+    expected = sum(regulator.input_current_ma(10.0, source.get_current_voltage(10.0)) for regulator in source.regulators)
+    assert abs(source.solve_current([10.0]) - expected) < 1e-9*expected
+
+def test_solved_current_is_consistent_and_cached():
+    source = curve_system(True).sources[0]
+    cache = {}
+    current_ma = source.solve_current([20.0], cache)
+    regulator = source.regulators[0]
+    assert abs(regulator.input_current_ma(20.0, source.get_current_voltage(current_ma)) - current_ma) < 1e-6*current_ma
+    assert len(cache) == 1
+    assert abs(source.solve_current([20.0], cache) - current_ma) <= 1e-9*current_ma
+    # The sag under the whole source current is deeper than under the output current alone
+    assert current_ma > regulator.input_current_ma(20.0, source.get_current_voltage(20.0))
+
+def test_unsettled_voltage_is_reported_once(capsys):
+    source = curve_system(True, resistance_ohm=1.0e3).sources[0]
+    cache = {}
+    source.solve_current([50.0], cache)
+    source.solve_current([50.0], cache)
+    assert capsys.readouterr().out.count("Error: Source Cell cannot supply its regulators") == 1
+
+@pytest.mark.parametrize('solve_voltage', [False, True])
+def test_engines_agree(solve_voltage):
+    stepped = curve_system(solve_voltage)
+    stepped.power_profile(3600.0, backend='python')
+    hyperperiod = curve_system(solve_voltage)
+    hyperperiod.power_profile(3600.0, use_hyperperiod=True)
+    for name in ('charge_mAh', 'energy_out_J', 'average_current_ma'):
+        assert abs(hyperperiod.summary()['sources'][0][name] - stepped.summary()['sources'][0][name]) <= 1e-6*abs(stepped.summary()['sources'][0][name])
+
+def test_solving_draws_more_than_the_default():
+    default = curve_system(False)
+    default.power_profile(3600.0)
+    solved = curve_system(True)
+    solved.power_profile(3600.0)
+    assert solved.sources[0].charge_out_mAh > default.sources[0].charge_out_mAh
+
+def test_fleet_rejects_curves():
+    with pytest.raises(ValueError):
+        epm.fleet_profile(curve_system(False), {}, 3600.0, num_devices=2)
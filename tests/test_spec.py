@@ -0,0 +1,143 @@
+import json
+import pickle
+
+import pytest
+
+import embedded_power_model as epm
+
+LIBRARY = """
+[components.mcu_active]
+name = "MCU"
+mode_name = "Active"
+current_ma = 3.0
+
+[threads.report]
+stages = [{delta_t_sec = 0.05, components = ["mcu_active"]},
+          {delta_t_sec = 1.95, components = [{name = "MCU", mode_name = "Sleep", current_ma = 0.001}]}]
+"""
+
+SPEC = """
+spec_version = 1
+include = ["library.toml"]
+
+[system]
+name = "Node"
+[[system.sources]]
+type = "LithiumCoinCellBattery"
+name = "CR2032"
+number_cells = 1
+capacity_mAh = 210.0
+initial_charge_mAh = 210.0
+internal_resistance_ohm = 10.0
+regulators = [{name = "1.8V Rail", output_voltage = 1.8, is_switching = false, quiescent_current_ma = 0.001, threads = ["report"]}]
+"""
+
+def script_system():
+    thread = epm.Thread(name="report", stages=[
+        epm.Stage(delta_t_sec=0.05, components=[epm.Component(name="MCU", mode_name="Active", current_ma=3.0)]),
+        epm.Stage(delta_t_sec=1.95, components=[epm.Component(name="MCU", mode_name="Sleep", current_ma=0.001)])
+    ])
+    regulator = epm.VoltageRegulator(name="1.8V Rail", output_voltage=1.8, threads=[thread], quiescent_current_ma=0.001, is_switching=False)
+    source = epm.LithiumCoinCellBattery(name="CR2032", number_cells=1, regulators=[regulator], capacity_mAh=210.0, initial_charge_mAh=210.0,
+                                        internal_resistance_ohm=10.0)
+    return epm.EmbeddedSystem(name="Node", sources=[source])
+
+def valid_spec():
+    return {"system": {"name": "Node", "sources": [{
+        "type": "LithiumIonBattery", "name": "Cell", "number_cells": 1, "capacity_mAh": 100.0, "initial_charge_mAh": 50.0,
+        "internal_resistance_ohm": 0.1, "regulators": [{
+            "name": "3.3V Rail", "output_voltage": 3.3, "quiescent_current_ma": 0.01, "is_switching": True, "efficiency": 0.9,
+            "threads": [{"name": "Main", "stages": [{"delta_t_sec": 1.0, "components": [{"name": "A", "mode_name": "On", "current_ma": 2.0}]}]}]}]}]}}
+
+@pytest.fixture
+def spec_file(tmp_path):
+    (tmp_path / "library.toml").write_text(LIBRARY)
+    (tmp_path / "node.toml").write_text(SPEC)
+    return tmp_path / "node.toml"
+
+def test_valid_spec_builds_the_scripted_system(spec_file):
+    assert epm.validate_spec(epm.read_spec(str(spec_file))) == []
+    loaded = epm.load_system(str(spec_file))
+    scripted = script_system()
+    loaded.power_profile(3600.0)
+    scripted.power_profile(3600.0)
+    assert loaded.summary() == scripted.summary()
+
+def test_missing_system_is_reported():
+    spec = valid_spec()
+    del spec["system"]
+    assert epm.validate_spec(spec) == ["spec: missing system"]
+    with pytest.raises(ValueError, match="missing system"):
+        epm.build_system(spec)
+
+def test_system_that_is_not_a_table_is_reported():
+    spec = valid_spec()
+    spec["system"] = []
+    assert epm.validate_spec(spec) == ["spec.system: expected dict"]
+
+def test_out_of_range_fields_are_reported():
+    spec = valid_spec()
+    spec["system"]["sources"][0]["number_cells"] = 0
+    spec["system"]["sources"][0]["regulators"][0]["threads"][0]["stages"][0]["delta_t_sec"] = -1.0
+    errors = epm.validate_spec(spec)
+    assert "system.sources[0].number_cells: must be positive" in errors
+    assert "system.sources[0].regulators[0].threads[0].stages[0].delta_t_sec: must be positive" in errors
+    assert len(errors) == 2
+
+def test_unknown_entries_and_references_are_reported():
+    spec = valid_spec()
+    spec["system"]["sources"][0]["colour"] = "red"
+    spec["system"]["sources"][0]["type"] = ["LithiumIonBattery"]
+    spec["system"]["sources"][0]["regulators"][0]["threads"].append("missing")
+    errors = epm.validate_spec(spec)
+    assert "system.sources[0]: unknown entry colour" in errors
+    assert "system.sources[0].type: expected str" in errors
+    assert "system.sources[0].regulators[0].threads[1]: no thread missing" in errors
+
+def test_bad_files_are_reported(tmp_path):
+    (tmp_path / "bad.toml").write_text("[system\nname = 1")
+    (tmp_path / "bad.json").write_text("{\"system\": ")
+    loader = epm.SpecLoader()
+    for name in ("bad.toml", "bad.json"):
+        with pytest.raises(ValueError, match=name):
+            epm.load_system(str(tmp_path / name))
+        errors = loader.validate(str(tmp_path / name))
+        assert len(errors) == 1 and name in errors[0]
+    assert loader.validate(str(tmp_path / "none.json"))
+
+def test_include_cycles_are_reported(tmp_path):
+    (tmp_path / "a.json").write_text(json.dumps({"include": ["b.json"], "system": {"name": "A", "sources": []}}))
+    (tmp_path / "b.json").write_text(json.dumps({"include": ["a.json"]}))
+    with pytest.raises(ValueError, match="includes itself"):
+        epm.load_system(str(tmp_path / "a.json"))
+
+def test_loader_caches_until_a_dependency_changes(spec_file, tmp_path):
+    loader = epm.SpecLoader(str(tmp_path / "cache"))
+    first = loader.load(str(spec_file))
+    second = loader.load(str(spec_file))
+    assert (loader.hits, loader.misses) == (1, 1)
+    assert first is not second and first.sources[0] is not second.sources[0]
+
+    other = epm.SpecLoader(str(tmp_path / "cache"))
+    other.load(str(spec_file))
+    assert (other.hits, other.misses) == (1, 0)
+
+    (tmp_path / "library.toml").write_text(LIBRARY.replace("current_ma = 3.0", "current_ma = 4.25"))
+    changed = other.load(str(spec_file))
+    assert (other.hits, other.misses) == (1, 1)
+    assert changed.sources[0].regulators[0].threads[0].stages[0].components[0].current_ma == 4.25
+
+def test_shared_cache_entries_are_json(spec_file, tmp_path):
+    epm.SpecLoader(str(tmp_path / "cache")).load(str(spec_file))
+    entries = list((tmp_path / "cache").iterdir())
+    assert len(entries) == 1 and entries[0].suffix == ".json"
+    stored = json.loads(entries[0].read_text())
+    assert stored['spec']['system']['name'] == epm.load_system(str(spec_file)).name
+
+    # A damaged entry is built again rather than trusted
+    entries[0].write_bytes(pickle.dumps({'dependencies': [], 'system': None}))
+    loader = epm.SpecLoader(str(tmp_path / "cache"))
+    assert loader.load(str(spec_file)).name == stored['spec']['system']['name']
+    assert (loader.hits, loader.misses) == (0, 1)
+    loader.clear()
+    assert list((tmp_path / "cache").iterdir()) == []
@@ -0,0 +1,50 @@
+import concurrent.futures
+
+import pytest
+
+from systems import two_source_system
+
+# A whole number of cycles of both sources' threads, so neither source steps past the end of the run
+SIM_TIME_SEC = 86860.0
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_split_sources_match_a_shared_timeline(processes):
+    expected = two_source_system()
+    expected.power_profile(SIM_TIME_SEC, backend='python')
+    system = two_source_system()
+    system.power_profile(SIM_TIME_SEC, split_sources=True, processes=processes, backend='python')
+    assert system._source_end_t == [SIM_TIME_SEC, SIM_TIME_SEC]
+    # Harvest is credited at a source's own events, a little later than on the shared timeline
+    for source, expected_source in zip(system.summary()['sources'], expected.summary()['sources']):
+        assert source['energy_in_J'] == pytest.approx(expected_source['energy_in_J'], rel=1e-12)
+        for name in ('charge_mAh', 'energy_out_J', 'peak_current_ma', 'min_voltage'):
+            assert source[name] == pytest.approx(expected_source[name], rel=1e-5)
+    for thread, expected_thread in zip(system.summary()['threads'], expected.summary()['threads']):
+        assert thread['stage_time_sec'] == pytest.approx(expected_thread['stage_time_sec'], rel=1e-9)
+
+def test_split_histories_and_extend():
+    expected = two_source_system()
+    expected.power_profile(2*SIM_TIME_SEC, record_time_history=True, backend='python')
+    system = two_source_system()
+    system.power_profile(SIM_TIME_SEC, record_time_history=True, split_sources=True, processes=1)
+    system.power_profile(SIM_TIME_SEC, record_time_history=True, split_sources=True, processes=1, extend=True)
+    # Each source records only its own stage changes, so the histories agree at the end and in their integrals
+    for source, expected_source in zip(system.sources, expected.sources):
+        assert source.history.column('charge_mAh')[-1] == pytest.approx(expected_source.history.column('charge_mAh')[-1], rel=1e-5)
+        assert source.history.integral('current_ma') == pytest.approx(expected_source.history.integral('current_ma'), rel=1e-6)
+        assert len(source.history) < len(expected_source.history)
+    # The system peak comes from the summed recorded currents
+    assert system.peak_current_mA == pytest.approx(expected.peak_current_mA, rel=1e-5)
+
+def test_stop_at_empty_needs_a_shared_timeline(capsys):
+    system = two_source_system(solar=False)
+    system.power_profile(3600.0, split_sources=True, stop_at_empty=True)
+    assert "Note: stop_at_empty needs a shared timeline" in capsys.readouterr().out
+
+def test_split_sources_step_in_this_process_by_default(monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError("a worker pool was started")
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', no_pool)
+    system = two_source_system()
+    system.power_profile(SIM_TIME_SEC, split_sources=True)
+    assert system._source_end_t == [SIM_TIME_SEC, SIM_TIME_SEC]
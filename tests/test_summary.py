@@ -0,0 +1,43 @@
+import numpy as np
+
+import embedded_power_model as epm
+from systems import small_system, two_source_system
+
+def test_summary_does_not_need_a_history():
+    recorded = small_system(solar=True)
+    recorded.power_profile(3600.0, record_time_history=True, backend='python')
+    unrecorded = small_system(solar=True)
+    unrecorded.power_profile(3600.0, backend='python')
+    assert unrecorded.summary() == recorded.summary()
+
+def test_nothing_is_recorded_without_a_history():
+    system = two_source_system()
+    system.power_profile(86400.0, instrument=True)
+    for source in system.sources:
+        assert source.history is None
+        assert source.energy_harvesting.history is None
+        assert len(source.energy_harvesting.power_history_W) == 0
+    assert system.instrumentation['history_bytes'] == 0
+
+def test_panel_history_follows_the_recording():
+    system = small_system(solar=True)
+    system.power_profile(3600.0, record_time_history=True)
+    panel = system.sources[0].energy_harvesting
+    assert len(panel.time) > 0
+    assert len(panel.power_history_W) == len(panel.random_walk_vals) == len(panel.time)
+    system.power_profile(3600.0)
+    assert panel.history is None
+
+def test_statistics():
+    system = small_system()
+    system.power_profile(600.0)
+    summary = system.summary()
+    source = summary['sources'][0]
+    assert source['peak_current_ma'] >= source['average_current_ma'] > 0.0
+    assert source['min_voltage'] <= system.sources[0].get_current_voltage() + 1e-9
+    assert source['energy_out_J'] > 0.0 and source['energy_in_J'] == 0.0
+    assert abs(source['initial_charge_mAh'] - source['charge_mAh'] - system.sources[0].charge_out_mAh) < 1e-9
+    assert summary['regulators'][0]['output_charge_mAh'] > 0.0
+    for thread in summary['threads']:
+        assert abs(sum(thread['stage_time_sec']) - 600.0) < 1e-6
+        assert abs(sum(thread['duty_cycles']) - 1.0) < 1e-9
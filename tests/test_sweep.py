@@ -0,0 +1,41 @@
+import pytest
+
+import embedded_power_model as epm
+from systems import small_system, two_source_system
+
+def test_paths_select_by_index_and_name():
+    system = two_source_system()
+    assert epm.get_parameter(system, 'sources[1].capacity_mAh') == 100.0
+    assert epm.get_parameter(system, 'sources[Cell 0].regulators[Rail 0].output_voltage') == 3.3
+    assert epm.get_parameter(system, 'sources[-1].energy_harvesting.seed') == 11
+    epm.set_parameter(system, 'sources[Cell 1].regulators[0].threads[0].stages[1].delta_t_sec', 19.5)
+    assert system.sources[1].regulators[0].threads[0].stages[1].delta_t_sec == 19.5
+
+@pytest.mark.parametrize('path', [
+    'sources[0].',
+    'sources[0]',
+    'sources[0].no_such_attribute',
+    'sources[Nobody].capacity_mAh',
+    'no_such_list[0].capacity_mAh',
+])
+def test_invalid_paths(path):
+    with pytest.raises(ValueError):
+        epm.get_parameter(small_system(), path)
+
+def test_sweep_runs_every_combination_on_copies():
+    system = small_system()
+    rows = epm.sweep(system, {'sources[0].capacity_mAh': [50.0, 100.0],
+                              ('sources[0].regulators[0].threads[0].stages[0].components[0].current_ma',
+                               'sources[0].regulators[0].threads[1].stages[0].components[0].current_ma'): [1.0, 20.0]},
+                     3600.0, processes=1)
+    assert len(rows) == 4
+    assert system.sim_time_sec is None
+    assert system.sources[0].capacity_mAh == 50.0
+    label = 'sources[0].regulators[0].threads[0].stages[0].components[0].current_ma, sources[0].regulators[0].threads[1].stages[0].components[0].current_ma'
+    assert [(row['sources[0].capacity_mAh'], row[label]) for row in rows] == [(50.0, 1.0), (50.0, 20.0), (100.0, 1.0), (100.0, 20.0)]
+    # A higher load lowers the lifetime, a larger battery raises it
+    assert rows[1]['lifetime_sec'] < rows[0]['lifetime_sec'] < rows[2]['lifetime_sec']
+
+def test_process_pool_gives_the_same_rows():
+    axes = {'sources[0].capacity_mAh': [40.0, 60.0], 'sources[0].internal_resistance_ohm': [0.1, 0.5]}
+    assert epm.sweep(small_system(), axes, 3600.0, processes=2) == epm.sweep(small_system(), axes, 3600.0, processes=1)
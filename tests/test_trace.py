@@ -0,0 +1,88 @@
+import pickle
+
+import numpy as np
+import pytest
+
+import embedded_power_model as epm
+
+def write_trace(path, samples, dtype=np.float32):
+    np.asarray(samples, dtype=dtype).tofile(str(path))
+    return str(path)
+
+def trace_system(thread):
+    regulator = epm.VoltageRegulator(name="Rail", output_voltage=3.3, threads=[thread], quiescent_current_ma=0.01, is_switching=True,
+                                     efficiency=0.9)
+    source = epm.LithiumIonBattery(name="Cell", number_cells=1, regulators=[regulator], capacity_mAh=10.0, initial_charge_mAh=10.0,
+                                   internal_resistance_ohm=0.1)
+    return epm.EmbeddedSystem(name="Trace", sources=[source])
+
+def greedy_runs(samples, tolerance_ma):
+    # Reference for tolerance_ma: each run takes every following sample within tolerance_ma of its first one
+    counts = []
+    start = 0
+    while start < len(samples):
+        end = start
+        while end < len(samples) and abs(samples[end] - samples[start]) <= tolerance_ma:
+            end = end + 1
+        counts.append(end - start)
+        start = end
+    return counts
+
+def test_equal_samples_merge_into_stages(tmp_path):
+    filename = write_trace(tmp_path / "steps.bin", [1.0, 1.0, 5.0, 5.0, 5.0, 0.5])
+    thread = epm.TraceThread("T", filename, sample_period_sec=0.001, chunk_samples=2)
+    assert np.allclose(thread.stage_delta_t_sec, [0.002, 0.003, 0.001])
+    assert np.allclose(thread.stage_current_ma, [1.0, 5.0, 0.5])
+    assert thread.num_stages == 3 and len(thread.stages) == 3
+    assert isinstance(thread.stage_current_ma, np.memmap)
+
+@pytest.mark.parametrize("chunk_samples", [7, 64, 100000])
+def test_tolerance_keeps_the_charge_and_the_greedy_runs(tmp_path, chunk_samples):
+    rng = np.random.default_rng(4)
+    samples = np.concatenate([rng.normal(5.0, 0.1, 3000), np.full(500, 0.002), rng.normal(20.0, 2.0, 800)]).astype(np.float32)
+    filename = write_trace(tmp_path / "noisy.bin", samples)
+    thread = epm.TraceThread("T", filename, sample_period_sec=0.001, tolerance_ma=0.25, chunk_samples=chunk_samples)
+    counts = greedy_runs(samples.astype(np.float64), 0.25)
+    assert np.allclose(thread.stage_delta_t_sec, np.array(counts)*0.001)
+    assert np.sum(thread.stage_delta_t_sec*thread.stage_current_ma) == pytest.approx(0.001*np.sum(samples.astype(np.float64)), rel=1e-12)
+
+def test_long_stage_tables_run_from_scratch_files(tmp_path, monkeypatch):
+    rng = np.random.default_rng(5)
+    filename = write_trace(tmp_path / "long.bin", rng.normal(4.0, 1.0, 5000))
+    reference = trace_system(epm.TraceThread("T", filename, sample_period_sec=0.0001))
+    reference.power_profile(1.2)
+
+    monkeypatch.setattr(epm, "STAGE_TABLE_MEMORY_ROWS", 100)
+    system = trace_system(epm.TraceThread("T", filename, sample_period_sec=0.0001))
+    thread = system.sources[0].regulators[0].threads[0]
+    assert isinstance(thread.stage_time_sec, np.memmap)
+    system.power_profile(1.2, backend='python')
+    assert system.summary() == reference.summary()
+    compiled = system.compile()
+    assert isinstance(compiled.stage_current_ma, np.memmap) and isinstance(compiled.stage_ticks, np.memmap)
+
+    # Snapshots and pickles carry the per-stage times, pickles make the stage table again from the file
+    restored = trace_system(epm.TraceThread("T", filename, sample_period_sec=0.0001))
+    restored.restore(system.snapshot())
+    copy = pickle.loads(pickle.dumps(system))
+    for other in (restored, copy):
+        other.power_profile(0.3, extend=True)
+    system.power_profile(0.3, extend=True)
+    assert restored.summary() == system.summary() == copy.summary()
+
+def test_window_and_argument_errors(tmp_path):
+    filename = write_trace(tmp_path / "short.bin", [1.0, 2.0, 3.0])
+    thread = epm.TraceThread("T", filename, sample_period_sec=1.0, start_sample=1, num_samples=1)
+    assert np.allclose(thread.stage_current_ma, [2.0])
+    with pytest.raises(ValueError):
+        epm.TraceThread("T", filename, sample_period_sec=0.0)
+    with pytest.raises(ValueError):
+        epm.TraceThread("T", filename, sample_period_sec=1.0, tolerance_ma=0.0)
+    with pytest.raises(ValueError):
+        epm.TraceThread("T", filename, sample_period_sec=1.0, start_sample=3)
+
+def test_convert_trace_csv(tmp_path):
+    (tmp_path / "capture.csv").write_text("t,i\n0,0.001\n1,0.002\n2,0.002\n")
+    assert epm.convert_trace_csv(str(tmp_path / "capture.csv"), str(tmp_path / "capture.bin"), column=1, skip_rows=1, chunk_rows=2) == 3
+    thread = epm.TraceThread("T", str(tmp_path / "capture.bin"), sample_period_sec=1.0, scale_ma=1000.0)
+    assert np.allclose(thread.stage_current_ma, [1.0, 2.0], rtol=1e-6)